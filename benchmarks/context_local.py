@@ -0,0 +1,34 @@
+"""
+Measure the overhead of attribute access on the store context local compared to
+resolving the store through the application and extension on every access.
+
+    python benchmarks/context_local.py
+"""
+from flask import Flask
+from flask_storm import FlaskStorm, store
+from flask_storm.utils import _resolve_storm_store
+from functools import partial
+from timeit import repeat
+from werkzeug.local import LocalProxy
+
+
+def main(number=100000):
+    app = Flask("benchmark")
+    app.config["STORM_DATABASE_URI"] = "sqlite:"
+    FlaskStorm(app)
+
+    uncached_store = LocalProxy(partial(_resolve_storm_store, None, False))
+
+    with app.app_context():
+        for name, proxy in [("uncached", uncached_store), ("cached", store)]:
+            # Resolve once to exclude the cost of connecting
+            proxy.get
+
+            best = min(repeat(lambda: proxy.get, number=number, repeat=5))
+            print(
+                "{:>8}: {:.3f} us per access".format(name, best / number * 1000000)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 # example.py
 from flask import Flask, jsonify
-from flask_storm import FlaskStorm, store
+from flask_storm import bulk_insert, FlaskStorm, store
 from random import choice
 from storm.locals import Int, Unicode
 
@@ -46,8 +46,11 @@ def initdb():
         u"Eve",
     ]
 
-    for i in range(1, 16):
-        store.add(Post(choice(names), u"Post #{}".format(i)))
+    bulk_insert(
+        store,
+        Post,
+        [{"name": choice(names), "text": u"Post #{}".format(i)} for i in range(1, 16)],
+    )
 
     store.commit()
 
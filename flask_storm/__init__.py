@@ -1,7 +1,22 @@
 from logging import getLogger, NullHandler
 
-from .debug import DebugTracer, get_debug_queries, RequestTracer
+from .debug import (
+    DebugTracer,
+    get_debug_queries,
+    get_query_stats,
+    NPlusOneError,
+    NPlusOneTracer,
+    query_budget,
+    QueryBudgetExceeded,
+    QueryBudgetTracer,
+    RequestTracer,
+    SlowQueryTracer,
+    StatsTracer,
+)
 from .ext import FlaskStorm
+from .metrics import MetricsTracer
+from .orm import bulk_insert, prefetch, prefetched, stream
+from .shared import SharedStatsTracer
 from .utils import find_flask_storm, create_context_local
 
 logger = getLogger(__name__)
@@ -10,13 +25,27 @@ logger.addHandler(NullHandler())
 __version__ = "1.0.0"
 
 __all__ = [
+    "bulk_insert",
     "create_context_local",
     "DebugTracer",
     "FlaskStorm",
     "find_flask_storm",
     "get_debug_queries",
+    "get_query_stats",
+    "MetricsTracer",
+    "NPlusOneError",
+    "NPlusOneTracer",
+    "prefetch",
+    "prefetched",
+    "query_budget",
+    "QueryBudgetExceeded",
+    "QueryBudgetTracer",
     "RequestTracer",
+    "SharedStatsTracer",
+    "SlowQueryTracer",
+    "StatsTracer",
     "store",
+    "stream",
 ]
 
 #: Shorthand for :attr:`FlaskStorm.store` which does not depend on knowing
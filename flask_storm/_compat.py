@@ -1,8 +1,12 @@
 __all__ = [
     "base_string",
     "bstr",
+    "Full",
     "long_int",
+    "lru_cache",
     "max_int",
+    "perf_counter_ns",
+    "Queue",
     "ustr",
 ]
 
@@ -24,3 +28,51 @@ try:
     from sys import maxint as max_int
 except ImportError:
     from sys import maxsize as max_int
+
+try:
+    from time import perf_counter_ns
+except ImportError:  # Python < 3.7
+    try:
+        from time import perf_counter
+    except ImportError:  # Python 2
+        from time import time as perf_counter
+
+    def perf_counter_ns():
+        return int(perf_counter() * 1000000000)
+
+try:
+    from functools import lru_cache
+except ImportError:  # Python 2
+    from collections import OrderedDict
+    from functools import wraps
+    from threading import Lock
+
+    def lru_cache(maxsize=128):
+        def decorator(func):
+            cache = OrderedDict()
+            lock = Lock()
+
+            @wraps(func)
+            def wrapper(*args):
+                with lock:
+                    if args in cache:
+                        value = cache.pop(args)
+                        cache[args] = value
+                        return value
+
+                value = func(*args)
+                with lock:
+                    cache[args] = value
+                    if len(cache) > maxsize:
+                        cache.popitem(last=False)
+                return value
+
+            wrapper.cache_clear = cache.clear
+            return wrapper
+
+        return decorator
+
+try:
+    from queue import Full, Queue
+except ImportError:  # Python 2
+    from Queue import Full, Queue
@@ -0,0 +1,561 @@
+import re
+
+from collections import OrderedDict
+from storm.expr import Expr, Select, State
+from storm.info import get_cls_info, get_obj_info
+from storm.locals import Store
+from storm.variables import Variable
+from threading import Lock
+from time import time
+
+from ._compat import base_string
+from .sql import _unquote_table, tables
+
+
+__all__ = [
+    "CachingConnection",
+    "CachingStore",
+    "enable_result_cache",
+    "ObjectCache",
+]
+
+
+_cacheable_re = re.compile(r"^\s*SELECT\b", re.IGNORECASE)
+_locking_re = re.compile(r"\bFOR\s+(?:UPDATE|SHARE|NO\s+KEY|KEY)\b", re.IGNORECASE)
+
+
+class CachedCursor(object):
+    """
+    Minimal DB-API cursor that replays rows fetched by another cursor. Storm's
+    result classes only need the fetch methods and ``rowcount``.
+
+    :param rows: Sequence of rows as returned by the original cursor.
+    :param rowcount: Row count of the original cursor.
+    """
+
+    def __init__(self, rows, rowcount=-1):
+        self.arraysize = 10
+        self.rowcount = rowcount
+
+        self._rows = rows
+        self._pos = 0
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        rows = self._rows[self._pos : self._pos + size]
+        self._pos += len(rows)
+        return list(rows)
+
+    def fetchall(self):
+        rows = self._rows[self._pos :]
+        self._pos = len(self._rows)
+        return list(rows)
+
+    def close(self):
+        pass
+
+
+class CachingConnection(object):
+    """
+    Wrapper around a Storm connection that memoizes the rows of ``SELECT``
+    statements with the same SQL and parameters. Cached entries are
+    invalidated when a statement writes to one of the tables they read from,
+    and the whole cache is cleared on commit, rollback and statements where
+    the written tables can not be determined.
+
+    ``SELECT`` statements without a ``FROM`` clause, and ``SELECT`` statements
+    that lock rows using ``FOR UPDATE`` or ``FOR SHARE``, are never cached.
+
+    Written tables are found using :func:`flask_storm.sql.tables`, which only
+    sees the tables named in a statement. Results that depend on tables
+    changed through views, triggers or foreign key cascades are not
+    invalidated until the next commit or rollback.
+
+    :param connection: Storm connection to wrap.
+    :param max_entries: Number of statements to keep results for. The oldest
+                        entry is evicted when the limit is reached.
+    :param max_rows: Total number of rows to keep. The oldest entries are
+                     evicted to make room, and results with more rows are not
+                     cached.
+    """
+
+    def __init__(self, connection, max_entries=256, max_rows=10000):
+        self._connection = connection
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+
+        #: Number of statements served from the cache
+        self.hits = 0
+
+        #: Number of cacheable statements that were executed
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._tables = {}
+        self._rows = 0
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def clear(self):
+        """
+        Remove all cached results.
+        """
+
+        self._entries.clear()
+        self._tables.clear()
+        self._rows = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._rows -= len(entry[0])
+
+    def _invalidate(self, written):
+        if not written:
+            self.clear()
+            return
+
+        for table in written:
+            for key in self._tables.pop(table, ()):
+                self._remove(key)
+
+    def _get_key(self, statement, params):
+        values = []
+        for param in params or ():
+            if isinstance(param, Variable):
+                param = param.get(to_db=True)
+            values.append(param)
+
+        key = (statement, tuple(values))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _store(self, key, read, rows, rowcount):
+        if len(rows) > self.max_rows:
+            return
+
+        while self._entries and (
+            len(self._entries) >= self.max_entries
+            or self._rows + len(rows) > self.max_rows
+        ):
+            self._remove(next(iter(self._entries)))
+
+        self._entries[key] = (rows, rowcount)
+        self._rows += len(rows)
+        for table in read:
+            self._tables.setdefault(table, set()).add(key)
+
+    def execute(self, statement, params=None, noresult=False):
+        connection = self._connection
+        if connection._closed or connection._blocked:
+            # Let the connection raise the appropriate error
+            return connection.execute(statement, params, noresult)
+
+        if isinstance(statement, Expr):
+            if params is not None:
+                raise ValueError("Can't pass parameters with expressions")
+            state = State()
+            statement = connection.compile(statement, state)
+            params = state.parameters
+
+        read = tables(statement)
+        cacheable = (
+            not noresult
+            and read
+            and _cacheable_re.match(statement)
+            and not _locking_re.search(statement)
+        )
+        key = self._get_key(statement, params) if cacheable else None
+        if key is None:
+            self._invalidate(read)
+            return connection.execute(statement, params, noresult)
+
+        if key in self._entries:
+            self.hits += 1
+            if connection._event:
+                connection._event.emit("register-transaction")
+            rows, rowcount = self._entries[key]
+        else:
+            self.misses += 1
+            result = connection.execute(statement, params)
+            raw_cursor = result._raw_cursor
+            rows = tuple(connection._check_disconnect(raw_cursor.fetchall))
+            rowcount = raw_cursor.rowcount
+            result.close()
+            self._store(key, read, rows, rowcount)
+
+        return connection.result_factory(connection, CachedCursor(rows, rowcount))
+
+    def track_write(self, statement):
+        """
+        Invalidate the results of the tables written to by a statement that
+        was executed without using this connection, like ``COPY``.
+
+        :param statement: SQL statement that was executed.
+        """
+
+        self._invalidate(tables(statement))
+
+    def commit(self):
+        self.clear()
+        return self._connection.commit()
+
+    def rollback(self):
+        self.clear()
+        return self._connection.rollback()
+
+    def close(self):
+        self.clear()
+        return self._connection.close()
+
+
+def enable_result_cache(store, max_entries=256, max_rows=10000):
+    """
+    Enable memoization of ``SELECT`` statements on the given store. See
+    :class:`CachingConnection` for details. Enabling the cache twice on the
+    same store has no effect.
+
+    :param store: Store to enable the cache for.
+    :param max_entries: Number of statements to keep results for.
+    :param max_rows: Total number of rows to keep.
+    :return: The :class:`CachingConnection` of the store.
+    """
+
+    if not isinstance(store._connection, CachingConnection):
+        store._connection = CachingConnection(
+            store._connection, max_entries, max_rows
+        )
+    return store._connection
+
+
+class ObjectCache(object):
+    """
+    Process wide cache of the column values of Storm objects, keyed by
+    namespace, class and primary key. The namespace identifies the database
+    the values were loaded from. It is shared by all threads and is used by
+    :class:`CachingStore`. Entries are evicted when they expire, or when the
+    cache is full in least recently used order.
+
+    :param size: Number of objects to keep.
+    :param ttl: Number of seconds an entry is valid for. ``None`` keeps
+                entries until they are evicted or invalidated.
+    """
+
+    def __init__(self, size=1000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+
+        #: Number of lookups that were served from the cache
+        self.hits = 0
+
+        #: Number of lookups that were not served from the cache
+        self.misses = 0
+
+        #: Incremented on every invalidation. See :meth:`set`
+        self.generation = 0
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return the cached values for the given key.
+
+        :param key: Tuple of namespace, class and primary key values.
+        :return: Tuple of column values, or ``None`` if not cached.
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or (entry[0] is not None and entry[0] <= time()):
+                self.misses += 1
+                return None
+
+            # Reinsert to mark the entry as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, values, generation=None):
+        """
+        Cache the column values for the given key.
+
+        :param key: Tuple of namespace, class and primary key values.
+        :param values: Tuple of column values as loaded from the database.
+        :param generation: Value of :attr:`generation` before the values were
+                           loaded. If anything was invalidated since, the
+                           values may be stale and are not cached.
+        """
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            expires = None if self.ttl is None else time() + self.ttl
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, values)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove the given key from the cache.
+
+        :param key: Tuple of namespace, class and primary key values.
+        """
+
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def invalidate_tables(self, names):
+        """
+        Remove all objects of classes stored in the given tables.
+
+        :param names: Iterable of lower cased table names without schema.
+        """
+
+        names = set(names)
+        with self._lock:
+            self.generation += 1
+            for key in list(self._entries):
+                table = getattr(key[1], "__storm_table__", None)
+                if not isinstance(table, base_string):
+                    # The table is declared using an expression, so it is not
+                    # possible to tell whether it was written to
+                    del self._entries[key]
+                elif _unquote_table(table) in names:
+                    del self._entries[key]
+
+    def clear(self):
+        """
+        Remove all cached objects.
+        """
+
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+_write_re = re.compile(r"^\s*(?!SELECT\b)", re.IGNORECASE)
+
+
+class _WriteTrackingConnection(object):
+    """
+    Wrapper around a Storm connection that records the tables written to by
+    every statement. This sees statements that Storm executes without using
+    ``Store.execute``, like ``ResultSet.remove()`` and ``ResultSet.set()``.
+
+    :param connection: Storm connection to wrap.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+        #: Lower cased names of the tables written to
+        self.tables = set()
+
+        #: ``True`` if a statement wrote to tables that could not be determined
+        self.unknown = False
+
+        #: Statements are not tracked while this is non-zero
+        self.paused = 0
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def clear(self):
+        """
+        Forget all tracked writes.
+        """
+
+        self.tables.clear()
+        self.unknown = False
+
+    def track_write(self, statement):
+        """
+        Record the tables written to by the given statement. ``SELECT``
+        statements are ignored.
+
+        :param statement: SQL statement.
+        """
+
+        if _write_re.match(statement):
+            written = tables(statement)
+            self.tables.update(written)
+            self.unknown |= not written
+
+    def execute(self, statement, params=None, noresult=False):
+        connection = self._connection
+        if self.paused or connection._closed or connection._blocked:
+            return connection.execute(statement, params, noresult)
+
+        if isinstance(statement, Expr):
+            if isinstance(statement, Select):
+                return connection.execute(statement, params, noresult)
+
+            if params is not None:
+                raise ValueError("Can't pass parameters with expressions")
+            state = State()
+            statement = connection.compile(statement, state)
+            params = state.parameters
+
+        self.track_write(statement)
+        return connection.execute(statement, params, noresult)
+
+
+def _alive_key(cls_info, variables):
+    # Same as the keys Storm uses for alive objects
+    return (cls_info.cls, tuple(variable.get(to_db=True) for variable in variables))
+
+
+class CachingStore(Store):
+    """
+    Store that serves :meth:`get` from an :class:`ObjectCache`, which makes
+    it possible to reuse objects across application contexts and stores.
+
+    Objects flushed by this store are invalidated in the object cache when the
+    store commits. Other statements that write to tables, like
+    :meth:`execute` or ``ResultSet.remove()``, invalidate all cached objects of
+    those tables. Writes made by other processes, or stores that do not use
+    the object cache, are only visible once the cached entries expire.
+
+    Stores connected to replicas should share the namespace of the primary
+    and be ``readonly``. They then use the objects loaded from the primary,
+    but never add objects to the cache. A replica that lags behind could
+    otherwise add stale values right after a commit invalidated them.
+
+    :param database: Storm Database to connect to.
+    :param object_cache: :class:`ObjectCache` to use. When ``None`` this store
+                         behaves like a regular store.
+    :param cache: Storm cache of alive objects. See Storm's ``Store``.
+    :param namespace: Hashable value that identifies the database in the
+                      object cache. Stores of different databases must use
+                      different namespaces.
+    :param readonly: When ``True`` objects loaded by this store are not added
+                     to the object cache.
+    """
+
+    def __init__(
+        self, database, object_cache=None, cache=None, namespace=None, readonly=False
+    ):
+        Store.__init__(self, database, cache)
+        self.object_cache = object_cache
+        self.namespace = namespace
+        self.readonly = readonly
+
+        self._written_objects = set()
+        self._write_tracker = None
+        if object_cache is not None:
+            # Writes are tracked on the connection, since Storm executes some
+            # statements without using execute()
+            self._write_tracker = _WriteTrackingConnection(self._connection)
+            self._connection = self._write_tracker
+
+    def get(self, cls, key):
+        object_cache = self.object_cache
+        if object_cache is None:
+            return Store.get(self, cls, key)
+
+        if self._implicit_flush_block_count == 0:
+            self.flush()
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        cls_info = get_cls_info(cls)
+        primary_vars = []
+        for column, variable in zip(cls_info.primary_key, key):
+            if not isinstance(variable, Variable):
+                variable = column.variable_factory(value=variable)
+            primary_vars.append(variable)
+
+        # Alive objects take precedence, since they may have been modified
+        alive_key = _alive_key(cls_info, primary_vars)
+        obj_info = self._alive.get(alive_key)
+        if obj_info is not None and not obj_info.get("invalidated"):
+            return self._get_object(obj_info)
+
+        cache_key = (self.namespace,) + alive_key
+        values = object_cache.get(cache_key)
+        if values is not None:
+            # The result is only used to convert the values into variables
+            connection = self._connection
+            result = connection.result_factory(connection, CachedCursor(()))
+            return self._load_object(cls_info, result, values)
+
+        generation = object_cache.generation
+        obj = Store.get(self, cls, tuple(primary_vars))
+        if obj is not None and not self.readonly:
+            variables = get_obj_info(obj).variables
+            values = tuple(
+                variables[column].get(to_db=True) for column in cls_info.columns
+            )
+            object_cache.set(cache_key, values, generation)
+        return obj
+
+    def _flush_one(self, obj_info):
+        if self.object_cache is None:
+            return Store._flush_one(self, obj_info)
+
+        cls_info = obj_info.cls_info
+        if "primary_vars" in obj_info:
+            self._written_objects.add(_alive_key(cls_info, obj_info["primary_vars"]))
+
+        # Flushed objects are invalidated one by one, rather than invalidating
+        # every object of their table
+        self._write_tracker.paused += 1
+        try:
+            Store._flush_one(self, obj_info)
+        finally:
+            self._write_tracker.paused -= 1
+        self._written_objects.add(_alive_key(cls_info, obj_info.primary_vars))
+
+    def _invalidate_object_cache(self):
+        object_cache = self.object_cache
+        tracker = self._write_tracker
+        if tracker.unknown:
+            object_cache.clear()
+            return
+
+        for key in self._written_objects:
+            object_cache.invalidate((self.namespace,) + key)
+        if tracker.tables:
+            object_cache.invalidate_tables(tracker.tables)
+
+    def _forget_writes(self):
+        self._written_objects.clear()
+        if self._write_tracker is not None:
+            self._write_tracker.clear()
+
+    def commit(self):
+        if self.object_cache is None:
+            return Store.commit(self)
+
+        # Invalidating before the commit prevents other threads from using
+        # stale values once the commit is visible, and invalidating after
+        # discards values they loaded before it was
+        self.flush()
+        self._invalidate_object_cache()
+        Store.commit(self)
+        self._invalidate_object_cache()
+        self._forget_writes()
+
+    def rollback(self):
+        Store.rollback(self)
+        self._forget_writes()
@@ -0,0 +1,91 @@
+import click
+import os
+
+from flask import current_app
+from flask.cli import AppGroup
+
+from .shared import SharedStats
+
+__all__ = [
+    "storm_cli",
+]
+
+
+storm_cli = AppGroup("storm", help="Flask-Storm commands.")
+
+_sort_keys = {
+    "total": lambda entry: entry.total_ns,
+    "count": lambda entry: entry.count,
+    "mean": lambda entry: entry.total_ns / entry.count,
+    "max": lambda entry: entry.max_ns,
+    "errors": lambda entry: entry.errors,
+}
+
+
+@storm_cli.command("stats")
+@click.option(
+    "--path",
+    help="Statistics file. Defaults to STORM_SHARED_STATS_PATH.",
+)
+@click.option(
+    "--sort",
+    type=click.Choice(sorted(_sort_keys)),
+    default="total",
+    show_default=True,
+    help="Column to sort statements by.",
+)
+@click.option(
+    "--limit",
+    type=int,
+    default=20,
+    show_default=True,
+    help="Number of statements to show.",
+)
+@click.option("--reset", is_flag=True, help="Remove all statistics after showing.")
+def stats_command(path, sort, limit, reset):
+    """
+    Show the statements with the highest total time on this host.
+    """
+
+    if path is None:
+        path = current_app.config.get("STORM_SHARED_STATS_PATH")
+    if path is None:
+        raise click.UsageError(
+            "No statistics file given, use --path or set STORM_SHARED_STATS_PATH"
+        )
+    if not os.path.exists(path):
+        raise click.ClickException("Statistics file {} does not exist".format(path))
+
+    stats = SharedStats(path)
+    try:
+        entries = sorted(stats.entries(), key=_sort_keys[sort], reverse=True)
+
+        click.echo(
+            "{:>12} {:>10} {:>10} {:>10} {:>8}  {}".format(
+                "total ms", "count", "mean ms", "max ms", "errors", "statement"
+            )
+        )
+        for entry in entries[:limit]:
+            click.echo(
+                "{:>12.1f} {:>10} {:>10.2f} {:>10.2f} {:>8}  {}".format(
+                    entry.total_ns / 1e6,
+                    entry.count,
+                    entry.total_ns / 1e6 / entry.count,
+                    entry.max_ns / 1e6,
+                    entry.errors,
+                    entry.text,
+                )
+            )
+
+        overflow = stats.overflow
+        if overflow:
+            click.echo(
+                "{} executions were not recorded since the file is full".format(
+                    overflow
+                )
+            )
+
+        if reset:
+            stats.reset()
+    finally:
+        stats.close()
@@ -1,21 +1,45 @@
+import atexit
+import json
 import sys
+import warnings
 
-from datetime import datetime
-from flask import _app_ctx_stack, has_request_context, request
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import (
+    _app_ctx_stack,
+    abort,
+    appcontext_tearing_down,
+    has_request_context,
+    request,
+    signals,
+)
+from logging import getLogger
 from operator import itemgetter
+from random import random
+from threading import Lock, Thread
+from time import time
+from weakref import WeakSet
+from storm.databases.sqlite import SQLiteConnection
 from storm.tracer import install_tracer, remove_tracer
+from storm.variables import Variable
 from werkzeug.local import Local
 
-from .sql import Adapter, replace_placeholders, format as format_sql, color as color_sql
-from .utils import has_color_support, colored
-
-try:
-    import sqlparse
-except ImportError:
-    sqlparse = None
+from ._compat import bstr, perf_counter_ns, Queue, Full, ustr
+from .sql import (
+    adapt_params,
+    Adapter,
+    fingerprint,
+    literal_adapter,
+    render as render_sql,
+    replace_placeholders,
+)
+from .utils import colored, get_connection_bind_name, has_color_support
 
 
 __all__ = [
+    "DebugQueryLog",
+    "MonotonicDebugQuery",
     "DebugTracer",
     "get_debug_queries",
     "RequestTracer",
@@ -23,6 +47,43 @@ __all__ = [
 ]
 
 
+logger = getLogger(__name__)
+
+
+class _GlobalTracer(object):
+    """
+    Base class for tracers that are installed globally using :meth:`start` and
+    :meth:`stop`, or by using the tracer as a context manager.
+    """
+
+    def __init__(self):
+        # Use thread locals since the tracer gets installed globally. This
+        # ensures start time will be correctly measured, even in multi-threaded
+        # environments. Werkzeug's implementation is used instead of threading
+        # from the standard library since Werkzeug supports greenlets as well.
+        self.threadinfo = Local()
+
+    def start(self):
+        """
+        Install this tracer for all statements.
+        """
+
+        install_tracer(self)
+
+    def stop(self):
+        """
+        Stop using this tracer.
+        """
+
+        remove_tracer(self)
+
+    def __enter__(self):
+        self.start()
+
+    def __exit__(self, type, exception, traceback):
+        self.stop()
+
+
 class DebugQuery(tuple):
     __slots__ = ()
 
@@ -40,6 +101,83 @@ class DebugQuery(tuple):
         return tuple.__new__(cls, [statement, params, start_time, end_time])
 
 
+class MonotonicDebugQuery(DebugQuery):
+    """
+    A query recorded by a :class:`DebugTracer` using the monotonic clock. Times
+    are stored as integer nanoseconds from :func:`time.perf_counter_ns`, and
+    :attr:`start_time`, :attr:`end_time` and :attr:`duration` are derived from
+    them on access.
+    """
+
+    __slots__ = ()
+
+    start_ns = property(itemgetter(2))
+    end_ns = property(itemgetter(3))
+    anchor = property(itemgetter(4))
+
+    @property
+    def start_time(self):
+        wall_time, anchor_ns = self.anchor
+        return wall_time + timedelta(microseconds=(self.start_ns - anchor_ns) / 1000.0)
+
+    @property
+    def end_time(self):
+        wall_time, anchor_ns = self.anchor
+        return wall_time + timedelta(microseconds=(self.end_ns - anchor_ns) / 1000.0)
+
+    @property
+    def duration_ns(self):
+        return self.end_ns - self.start_ns
+
+    @property
+    def duration(self):
+        return timedelta(microseconds=self.duration_ns / 1000.0)
+
+    def __new__(cls, statement, params, start_ns, end_ns, anchor):
+        return tuple.__new__(cls, [statement, params, start_ns, end_ns, anchor])
+
+
+class DebugQueryLog(deque):
+    """
+    A ring buffer of queries used by :class:`DebugTracer` when ``max_queries``
+    is given. When full, the oldest query is discarded for every new one.
+    Discarded queries are counted in :attr:`dropped`.
+    """
+
+    def __init__(self, maxlen=None):
+        super(DebugQueryLog, self).__init__(maxlen=maxlen)
+
+        #: Number of queries discarded because the log was full
+        self.dropped = 0
+
+    @property
+    def total(self):
+        """
+        Total number of queries appended, including dropped ones.
+        """
+
+        return len(self) + self.dropped
+
+    def append(self, query):
+        if self.maxlen is not None and len(self) == self.maxlen:
+            self.dropped += 1
+        super(DebugQueryLog, self).append(query)
+
+
+def _truncate_param(value, max_size):
+    if isinstance(value, Variable):
+        value = value.get(to_db=True)
+
+    if isinstance(value, memoryview):
+        value = value[:max_size + 1].tobytes()
+
+    if isinstance(value, ustr) and len(value) > max_size:
+        return value[:max_size] + u"..."
+    elif isinstance(value, (bstr, bytearray)) and len(value) > max_size:
+        return value[:max_size] + b"..."
+    return value
+
+
 class DebugTracer(object):
     """
     A tracer which stores all queries with parameters onto the current request
@@ -53,42 +191,154 @@ class DebugTracer(object):
             # Perform queries
             queries = get_debug_queries()
 
+    Sampling makes the tracer cheap enough to leave enabled in production.
+    Requests that are not sampled are not timed at all, unless
+    ``slow_threshold`` is given.
+
+    ::
+
+        # Record 1 % of all requests, the first 10 executions of every
+        # statement, and every query slower than 100 ms
+        tracer = DebugTracer(
+            sample_rate=0.01,
+            slow_threshold=timedelta(milliseconds=100),
+            max_per_statement=10,
+        )
+
     .. note::
        :func:`get_debug_queries` do not need to be called within the context
        manager, as long as the request context is still alive, since all queries
        are stored on the request context.
+
+    :param sample_rate: Fraction of application contexts to record queries for.
+                        The decision is made once per application context.
+    :param slow_threshold: ``timedelta``. Queries at least this slow are always
+                           recorded, even if the application context is not
+                           sampled.
+    :param max_per_statement: Only record the first executions of every
+                              statement fingerprint within an application
+                              context. See :func:`~flask_storm.sql.fingerprint`.
+    :param max_queries: Keep at most this many queries per application context
+                        in a :class:`DebugQueryLog`. Older queries are dropped.
+    :param max_param_size: Truncate string and binary parameters longer than
+                           this. Parameters are not retained beyond the size
+                           limit.
+    :param clock: ``wall`` (default) to time queries using ``datetime.now()``,
+                  or ``monotonic`` to use :func:`time.perf_counter_ns`. The
+                  monotonic clock is unaffected by clock adjustments, has a
+                  higher resolution and records queries as
+                  :class:`MonotonicDebugQuery`.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        sample_rate=1.0,
+        slow_threshold=None,
+        max_per_statement=None,
+        max_queries=None,
+        max_param_size=None,
+        clock="wall",
+    ):
         # Use thread locals since the tracer gets installed globally. This
         # ensures start time will be correctly measured, even in multi-threaded
         # environments. Werkzeug's implementation is used instead of threading
         # from the standard library since Werkzeug supports greenlets as well.
         self.threadinfo = Local()
 
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_per_statement = max_per_statement
+        self.max_queries = max_queries
+        self.max_param_size = max_param_size
+
+        if clock == "wall":
+            self._now = datetime.now
+        elif clock == "monotonic":
+            self._now = perf_counter_ns
+
+            # Anchor monotonic times to the wall clock so absolute start and end
+            # times can be derived on demand
+            self._anchor = (datetime.now(), perf_counter_ns())
+            if slow_threshold is not None:
+                slow_threshold = int(slow_threshold.total_seconds() * 1000000000)
+        else:
+            raise ValueError("Unknown clock {!r}".format(clock))
+
+        self.clock = clock
+        self._slow_threshold = slow_threshold
+
+    def _is_sampled(self, ctx):
+        if self.sample_rate >= 1:
+            return True
+
+        # The sampling decision is made once per application context, so
+        # sampled requests have a complete query log
+        sampled = getattr(ctx, "storm_debug_sampled", None)
+        if sampled is None:
+            sampled = ctx.storm_debug_sampled = random() < self.sample_rate
+        return sampled
+
+    def _should_record(self, ctx, statement, duration):
+        if self._slow_threshold is not None and duration >= self._slow_threshold:
+            return True
+
+        if not self._is_sampled(ctx):
+            return False
+
+        if self.max_per_statement is not None:
+            if not hasattr(ctx, "storm_debug_statement_counts"):
+                ctx.storm_debug_statement_counts = {}
+
+            key = fingerprint(statement).hash
+            counts = ctx.storm_debug_statement_counts
+            counts[key] = counts.get(key, 0) + 1
+            if counts[key] > self.max_per_statement:
+                return False
+
+        return True
+
     def connection_raw_execute(self, connection, raw_cursor, statement, params):
-        self.threadinfo.start_time = datetime.now()
+        # Skip timing entirely for requests that are not sampled, unless slow
+        # queries must be recorded regardless
+        if self.slow_threshold is None and self.sample_rate < 1:
+            ctx = _app_ctx_stack.top
+            if ctx is None or not self._is_sampled(ctx):
+                return
+
+        self.threadinfo.start_time = self._now()
 
     def connection_raw_execute_success(self, connection, raw_cursor, statement, params):
+        start_time = getattr(self.threadinfo, "start_time", None)
+        if start_time is None:
+            return
+
+        # Remove start time to prevent leakage across queries
+        self.threadinfo.start_time = None
+        end_time = self._now()
 
         ctx = _app_ctx_stack.top
         if ctx is None:
             return
 
+        if not self._should_record(ctx, statement, end_time - start_time):
+            return
+
         if not hasattr(ctx, "storm_debug_queries"):
-            ctx.storm_debug_queries = []
+            if self.max_queries is None:
+                ctx.storm_debug_queries = []
+            else:
+                ctx.storm_debug_queries = DebugQueryLog(self.max_queries)
 
-        ctx.storm_debug_queries.append(
-            DebugQuery(
-                statement,
-                params,
-                getattr(self.threadinfo, "start_time"),
-                datetime.now(),
-            )
-        )
+        if self.max_param_size is not None:
+            params = tuple(_truncate_param(p, self.max_param_size) for p in params)
 
-        # Remove start time to prevent leakage across queries
-        delattr(self.threadinfo, "start_time")
+        if self.clock == "monotonic":
+            query = MonotonicDebugQuery(
+                statement, params, start_time, end_time, self._anchor
+            )
+        else:
+            query = DebugQuery(statement, params, start_time, end_time)
+        ctx.storm_debug_queries.append(query)
 
     def connection_raw_execute_error(
         self, connection, raw_cursor, statement, params, error
@@ -105,21 +355,895 @@ class DebugTracer(object):
 def get_debug_queries():
     """
     Return an array of queries executed within the context of a
-    :class:`DebugTracer` under the current application context and thread.
+    :class:`DebugTracer` under the current application context and thread. If
+    the tracer limits the number of queries a :class:`DebugQueryLog` is
+    returned instead.
     """
 
     return getattr(_app_ctx_stack.top, "storm_debug_queries", [])
 
 
+class StatementStats(object):
+    """
+    Running statistics for a single statement within an application context.
+    """
+
+    __slots__ = ("count", "errors", "total_ns", "max_ns")
+
+    def __init__(self):
+        #: Number of executions
+        self.count = 0
+
+        #: Number of executions that failed
+        self.errors = 0
+
+        #: Total execution time in nanoseconds
+        self.total_ns = 0
+
+        #: Execution time of the slowest execution in nanoseconds
+        self.max_ns = 0
+
+    @property
+    def total_time(self):
+        return timedelta(microseconds=self.total_ns / 1000.0)
+
+    @property
+    def max_time(self):
+        return timedelta(microseconds=self.max_ns / 1000.0)
+
+    def add(self, duration_ns, success=True):
+        self.count += 1
+        if not success:
+            self.errors += 1
+        self.total_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+
+class QueryStats(StatementStats):
+    """
+    Running statistics for all queries within an application context, as
+    returned by :func:`get_query_stats`. Memory use is proportional to the
+    number of distinct statements rather than the number of queries.
+    """
+
+    __slots__ = ("slowest_statement", "statements")
+
+    def __init__(self):
+        super(QueryStats, self).__init__()
+
+        #: Statement of the slowest execution, or ``None`` if there were no
+        #: queries
+        self.slowest_statement = None
+
+        #: Dict from normalized statement to :class:`StatementStats`. See
+        #: :func:`~flask_storm.sql.fingerprint`
+        self.statements = {}
+
+    def record(self, statement, duration_ns, success=True):
+        if duration_ns > self.max_ns or self.slowest_statement is None:
+            self.slowest_statement = statement
+        self.add(duration_ns, success)
+
+        stats = self.statements.get(statement)
+        if stats is None:
+            stats = self.statements[statement] = StatementStats()
+        stats.add(duration_ns, success)
+
+
+class StatsTracer(_GlobalTracer):
+    """
+    A tracer which keeps running statistics of the queries executed within the
+    current application context, without storing the queries themselves. The
+    statistics are accessible using :func:`get_query_stats`. This is cheap
+    enough to keep installed in production.
+
+    ::
+
+        tracer = StatsTracer()
+        tracer.start()
+
+        @app.after_request
+        def log_query_stats(response):
+            stats = get_query_stats()
+            app.logger.info(
+                "%s queries in %s", stats.count, stats.total_time
+            )
+            return response
+    """
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        self.threadinfo.start_ns = perf_counter_ns()
+
+    def _add(self, statement, success):
+        start_ns = getattr(self.threadinfo, "start_ns", None)
+        if start_ns is None:
+            return
+        self.threadinfo.start_ns = None
+        duration_ns = perf_counter_ns() - start_ns
+
+        ctx = _app_ctx_stack.top
+        if ctx is None:
+            return
+
+        if not hasattr(ctx, "storm_query_stats"):
+            ctx.storm_query_stats = QueryStats()
+        ctx.storm_query_stats.record(
+            fingerprint(statement).text, duration_ns, success
+        )
+
+    def connection_raw_execute_success(self, connection, raw_cursor, statement, params):
+        self._add(statement, True)
+
+    def connection_raw_execute_error(
+        self, connection, raw_cursor, statement, params, error
+    ):
+        self._add(statement, False)
+
+
+def get_query_stats():
+    """
+    Return :class:`QueryStats` for queries executed within the context of a
+    :class:`StatsTracer` under the current application context. If no queries
+    have been executed empty statistics are returned.
+    """
+
+    stats = getattr(_app_ctx_stack.top, "storm_query_stats", None)
+    if stats is None:
+        return QueryStats()
+    return stats
+
+
+class NPlusOneWarning(UserWarning):
+    """
+    Warning issued by :class:`NPlusOneTracer` when a statement is repeated too
+    many times within an application context.
+    """
+
+
+class NPlusOneError(RuntimeError):
+    """
+    Raised by :class:`NPlusOneTracer` when a statement is repeated too many
+    times within an application context.
+
+    :param statement: Normalized statement that was repeated.
+    :param count: Number of times the statement was executed.
+    """
+
+    def __init__(self, statement, count):
+        super(NPlusOneError, self).__init__(
+            "Statement executed {} times in one application context, this is "
+            "likely an N+1 query: {}".format(count, statement)
+        )
+        self.statement = statement
+        self.count = count
+
+
+class NPlusOneTracer(_GlobalTracer):
+    """
+    A tracer which detects N+1 query patterns, which typically come from lazily
+    loaded references within a loop. Statements are grouped by their
+    :func:`~flask_storm.sql.fingerprint`, so statements that only differ in
+    their values are counted together. Once a normalized statement is executed more
+    than ``threshold`` times within an application context it is reported once.
+
+    ::
+
+        # Fail tests that trigger N+1 queries
+        with NPlusOneTracer(threshold=5, action="raise"):
+            client.get("/posts")
+
+    :param threshold: Number of executions of the same statement that are
+                      allowed within an application context.
+    :param action: ``log`` to log a warning using the ``flask_storm.debug``
+                   logger, ``warn`` to issue a :class:`NPlusOneWarning`, or
+                   ``raise`` to raise :class:`NPlusOneError` from the query that
+                   exceeded the threshold.
+    :raises ValueError: if the action is unknown.
+    """
+
+    actions = ("log", "warn", "raise")
+
+    def __init__(self, threshold=10, action="log"):
+        if action not in self.actions:
+            raise ValueError(
+                "Unknown action {!r}, expected one of {}".format(
+                    action, ", ".join(self.actions)
+                )
+            )
+
+        super(NPlusOneTracer, self).__init__()
+        self.threshold = threshold
+        self.action = action
+
+    def _report(self, statement, count):
+        if self.action == "raise":
+            raise NPlusOneError(statement, count)
+        elif self.action == "warn":
+            warnings.warn(
+                "Statement executed {} times, this is likely an N+1 query: "
+                "{}".format(count, statement),
+                NPlusOneWarning,
+                stacklevel=2,
+            )
+        else:
+            logger.warning(
+                "Statement executed %d times, this is likely an N+1 query: %s",
+                count,
+                statement,
+            )
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        ctx = _app_ctx_stack.top
+        if ctx is None:
+            return
+
+        if not hasattr(ctx, "storm_nplusone_counts"):
+            ctx.storm_nplusone_counts = {}
+
+        text = fingerprint(statement).text
+        counts = ctx.storm_nplusone_counts
+        counts[text] = count = counts.get(text, 0) + 1
+
+        # Only report the first time the threshold is exceeded to prevent
+        # flooding the log
+        if count == self.threshold + 1:
+            self._report(text, count)
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """
+    Raised by :class:`QueryBudgetTracer` when an application context exceeds
+    its query budget.
+
+    :param message: Description of the exceeded limit.
+    :param queries: Number of statements executed.
+    :param db_time: Milliseconds spent executing statements.
+    """
+
+    def __init__(self, message, queries, db_time):
+        super(QueryBudgetExceeded, self).__init__(message)
+        self.queries = queries
+        self.db_time = db_time
+
+
+class QueryBudgetUsage(object):
+    """
+    Statements executed within one application context, as measured by
+    :class:`QueryBudgetTracer`.
+    """
+
+    __slots__ = ("queries", "total_ns", "exceeded")
+
+    def __init__(self):
+        #: Number of statements executed
+        self.queries = 0
+
+        #: Total execution time in nanoseconds
+        self.total_ns = 0
+
+        #: ``True`` once a limit has been exceeded
+        self.exceeded = False
+
+    @property
+    def db_time(self):
+        """
+        Total execution time in milliseconds.
+        """
+
+        return self.total_ns / 1000000.0
+
+
+def _check_query_budget_mode(mode):
+    if mode not in QueryBudgetTracer.modes:
+        raise ValueError(
+            "Unknown query budget mode {!r}, expected one of {}".format(
+                mode, ", ".join(QueryBudgetTracer.modes)
+            )
+        )
+
+
+def query_budget(max_queries=None, max_db_time=None, mode=None):
+    """
+    Decorator that overrides the limits of :class:`QueryBudgetTracer` for a
+    view. Arguments that are ``None`` use the configured value.
+
+    ::
+
+        @app.route("/report")
+        @query_budget(max_queries=500, max_db_time=2000)
+        def report():
+            ...
+
+    :param max_queries: Number of statements the view may execute.
+    :param max_db_time: Milliseconds the view may spend executing statements.
+    :param mode: What to do when a limit is exceeded. See
+                 :class:`QueryBudgetTracer`.
+    :raises ValueError: if the mode is unknown.
+    """
+
+    if mode is not None:
+        _check_query_budget_mode(mode)
+
+    overrides = {}
+    if max_queries is not None:
+        overrides["max_queries"] = max_queries
+    if max_db_time is not None:
+        overrides["max_db_time"] = max_db_time
+    if mode is not None:
+        overrides["mode"] = mode
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            ctx = _app_ctx_stack.top
+            if ctx is None:
+                return func(*args, **kwargs)
+
+            # Restore the previous limits, since the application context may
+            # outlive the view, for example when it is called directly
+            previous = getattr(ctx, "storm_query_budget", {})
+            ctx.storm_query_budget = overrides
+            try:
+                return func(*args, **kwargs)
+            finally:
+                ctx.storm_query_budget = previous
+
+        return wrapper
+
+    return decorator
+
+
+class QueryBudgetTracer(_GlobalTracer):
+    """
+    A tracer which limits the number of statements, and the time spent
+    executing them, within a request. Limits are read from the configuration of
+    the current application and can be overridden per view using
+    :func:`query_budget`. Statements executed outside of requests, for example
+    by CLI commands or in the shell, are not limited.
+
+    ``STORM_MAX_QUERIES_PER_REQUEST``
+        Number of statements a request may execute.
+
+    ``STORM_MAX_DB_TIME_PER_REQUEST``
+        Milliseconds a request may spend executing statements.
+
+    ``STORM_QUERY_BUDGET_MODE``
+        ``log`` (default) to log a warning using the ``flask_storm.debug``
+        logger, ``raise`` to raise :class:`QueryBudgetExceeded` or ``abort``
+        to log a warning and abort the request with ``503 Service
+        Unavailable``.
+
+    A limit is reported once per request. The statement count is checked before
+    a statement is executed, which means the statement that would exceed the
+    limit is not executed in ``raise`` and ``abort`` mode.
+
+    :raises ValueError: from :meth:`start`, or the first statement of a
+                        request, if ``STORM_QUERY_BUDGET_MODE`` is unknown.
+    """
+
+    modes = ("log", "raise", "abort")
+
+    def start(self):
+        """
+        Install this tracer for all statements. If an application context is
+        active its ``STORM_QUERY_BUDGET_MODE`` is validated.
+
+        :raises ValueError: if ``STORM_QUERY_BUDGET_MODE`` is unknown.
+        """
+
+        ctx = _app_ctx_stack.top
+        if ctx is not None:
+            config = ctx.app.config
+            _check_query_budget_mode(config.get("STORM_QUERY_BUDGET_MODE", "log"))
+        super(QueryBudgetTracer, self).start()
+
+    def _get_ctx(self):
+        # Budgets only apply to requests, since CLI commands and the shell are
+        # expected to run long batches of statements
+        if not has_request_context():
+            return None
+        return _app_ctx_stack.top
+
+    def _get_limits(self, ctx):
+        config = ctx.app.config
+        limits = {
+            "max_queries": config.get("STORM_MAX_QUERIES_PER_REQUEST"),
+            "max_db_time": config.get("STORM_MAX_DB_TIME_PER_REQUEST"),
+            "mode": config.get("STORM_QUERY_BUDGET_MODE", "log"),
+        }
+        limits.update(getattr(ctx, "storm_query_budget", {}))
+        return limits
+
+    def _get_usage(self, ctx):
+        try:
+            return ctx.storm_query_budget_usage
+        except AttributeError:
+            # The mode is validated once per request, rather than only when a
+            # limit is exceeded
+            _check_query_budget_mode(self._get_limits(ctx)["mode"])
+            usage = ctx.storm_query_budget_usage = QueryBudgetUsage()
+            return usage
+
+    def _report(self, usage, mode, message):
+        usage.exceeded = True
+        message += " in endpoint {!r}".format(request.endpoint)
+
+        if mode == "raise":
+            raise QueryBudgetExceeded(message, usage.queries, usage.db_time)
+
+        logger.warning("Query budget exceeded: %s", message)
+        if mode == "abort":
+            abort(503)
+
+    def _finish(self):
+        start_ns = getattr(self.threadinfo, "start_ns", None)
+        if start_ns is None:
+            return
+        self.threadinfo.start_ns = None
+
+        ctx = self._get_ctx()
+        if ctx is None:
+            return
+
+        usage = self._get_usage(ctx)
+        usage.total_ns += perf_counter_ns() - start_ns
+        if usage.exceeded:
+            return
+
+        limits = self._get_limits(ctx)
+        max_db_time = limits["max_db_time"]
+        if max_db_time is not None and usage.db_time > max_db_time:
+            self._report(
+                usage,
+                limits["mode"],
+                "{:.1f} ms spent executing statements, the limit is {} ms".format(
+                    usage.db_time, max_db_time
+                ),
+            )
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        ctx = self._get_ctx()
+        if ctx is None:
+            return
+
+        usage = self._get_usage(ctx)
+        usage.queries += 1
+        if not usage.exceeded:
+            limits = self._get_limits(ctx)
+            max_queries = limits["max_queries"]
+            if max_queries is not None and usage.queries > max_queries:
+                self._report(
+                    usage,
+                    limits["mode"],
+                    "{} statements executed, the limit is {}".format(
+                        usage.queries, max_queries
+                    ),
+                )
+
+        self.threadinfo.start_ns = perf_counter_ns()
+
+    def connection_raw_execute_success(self, connection, raw_cursor, statement, params):
+        self._finish()
+
+    def connection_raw_execute_error(
+        self, connection, raw_cursor, statement, params, error
+    ):
+        self._finish()
+
+
+class QueuedWriter(object):
+    """
+    Formats and writes output on a background thread, to keep slow terminals,
+    pipes or files from delaying the thread that produces the output. Work is
+    submitted as callables returning the text to write. Pending output is
+    flushed at interpreter exit.
+
+    :param file: File like object (has write method) to write to.
+    :param maxsize: Maximum number of pending writes.
+    :param policy: ``drop`` to discard output when the queue is full, or
+                   ``block`` to wait for space in the queue.
+    :raises ValueError: if the policy is unknown.
+    """
+
+    policies = ("drop", "block")
+
+    def __init__(self, file, maxsize=1000, policy="drop"):
+        if policy not in self.policies:
+            raise ValueError(
+                "Unknown queue policy {!r}, expected one of {}".format(
+                    policy, ", ".join(self.policies)
+                )
+            )
+
+        self.file = file
+        self.policy = policy
+
+        #: Number of writes dropped because the queue was full
+        self.dropped = 0
+
+        self._queue = Queue(maxsize)
+        self._thread = None
+        self._lock = Lock()
+
+        _queued_writers.add(self)
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                thread = Thread(target=self._run, name="flask-storm-writer")
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+
+                func, args = item
+                self.file.write(func(*args))
+            except Exception:
+                logger.exception("Failed to write queued output")
+            finally:
+                self._queue.task_done()
+
+    def submit(self, func, *args):
+        """
+        Queue ``func(*args)`` to be called on the background thread. The return
+        value is written to the file.
+        """
+
+        self._ensure_thread()
+
+        if self.policy == "block":
+            self._queue.put((func, args))
+            return
+
+        try:
+            self._queue.put_nowait((func, args))
+        except Full:
+            with self._lock:
+                self.dropped += 1
+
+    def write(self, text):
+        """
+        Queue the given text to be written.
+        """
+
+        self.submit(ustr, text)
+
+    def flush(self):
+        """
+        Block until all queued output is written.
+        """
+
+        if self._thread is not None:
+            self._queue.join()
+
+        if hasattr(self.file, "flush"):
+            self.file.flush()
+
+    def close(self):
+        """
+        Flush queued output and stop the background thread.
+        """
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+
+# Weak references make sure writers that are no longer used are not kept alive
+# just to be flushed at exit
+_queued_writers = WeakSet()
+
+
+@atexit.register
+def _flush_queued_writers():
+    for writer in list(_queued_writers):
+        try:
+            writer.flush()
+        except Exception:
+            pass
+
+
+class SlowQueryTracer(_GlobalTracer):
+    """
+    A tracer which logs statements slower than a threshold. Every statement is
+    timed, but the expensive work of interpolating parameters and looking up the
+    endpoint and bind is only done for slow statements, which makes this tracer
+    suitable for production.
+
+    Slow statements are logged as warnings to the ``flask_storm.slow_query``
+    logger by default. The record is available as the ``storm_slow_query``
+    attribute of the log record. When ``file`` is given records are written to
+    it as JSON lines instead.
+
+    ::
+
+        SlowQueryTracer(threshold=250).start()
+
+    When ``explain`` is ``True`` the plan of slow statements is captured using
+    ``EXPLAIN`` on PostgreSQL and ``EXPLAIN QUERY PLAN`` on SQLite, and added
+    to the record as ``plan``. The plan is captured at most once per
+    ``explain_interval`` seconds for every statement fingerprint, by a
+    background thread with its own connection to the database. Records that
+    get a plan are written once it is captured. Statements executed to capture
+    plans are not seen by any tracer.
+
+    :param threshold: Threshold in milliseconds. Defaults to the
+                      ``STORM_SLOW_QUERY_MS`` configuration variable of the
+                      current application, or 100 if it is not set.
+    :param logger: Logger to use instead of ``flask_storm.slow_query``.
+    :param file: File like object (has write method) to write JSON lines to.
+    :param explain: When ``True`` plans of slow statements are captured.
+    :param explain_analyze: When ``True`` ``EXPLAIN ANALYZE`` is used for
+                            ``SELECT`` statements on PostgreSQL. This executes
+                            the statement a second time.
+    :param explain_interval: Minimum number of seconds between plan captures
+                             for the same statement fingerprint.
+    :param explain_cache_size: Number of fingerprints to remember the last
+                               plan capture of.
+    :param explain_queue_size: Maximum number of pending plan captures. Records
+                               are written without a plan when the queue is
+                               full.
+    """
+
+    default_threshold = 100
+
+    def __init__(
+        self,
+        threshold=None,
+        logger=None,
+        file=None,
+        explain=False,
+        explain_analyze=False,
+        explain_interval=300,
+        explain_cache_size=1024,
+        explain_queue_size=100,
+    ):
+        super(SlowQueryTracer, self).__init__()
+        self.threshold = threshold
+        self.file = file
+        self.explain = explain
+        self.explain_analyze = explain_analyze
+        self.explain_interval = explain_interval
+        self.explain_cache_size = explain_cache_size
+
+        self._explained = OrderedDict()
+        self._explained_lock = Lock()
+        self._explain_queue = Queue(explain_queue_size)
+        self._explain_thread = None
+        self._write_lock = Lock()
+
+        self.logger = logger
+        if logger is None:
+            self.logger = getLogger("flask_storm.slow_query")
+
+    def _get_threshold(self):
+        if self.threshold is not None:
+            return self.threshold
+
+        ctx = _app_ctx_stack.top
+        if ctx is None:
+            return self.default_threshold
+        return ctx.app.config.get("STORM_SLOW_QUERY_MS", self.default_threshold)
+
+    def _should_explain(self, key):
+        now = time()
+        with self._explained_lock:
+            last = self._explained.pop(key, None)
+            if last is not None and now - last < self.explain_interval:
+                # Reinsert to mark the fingerprint as most recently used
+                self._explained[key] = last
+                return False
+
+            self._explained[key] = now
+            while len(self._explained) > self.explain_cache_size:
+                self._explained.popitem(last=False)
+        return True
+
+    def _get_explain_prefix(self, connection, statement):
+        if isinstance(connection, SQLiteConnection):
+            return "EXPLAIN QUERY PLAN "
+        elif Adapter(connection).type == "postgres":
+            is_select = statement.lstrip()[:6].upper() == "SELECT"
+            if self.explain_analyze and is_select:
+                return "EXPLAIN ANALYZE "
+            return "EXPLAIN "
+        return None
+
+    def _explain(self, raw_connections, database, sql):
+        # A raw DB-API connection is used since Storm would pass the statement
+        # to all installed tracers
+        raw_connection = raw_connections.get(database)
+        if raw_connection is None:
+            raw_connection = raw_connections[database] = database.raw_connect()
+
+        try:
+            cursor = raw_connection.cursor()
+            try:
+                cursor.execute(sql)
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+            raw_connection.rollback()
+        except Exception:
+            # The connection may be broken, so a new one is used next time
+            del raw_connections[database]
+            raw_connection.close()
+            raise
+
+        # SQLite returns the description in the last column and PostgreSQL in
+        # the only column
+        return u"\n".join(ustr(row[-1]) for row in rows)
+
+    def _run_explainer(self):
+        raw_connections = {}
+        try:
+            while True:
+                item = self._explain_queue.get()
+                try:
+                    if item is None:
+                        return
+
+                    database, sql, record = item
+                    try:
+                        record["plan"] = self._explain(raw_connections, database, sql)
+                    except Exception:
+                        logger.debug(
+                            "Failed to capture plan of slow query", exc_info=True
+                        )
+                    self._write_record(record)
+                except Exception:
+                    logger.exception("Failed to write slow query")
+                finally:
+                    self._explain_queue.task_done()
+        finally:
+            for raw_connection in raw_connections.values():
+                raw_connection.close()
+
+    def _submit_explain(self, connection, statement, record):
+        prefix = self._get_explain_prefix(connection, statement)
+        if prefix is None:
+            return False
+
+        with self._explained_lock:
+            if self._explain_thread is None:
+                thread = Thread(target=self._run_explainer, name="flask-storm-explain")
+                thread.daemon = True
+                thread.start()
+                self._explain_thread = thread
+
+        item = (connection._database, prefix + record["statement"], record)
+        try:
+            self._explain_queue.put_nowait(item)
+        except Full:
+            return False
+        return True
+
+    def flush(self):
+        """
+        Block until all pending plan captures are done and their records are
+        written.
+        """
+
+        if self._explain_thread is not None:
+            self._explain_queue.join()
+
+    def _build_record(self, connection, statement, params, duration_ms, success):
+        try:
+            sql = replace_placeholders(statement, params, Adapter(connection), True)
+        except Exception:
+            sql = statement
+
+        endpoint = None
+        if has_request_context():
+            endpoint = request.endpoint
+
+        record = {
+            "timestamp": datetime.now().isoformat(),
+            "duration_ms": duration_ms,
+            "success": success,
+            "statement": sql,
+            "fingerprint": fingerprint(statement).hash,
+            "endpoint": endpoint,
+            "bind": get_connection_bind_name(connection),
+        }
+
+        return record
+
+    def _write_record(self, record):
+        if self.file is not None:
+            line = ustr(json.dumps(record, default=str)) + u"\n"
+            with self._write_lock:
+                self.file.write(line)
+            return
+
+        msg = "Slow query (%.1f ms) on bind %r in endpoint %r: %s"
+        args = [
+            record["duration_ms"],
+            record["bind"],
+            record["endpoint"],
+            record["statement"],
+        ]
+        if record.get("plan"):
+            msg += "\n%s"
+            args.append(record["plan"])
+
+        self.logger.warning(msg, *args, extra={"storm_slow_query": record})
+
+    def _finish(self, connection, statement, params, success):
+        start_ns = getattr(self.threadinfo, "start_ns", None)
+        if start_ns is None:
+            return
+        self.threadinfo.start_ns = None
+
+        duration_ms = (perf_counter_ns() - start_ns) / 1000000.0
+        if duration_ms < self._get_threshold():
+            return
+
+        record = self._build_record(connection, statement, params, duration_ms, success)
+        explain = (
+            self.explain and success and self._should_explain(record["fingerprint"])
+        )
+        if not explain or not self._submit_explain(connection, statement, record):
+            self._write_record(record)
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        self.threadinfo.start_ns = perf_counter_ns()
+
+    def connection_raw_execute_success(self, connection, raw_cursor, statement, params):
+        self._finish(connection, statement, params, True)
+
+    def connection_raw_execute_error(
+        self, connection, raw_cursor, statement, params, error
+    ):
+        self._finish(connection, statement, params, False)
+
+    def stop(self):
+        """
+        Stop using this tracer. Pending plan captures are finished and their
+        connections closed before returning.
+        """
+
+        super(SlowQueryTracer, self).stop()
+
+        with self._explained_lock:
+            thread, self._explain_thread = self._explain_thread, None
+
+        if thread is not None:
+            self._explain_queue.put(None)
+            thread.join()
+
+
 class ShellTracer(object):
     """
     :param file: File like object (has write method) where queries will be
                  logged to.
     :param fancy: When ``True`` (default) colored output is used, if support is
                   detected, when ``False`` plain text is used.
+    :param queued: When ``True`` statements are formatted and written on a
+                   background thread using a :class:`QueuedWriter`, which keeps
+                   slow output from delaying queries.
+    :param queue_size: Maximum number of pending writes when ``queued`` is
+                       ``True``.
+    :param queue_policy: ``drop`` (default) to discard output when the queue is
+                         full, or ``block`` to wait for it.
     """
 
-    def __init__(self, file=None, fancy=None):
+    def __init__(
+        self, file=None, fancy=None, queued=False, queue_size=1000, queue_policy="drop"
+    ):
         if file is None:
             self.file = sys.stdout
         else:
@@ -129,6 +1253,12 @@ class ShellTracer(object):
         if fancy is None:
             self.fancy = True
 
+        self.writer = None
+        if queued:
+            self.writer = QueuedWriter(
+                self.file, maxsize=queue_size, policy=queue_policy
+            )
+
         # Use thread locals since the tracer gets installed globally. This
         # ensures start time will be correctly measured, even in multi-threaded
         # environments. Werkzeug's implementation is used instead of threading
@@ -140,35 +1270,46 @@ class ShellTracer(object):
     def use_color(self):
         return self.fancy and has_color_support(self.file)
 
-    def _log(self, msg):
-        if not self.threadinfo.active:
-            return
-
-        self.file.write(u"{};\n".format(color_sql(msg) if self.use_color else msg))
+    def _emit(self, func, *args):
+        # Formatting is deferred to the writer when output is queued
+        if self.writer is None:
+            self.file.write(func(*args))
+        else:
+            self.writer.submit(func, *args)
 
-    def _log_result(self, success):
-        if not self.threadinfo.active:
-            return
+    def _format_statement(self, statement, params, adapter, use_color):
+        return u"{};\n".format(
+            render_sql(statement, params, adapter, colorize=use_color)
+        )
 
-        time = self.threadinfo.end_time - self.threadinfo.start_time
+    def _format_result(self, success, time, use_color):
         msg = u"-- {result} in {time} ms".format(
             result="SUCCESS" if success else "FAILURE", time=time.total_seconds() * 1000
         )
+        return u"{}\n".format(colored(msg, 244) if use_color else msg)
 
-        self.file.write(u"{}\n".format(colored(msg, 244) if self.use_color else msg))
+    def _log(self, statement, params, adapter):
+        self._emit(self._format_statement, statement, params, adapter, self.use_color)
+
+    def _log_result(self, success):
+        if not getattr(self.threadinfo, "active", False):
+            return
+
+        time = self.threadinfo.end_time - self.threadinfo.start_time
+        self._emit(self._format_result, success, time, self.use_color)
 
     def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        if getattr(self.threadinfo, "active", False):
+            # Parameters are adapted here since formatting may happen later on
+            # the writer thread, when the connection may be in use by another
+            # thread or closed
+            params = adapt_params(params, Adapter(connection))
+            self._log(statement, params, literal_adapter)
+
         # Start timer after log printing since it may delay query execution and
         # skew the time
         self.threadinfo.start_time = datetime.now()
 
-        if sqlparse is None:
-            self._log(u"{}\n{!r}".format(statement, params))
-        else:
-            self._log(
-                format_sql(replace_placeholders(statement, params, Adapter(connection)))
-            )
-
     def connection_raw_execute_success(self, connection, raw_cursor, statement, params):
         self.threadinfo.end_time = datetime.now()
         self._log_result(True)
@@ -193,12 +1334,18 @@ class ShellTracer(object):
 
     def stop(self):
         """
-        Stop using this tracer.
+        Stop using this tracer. Queued output is flushed and the writer thread
+        is stopped before returning. It is started again if the tracer is
+        restarted.
         """
 
         remove_tracer(self)
         self.threadinfo.active = False
 
+        if self.writer is not None:
+            self.writer.flush()
+            self.writer.close()
+
     def __enter__(self):
         self.start()
 
@@ -206,6 +1353,14 @@ class ShellTracer(object):
         self.stop()
 
 
+class _RequestTraceBuffer(object):
+    __slots__ = ("header", "entries")
+
+    def __init__(self, header):
+        self.header = header
+        self.entries = []
+
+
 class RequestTracer(ShellTracer):
     """
     A tracer which prints all SQL queries generated by Storm directly to STDOUT.
@@ -217,12 +1372,25 @@ class RequestTracer(ShellTracer):
             # Queries executed here will be printed into STDOUT
             ...
 
+    In buffered mode all statements of an application context are collected and
+    written as one block, with a single request line and a summary, when the
+    tracer stops or the application context tears down. This keeps the output
+    of concurrent requests from interleaving.
+
     :param file: File like object (has write method) where queries will be
                  logged to.
     :param fancy: When ``True`` (default) colored output is used, if support is
                   detected, when ``False`` plain text is used.
+    :param queued: When ``True`` statements are formatted and written on a
+                   background thread. See :class:`ShellTracer`.
+    :param buffered: When ``True`` output is written as one block per
+                     application context.
     """
 
+    def __init__(self, file=None, fancy=None, buffered=False, **kwargs):
+        super(RequestTracer, self).__init__(file, fancy, **kwargs)
+        self.buffered = buffered
+
     def _get_request_line(self, request):
         template = (
             "{ip} - - [{timestamp:%d/%b/%Y %H:%M:%S}] "
@@ -241,7 +1409,89 @@ class RequestTracer(ShellTracer):
             version=request.environ.get("SERVER_PROTOCOL"),
         )
 
-    def _log(self, msg):
+    def _get_buffer(self):
+        ctx = _app_ctx_stack.top
+        if ctx is None:
+            return None
+
+        buffer = getattr(ctx, "storm_request_trace", None)
+        if buffer is None:
+            header = u""
+            if has_request_context():
+                header = self._get_request_line(request)
+            buffer = ctx.storm_request_trace = _RequestTraceBuffer(header)
+        return buffer
+
+    def _log(self, statement, params, adapter):
+        buffer = self._get_buffer() if self.buffered else None
+        if buffer is not None:
+            # The result is filled in by _log_result
+            entry = [statement, params, adapter, None, None]
+            buffer.entries.append(entry)
+            self.threadinfo.entry = entry
+            return
+
+        # The request line must be built here, since the request is not
+        # available on the writer thread
         if has_request_context():
-            self.file.write(self._get_request_line(request))
-        super(RequestTracer, self)._log(msg)
+            self._emit(ustr, self._get_request_line(request))
+        super(RequestTracer, self)._log(statement, params, adapter)
+
+    def _log_result(self, success):
+        entry = getattr(self.threadinfo, "entry", None)
+        if entry is None:
+            super(RequestTracer, self)._log_result(success)
+            return
+
+        self.threadinfo.entry = None
+        entry[3] = success
+        entry[4] = self.threadinfo.end_time - self.threadinfo.start_time
+
+    def _format_block(self, buffer, use_color):
+        lines = [buffer.header]
+        total = timedelta(0)
+        for statement, params, adapter, success, duration in buffer.entries:
+            lines.append(self._format_statement(statement, params, adapter, use_color))
+            if duration is not None:
+                lines.append(self._format_result(success, duration, use_color))
+                total += duration
+
+        msg = u"-- {count} queries in {time} ms".format(
+            count=len(buffer.entries), time=total.total_seconds() * 1000
+        )
+        lines.append(u"{}\n".format(colored(msg, 244) if use_color else msg))
+        return u"".join(lines)
+
+    def flush(self):
+        """
+        Write buffered statements of the current application context. This is
+        called automatically when the tracer stops and when the application
+        context tears down.
+        """
+
+        ctx = _app_ctx_stack.top
+        buffer = getattr(ctx, "storm_request_trace", None)
+        if buffer is None:
+            return
+
+        ctx.storm_request_trace = None
+        if buffer.entries:
+            self._emit(self._format_block, buffer, self.use_color)
+
+    def _on_teardown(self, sender, **kwargs):
+        if getattr(self.threadinfo, "active", False):
+            self.flush()
+
+    def start(self):
+        # Signals require blinker before Flask 2.3. Without them buffered output
+        # is only written when the tracer stops
+        if self.buffered and getattr(signals, "signals_available", True):
+            appcontext_tearing_down.connect(self._on_teardown)
+        super(RequestTracer, self).start()
+
+    def stop(self):
+        if self.buffered:
+            if getattr(signals, "signals_available", True):
+                appcontext_tearing_down.disconnect(self._on_teardown)
+            self.flush()
+        super(RequestTracer, self).stop()
@@ -1,10 +1,24 @@
 from flask import current_app, _app_ctx_stack
+from functools import partial
+from logging import getLogger
+from storm.databases.sqlite import SQLite
 from storm.locals import create_database, Store
+from weakref import WeakKeyDictionary
 
+from .cache import CachingStore, enable_result_cache, ObjectCache
 from .debug import ShellTracer
+from .pool import StorePool
+from .replica import LatencyTracer, Replica, ReplicaSet
 from .utils import find_flask_storm, create_context_local
 
 
+logger = getLogger(__name__)
+
+# Connections to these databases can only be used by the thread that created
+# them, which means their stores can not be pooled
+_thread_bound_databases = (SQLite,)
+
+
 class FlaskStorm(object):
     """
     Create a FlaskStorm instance.
@@ -16,6 +30,17 @@ class FlaskStorm(object):
     _app = None
 
     def __init__(self, app=None):
+        # Database objects are cached per application and bind, since creating
+        # them involves parsing the URI. Weak references ensure the cache does
+        # not keep applications alive
+        self._databases = WeakKeyDictionary()
+        self._pools = WeakKeyDictionary()
+        self._replica_sets = WeakKeyDictionary()
+        self._object_caches = WeakKeyDictionary()
+
+        # Installed the first time a replica set uses the latency strategy
+        self._latency_tracer = None
+
         if app is not None:
             self.init_app(app)
 
@@ -26,7 +51,9 @@ class FlaskStorm(object):
     def app(self):
         if self._app is not None:
             return self._app
-        return current_app
+        # The actual object is returned since applications are used as keys of
+        # weak dictionaries
+        return current_app._get_current_object()
 
     @property
     def is_bound(self):
@@ -86,19 +113,32 @@ class FlaskStorm(object):
                     "_store_tracer": tracer,
                 }
 
+        # Register the flask storm command group. The CLI is available from
+        # version 0.11 of Flask and later
+        if hasattr(app, "cli"):
+            from .cli import storm_cli
+
+            app.cli.add_command(storm_cli)
+
         # Register teardown to make sure Store is closed at the end of each
         # request
         @app.teardown_appcontext
         def close_store(response_or_exception):
             ctx = _app_ctx_stack.top
-            for store in getattr(ctx, "storm_store", {}).values():
-                store.close()
+            pools = getattr(ctx, "storm_store_pools", {})
+            for bind, store in getattr(ctx, "storm_store", {}).items():
+                if bind in pools:
+                    pools[bind].checkin(store)
+                else:
+                    store.close()
 
     def get_binds(self):
         """
         Return dict of database URIs for the application as defined by the
         ``STORM_BINDS`` configuration variable. If ``STORM_DATABASE_URI`` is
-        defined it will be available using the key ``None``.
+        defined it will be available using the key ``None``. Binds with
+        replicas are returned as dicts with the keys ``primary`` and
+        ``replicas``.
 
         :return: Dict from bind names to database URIs.
         """
@@ -116,6 +156,171 @@ class FlaskStorm(object):
 
         return binds
 
+    def _get_bind_config(self, bind):
+        config = self.app.config
+        # None is reserved for the default store as defined by
+        # STORM_DATABASE_URI
+        if None in config.get("STORM_BINDS", {}):
+            raise RuntimeError(
+                "There is a None key in STORM_BINDS. This is reserved for "
+                "the default store as defined by STORM_DATABASE_URI"
+            )
+
+        if bind is None:
+            value = config.get("STORM_DATABASE_URI")
+        else:
+            value = config.get("STORM_BINDS", {}).get(bind)
+
+        if value is None:
+            raise RuntimeError(
+                "No connection URI found in configuration. Is "
+                "STORM_DATABASE_URI defined?"
+            )
+
+        # Binds with replicas are declared as a dict with a primary URI and a
+        # list of replica URIs
+        if isinstance(value, dict):
+            return value["primary"], list(value.get("replicas", ()))
+        return value, []
+
+    def _get_app_cache(self, cache):
+        app = self.app
+        app_cache = cache.get(app)
+        if app_cache is None:
+            app_cache = cache.setdefault(app, {})
+        return app_cache
+
+    def _get_database(self, key, uri):
+        databases = self._get_app_cache(self._databases)
+        cached = databases.get(key)
+        if cached is None or cached[0] != uri:
+            cached = databases[key] = (uri, create_database(uri))
+        return cached[1]
+
+    def get_database(self, bind=None):
+        """
+        Return the Storm Database for the given bind. Databases are created
+        once per application and bind, and are recreated only if the URI of the
+        bind changes. For binds with replicas this is the primary database.
+
+        :param bind: Bind name of database URI. Defaults to the one specified by
+                     ``STORM_DATABASE_URI``.
+        :return: Database instance
+        :raises RuntimeError: if no connection URI is found.
+        """
+
+        uri, _ = self._get_bind_config(bind)
+        return self._get_database(bind, uri)
+
+    def get_bind_name(self, database):
+        """
+        Return the name of the bind the given database was created for by
+        :meth:`get_database`. Databases of replicas resolve to the name of the
+        bind they are a replica of.
+
+        :param database: Storm Database instance.
+        :return: Bind name, ``None`` for the default bind.
+        :raises LookupError: if the database was not created by this instance
+                             for the current application.
+        """
+
+        for key, (uri, cached) in list(self._get_app_cache(self._databases).items()):
+            if cached is database:
+                return key[0] if isinstance(key, tuple) else key
+        raise LookupError("Database is not managed by this FlaskStorm instance")
+
+    def _get_pool(self, key, database):
+        config = self.app.config
+        size = config.get("STORM_POOL_SIZE")
+        if not size or isinstance(database, _thread_bound_databases):
+            return None
+
+        options = {
+            "size": size,
+            "max_overflow": config.get("STORM_POOL_MAX_OVERFLOW", 10),
+            "recycle": config.get("STORM_POOL_RECYCLE"),
+            "timeout": config.get("STORM_POOL_TIMEOUT", 30),
+            "pre_ping": config.get("STORM_POOL_PRE_PING", False),
+        }
+
+        pools = self._get_app_cache(self._pools)
+        pool = pools.get(key)
+        if (
+            pool is None
+            or pool.database is not database
+            or any(getattr(pool, name) != value for name, value in options.items())
+        ):
+            if pool is not None:
+                pool.close()
+
+            pool = pools[key] = StorePool(
+                database, store_factory=partial(self._create_store, key=key), **options
+            )
+        return pool
+
+    def get_pool(self, bind=None):
+        """
+        Return the :class:`~flask_storm.pool.StorePool` for the given bind, or
+        ``None`` if pooling is disabled. Pooling is enabled by setting
+        ``STORM_POOL_SIZE``. The pool is replaced if the URI of the bind or the
+        pool configuration changes.
+
+        SQLite binds are never pooled, since SQLite connections can only be
+        used by the thread that created them.
+
+        :param bind: Bind name of database URI. Defaults to the one specified by
+                     ``STORM_DATABASE_URI``.
+        :return: StorePool instance or ``None``.
+        :raises RuntimeError: if no connection URI is found.
+        """
+
+        return self._get_pool(bind, self.get_database(bind))
+
+    def get_replica_set(self, bind=None):
+        """
+        Return the :class:`~flask_storm.replica.ReplicaSet` for the given bind,
+        or ``None`` if the bind has no replicas. The replica set is replaced if
+        the replica configuration changes.
+
+        :param bind: Bind name of database URI. Defaults to the one specified by
+                     ``STORM_DATABASE_URI``.
+        :return: ReplicaSet instance or ``None``.
+        :raises RuntimeError: if no connection URI is found.
+        :raises ValueError: if ``STORM_REPLICA_STRATEGY`` is unknown.
+        """
+
+        _, uris = self._get_bind_config(bind)
+        if not uris:
+            return None
+
+        config = self.app.config
+        strategy = config.get("STORM_REPLICA_STRATEGY", "round-robin")
+        backoff = config.get("STORM_REPLICA_BACKOFF", 30)
+
+        replica_sets = self._get_app_cache(self._replica_sets)
+        replica_set = replica_sets.get(bind)
+        if (
+            replica_set is None
+            or replica_set.uris != uris
+            or replica_set.strategy != strategy
+            or replica_set.backoff != backoff
+        ):
+            replicas = [
+                Replica(uri, self._get_database((bind, uri), uri)) for uri in uris
+            ]
+            replica_set = replica_sets[bind] = ReplicaSet(
+                replicas, strategy=strategy, backoff=backoff
+            )
+            if strategy == "latency":
+                self._get_latency_tracer().track(replica_set)
+        return replica_set
+
+    def _get_latency_tracer(self):
+        if self._latency_tracer is None:
+            self._latency_tracer = LatencyTracer()
+            self._latency_tracer.start()
+        return self._latency_tracer
+
     def connect(self, bind=None):
         """
         Return a new Store instance with a connection to the database specified
@@ -129,23 +334,117 @@ class FlaskStorm(object):
         :raises RuntimeError: if no connection URI is found.
         """
 
-        binds = self.get_binds()
-        if bind not in binds:
-            raise RuntimeError(
-                "No connection URI found in configuration. Is "
-                "STORM_DATABASE_URI defined?"
-            )
+        return Store(self.get_database(bind))
 
-        return Store(create_database(binds[bind]))
+    def register_metrics(self, tracer, url="/metrics", app=None):
+        """
+        Expose the metrics of the given tracer on the given URL of the
+        application.
+
+        .. note::
+           This registers a blueprint, which must be done while setting up the
+           application. Flask does not allow registering blueprints once the
+           application has handled its first request.
 
-    def get_store(self, bind=None):
+        ::
+
+            app = Flask(__name__)
+            flask_storm.init_app(app)
+
+            metrics = MetricsTracer()
+            metrics.start()
+            flask_storm.register_metrics(metrics, app=app)
+
+        :param tracer: :class:`~flask_storm.MetricsTracer` instance.
+        :param url: URL to expose metrics on.
+        :param app: Application to register the URL for. Defaults to the
+                    application this instance is bound to, or the current
+                    application.
+        """
+
+        if app is None:
+            app = self.app
+        app.register_blueprint(tracer.create_blueprint(url))
+
+    def get_object_cache(self):
+        """
+        Return the :class:`~flask_storm.cache.ObjectCache` of the current
+        application, or ``None`` if it is disabled. The cache is enabled by
+        setting ``STORM_OBJECT_CACHE_SIZE``, and is shared by all binds. The
+        objects of every bind are kept apart.
+
+        :return: ObjectCache instance or ``None``.
+        """
+
+        config = self.app.config
+        size = config.get("STORM_OBJECT_CACHE_SIZE")
+        if not size:
+            return None
+
+        app = self.app
+        ttl = config.get("STORM_OBJECT_CACHE_TTL", 300)
+        object_cache = self._object_caches.get(app)
+        if object_cache is None or (object_cache.size, object_cache.ttl) != (size, ttl):
+            object_cache = self._object_caches[app] = ObjectCache(size, ttl)
+        return object_cache
+
+    def _create_store(self, database, key=None):
+        object_cache = self.get_object_cache()
+        if object_cache is None:
+            return Store(database)
+
+        # Objects are cached per bind and primary database. Stores connected to
+        # replicas use the objects loaded from the primary, but never add to
+        # them since replicas may lag behind
+        readonly = isinstance(key, tuple)
+        bind = key[0] if readonly else key
+        namespace = (bind, self._get_bind_config(bind)[0])
+        return CachingStore(
+            database, object_cache, namespace=namespace, readonly=readonly
+        )
+
+    def _acquire(self, key, database):
+        pool = self._get_pool(key, database)
+        if pool is None:
+            return self._create_store(database, key), None
+        return pool.checkout(), pool
+
+    def _acquire_replica(self, bind, replica_set):
+        for replica in replica_set.candidates():
+            try:
+                result = self._acquire((bind, replica.uri), replica.database)
+            except Exception:
+                # The URI is not logged since it may contain a password
+                logger.warning(
+                    "Replica %d of bind %r failed, ejecting it",
+                    replica_set.replicas.index(replica),
+                    bind,
+                    exc_info=True,
+                )
+                replica_set.mark_failure(replica)
+                continue
+
+            replica_set.mark_success(replica)
+            return result
+
+        # All replicas are ejected, so fall back to the primary
+        return self._acquire(bind, self.get_database(bind))
+
+    def get_store(self, bind=None, readonly=False):
         """
         Return a Store instance for the current application context. If there is
         no instance a new one will be created. Instances created using this
-        method will close on application context tear down.
+        method will close on application context tear down. When pooling is
+        enabled the store is checked out of the bind's pool instead, and is
+        rolled back and returned to the pool on tear down. When
+        ``STORM_RESULT_CACHE`` is enabled the rows of ``SELECT`` statements are
+        memoized by the store, see :class:`flask_storm.cache.CachingConnection`.
 
         :param bind: Bind name of database URI. Defaults to the one specified by
                      ``STORM_DATABASE_URI``.
+        :param readonly: When ``True`` a store connected to one of the bind's
+                         replicas is returned. If the bind has no replicas, or
+                         all of them have failed, the primary store is used.
         :return: Store for the current application context.
         :raises RuntimeError: if accessed outside the scope of an application
                               context.
@@ -157,8 +456,36 @@ class FlaskStorm(object):
             if not hasattr(ctx, "storm_store"):
                 ctx.storm_store = {}
 
-            if bind not in ctx.storm_store:
-                ctx.storm_store[bind] = self.connect(bind)
-            return ctx.storm_store[bind]
+            key = bind
+            if readonly:
+                key = (bind, True)
+                if key not in ctx.storm_store:
+                    replica_set = self.get_replica_set(bind)
+                    if replica_set is None:
+                        return self.get_store(bind)
+
+                    self._register_store(
+                        ctx, key, *self._acquire_replica(bind, replica_set)
+                    )
+            elif key not in ctx.storm_store:
+                self._register_store(
+                    ctx, key, *self._acquire(bind, self.get_database(bind))
+                )
+            return ctx.storm_store[key]
+
+    def _register_store(self, ctx, key, store, pool):
+        config = ctx.app.config
+        if config.get("STORM_RESULT_CACHE", False):
+            enable_result_cache(
+                store,
+                config.get("STORM_RESULT_CACHE_SIZE", 256),
+                config.get("STORM_RESULT_CACHE_MAX_ROWS", 10000),
+            )
+
+        ctx.storm_store[key] = store
+        if pool is not None:
+            if not hasattr(ctx, "storm_store_pools"):
+                ctx.storm_store_pools = {}
+            ctx.storm_store_pools[key] = pool
 
     store = property(get_store)
@@ -0,0 +1,292 @@
+from bisect import bisect_left
+from flask import Blueprint, has_request_context, request, Response
+from threading import Lock
+from weakref import ref
+
+from ._compat import perf_counter_ns, ustr
+from .debug import _GlobalTracer
+from .sql import fingerprint
+from .utils import get_connection_bind_name
+
+__all__ = [
+    "MetricsTracer",
+]
+
+
+#: Default histogram buckets in seconds
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricSeries(object):
+    """
+    Counters and latency histogram for one combination of bind, statement
+    fingerprint and endpoint.
+
+    :param size: Number of histogram buckets, including the ``+Inf`` bucket.
+    """
+
+    __slots__ = ("buckets", "count", "errors", "total_ns")
+
+    def __init__(self, size):
+        #: Number of executions per bucket. These are not cumulative
+        self.buckets = [0] * size
+
+        #: Number of executions
+        self.count = 0
+
+        #: Number of executions that raised an error
+        self.errors = 0
+
+        #: Total execution time in nanoseconds
+        self.total_ns = 0
+
+    def merge(self, other):
+        for i, value in enumerate(other.buckets):
+            self.buckets[i] += value
+        self.count += other.count
+        self.errors += other.errors
+        self.total_ns += other.total_ns
+
+
+class _Accumulator(object):
+    # Metrics of one thread. The lock is only contended while metrics are
+    # collected, which keeps the cost of recording a statement low
+    __slots__ = ("lock", "series")
+
+    def __init__(self):
+        self.lock = Lock()
+        self.series = {}
+
+
+class _AccumulatorHandle(object):
+    # Owned by the thread local. When a thread goes away so does its handle,
+    # which lets the tracer drop the accumulator after merging it one last time
+    __slots__ = ("accumulator", "__weakref__")
+
+    def __init__(self, accumulator):
+        self.accumulator = accumulator
+
+
+def _escape_label(value):
+    if value is None:
+        return ""
+    return ustr(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    return u",".join(
+        u'{}="{}"'.format(name, _escape_label(value)) for name, value in labels
+    )
+
+
+class MetricsTracer(_GlobalTracer):
+    """
+    Storm tracer that counts statements and measures their latency per bind,
+    statement fingerprint and Flask endpoint. Metrics are exposed in the
+    Prometheus text exposition format using :meth:`render`,
+    :meth:`wsgi_app` or :meth:`create_blueprint`.
+
+    Statements are recorded into per-thread accumulators, which are merged
+    when metrics are collected.
+
+    ::
+
+        tracer = MetricsTracer()
+        tracer.start()
+
+        flask_storm.register_metrics(tracer, "/metrics")
+
+    :param buckets: Upper bounds of the latency histogram buckets in seconds.
+    :param namespace: Prefix of the metric names.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, namespace="storm"):
+        super(MetricsTracer, self).__init__()
+        self.buckets = tuple(sorted(buckets))
+        self.namespace = namespace
+
+        self._bounds_ns = [int(bound * 1e9) for bound in self.buckets]
+        self._totals = {}
+        self._accumulators = {}
+        self._lock = Lock()
+
+    def _get_accumulator(self):
+        try:
+            return self.threadinfo.handle.accumulator
+        except AttributeError:
+            pass
+
+        accumulator = _Accumulator()
+        handle = self.threadinfo.handle = _AccumulatorHandle(accumulator)
+        with self._lock:
+            self._accumulators[ref(handle)] = accumulator
+        return accumulator
+
+    def _record(self, connection, statement, success):
+        start_ns = getattr(self.threadinfo, "start_ns", None)
+        if start_ns is None:
+            return
+        self.threadinfo.start_ns = None
+
+        duration_ns = perf_counter_ns() - start_ns
+        endpoint = request.endpoint if has_request_context() else None
+        key = (
+            get_connection_bind_name(connection),
+            fingerprint(statement).hash,
+            endpoint,
+        )
+
+        accumulator = self._get_accumulator()
+        with accumulator.lock:
+            series = accumulator.series.get(key)
+            if series is None:
+                series = accumulator.series[key] = MetricSeries(len(self.buckets) + 1)
+
+            series.buckets[bisect_left(self._bounds_ns, duration_ns)] += 1
+            series.count += 1
+            series.total_ns += duration_ns
+            if not success:
+                series.errors += 1
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        self.threadinfo.start_ns = perf_counter_ns()
+
+    def connection_raw_execute_success(self, connection, raw_cursor, statement, params):
+        self._record(connection, statement, True)
+
+    def connection_raw_execute_error(
+        self, connection, raw_cursor, statement, params, error
+    ):
+        self._record(connection, statement, False)
+
+    def collect(self):
+        """
+        Merge the metrics of all threads.
+
+        :return: Dictionary of :class:`MetricSeries` keyed by
+                 ``(bind, fingerprint, endpoint)``.
+        """
+
+        with self._lock:
+            for handle, accumulator in list(self._accumulators.items()):
+                with accumulator.lock:
+                    series, accumulator.series = accumulator.series, {}
+
+                for key, value in series.items():
+                    total = self._totals.get(key)
+                    if total is None:
+                        total = self._totals[key] = MetricSeries(len(value.buckets))
+                    total.merge(value)
+
+                if handle() is None:
+                    del self._accumulators[handle]
+
+            collected = {}
+            for key, value in self._totals.items():
+                series = collected[key] = MetricSeries(len(value.buckets))
+                series.merge(value)
+            return collected
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+
+        :return: Unicode string
+        """
+
+        rows = []
+        for (bind, hash, endpoint), series in self.collect().items():
+            labels = [("bind", bind), ("fingerprint", hash), ("endpoint", endpoint)]
+            rows.append((labels, series))
+        rows.sort(key=lambda row: _format_labels(row[0]))
+
+        queries = u"{}_queries_total".format(self.namespace)
+        errors = u"{}_query_errors_total".format(self.namespace)
+        duration = u"{}_query_duration_seconds".format(self.namespace)
+        le_values = [repr(float(bound)) for bound in self.buckets] + ["+Inf"]
+
+        lines = [
+            u"# HELP {} Number of executed statements.".format(queries),
+            u"# TYPE {} counter".format(queries),
+        ]
+        for labels, series in rows:
+            lines.append(
+                u"{}{{{}}} {}".format(queries, _format_labels(labels), series.count)
+            )
+
+        lines.append(u"# HELP {} Number of statements that failed.".format(errors))
+        lines.append(u"# TYPE {} counter".format(errors))
+        for labels, series in rows:
+            lines.append(
+                u"{}{{{}}} {}".format(errors, _format_labels(labels), series.errors)
+            )
+
+        lines.append(u"# HELP {} Statement execution time.".format(duration))
+        lines.append(u"# TYPE {} histogram".format(duration))
+        for labels, series in rows:
+            cumulative = 0
+            for le, value in zip(le_values, series.buckets):
+                cumulative += value
+                bucket_labels = _format_labels(labels + [("le", le)])
+                lines.append(
+                    u"{}_bucket{{{}}} {}".format(duration, bucket_labels, cumulative)
+                )
+
+            lines.append(
+                u"{}_sum{{{}}} {!r}".format(
+                    duration, _format_labels(labels), series.total_ns / 1e9
+                )
+            )
+            lines.append(
+                u"{}_count{{{}}} {}".format(
+                    duration, _format_labels(labels), series.count
+                )
+            )
+
+        return u"\n".join(lines) + u"\n"
+
+    def wsgi_app(self, environ, start_response):
+        """
+        WSGI application that responds with all metrics. It can be mounted
+        using for example Werkzeug's ``DispatcherMiddleware``.
+        """
+
+        body = self.render().encode("utf-8")
+        start_response(
+            "200 OK",
+            [("Content-Type", CONTENT_TYPE), ("Content-Length", str(len(body)))],
+        )
+        return [body]
+
+    def create_blueprint(self, url="/metrics", name="storm_metrics"):
+        """
+        Return a blueprint that exposes all metrics on the given URL.
+
+        :param url: URL to expose metrics on.
+        :param name: Name of the blueprint.
+        :return: Blueprint instance
+        """
+
+        blueprint = Blueprint(name, __name__)
+
+        @blueprint.route(url)
+        def metrics():
+            return Response(self.render(), content_type=CONTENT_TYPE)
+
+        return blueprint
@@ -0,0 +1,551 @@
+from binascii import hexlify
+from datetime import date, datetime, time, timedelta
+from io import BytesIO
+from itertools import count
+from storm.databases.postgres import Returning
+from storm.expr import And, COLUMN_NAME, Expr, Insert, Or, State, TABLE
+from storm.info import get_cls_info, get_obj_info
+from storm.locals import Reference, ReferenceSet, Store
+from storm.store import compare_columns
+from storm.tracer import trace
+
+from ._compat import bstr, ustr
+from .cache import _WriteTrackingConnection, CachingConnection
+from .sql import Adapter, ConnectionWrapper
+
+try:
+    from storm.database import convert_param_marks, CursorWrapper
+except ImportError:  # storm < 0.21
+    from storm.database import convert_param_marks
+
+    CursorWrapper = None
+
+
+__all__ = [
+    "bulk_insert",
+    "prefetch",
+    "prefetched",
+    "stream",
+]
+
+
+#: Number of keys to put in every ``IN (...)`` list
+PREFETCH_CHUNK_SIZE = 500
+
+#: Number of rows to insert per statement in :func:`bulk_insert`
+BULK_INSERT_BATCH_SIZE = 1000
+
+#: Number of rows to fetch at a time in :func:`stream`
+STREAM_BATCH_SIZE = 1000
+
+_prefetched_key = "flask_storm.prefetched"
+
+
+def _get_values(variables):
+    return tuple(variable.get() for variable in variables)
+
+
+def _where_in(columns, keys):
+    if len(columns) == 1:
+        return columns[0].is_in([key[0] for key in keys])
+    return Or(*[compare_columns(columns, key) for key in keys])
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _group_by_key(objects, relation):
+    # Map local key values to the objects that have them
+    groups = {}
+    for obj in objects:
+        if relation.local_variables_are_none(obj):
+            continue
+        key = _get_values(relation.get_local_variables(obj))
+        groups.setdefault(key, []).append(obj)
+    return groups
+
+
+def _prefetch_reference(store, objects, reference, chunk_size):
+    relation = reference._relation
+
+    # Objects that already have their remote linked do not need it loaded
+    objects = [obj for obj in objects if relation.get_remote(obj) is None]
+    groups = _group_by_key(objects, relation)
+    keys = list(groups)
+
+    for chunk in _chunks(keys, chunk_size):
+        where = _where_in(relation.remote_key, chunk)
+        for remote in store.find(relation.remote_cls, where):
+            key = _get_values(relation.get_remote_variables(remote))
+            for obj in groups.get(key, ()):
+                relation.link(obj, remote)
+
+
+def _prefetch_reference_set(store, objects, reference_set, chunk_size):
+    relation1 = reference_set._relation1
+    relation2 = reference_set._relation2
+    order_by = reference_set._order_by
+
+    groups = _group_by_key(objects, relation1)
+    related = dict((id(obj), []) for obj in objects)
+
+    for chunk in _chunks(list(groups), chunk_size):
+        where = _where_in(relation1.remote_key, chunk)
+        if relation2 is None:
+            result = store.find(relation1.remote_cls, where)
+        else:
+            # Many-to-many relations are loaded together with the link objects
+            # which know which object the remote belongs to
+            result = store.find(
+                (relation1.remote_cls, relation2.local_cls),
+                And(where, relation2.get_where_for_join()),
+            )
+        if order_by is not None:
+            result = result.order_by(*order_by)
+
+        for row in result:
+            link, remote = (row, row) if relation2 is None else row
+            key = _get_values(relation1.get_remote_variables(link))
+            for obj in groups.get(key, ()):
+                related[id(obj)].append(remote)
+
+    for obj in objects:
+        get_obj_info(obj)[(_prefetched_key, reference_set)] = related[id(obj)]
+
+
+def prefetch(objects, *references, **kwargs):
+    """
+    Load the objects referenced by the given objects using one query per
+    reference, instead of one query per object and reference. Prefetched
+    ``Reference`` objects are used when accessing the attribute, but
+    prefetched ``ReferenceSet`` objects are only available through
+    :func:`prefetched`, since accessing the attribute always queries the
+    database. Large sets are loaded in chunks of ``chunk_size`` keys.
+
+    ::
+
+        posts = prefetch(store.find(Post), Post.author, Post.tags)
+        for post in posts:
+            print(post.author.name, [tag.name for tag in prefetched(post, Post.tags)])
+
+    Objects loaded for a ``Reference`` are linked to the referencing objects,
+    which means accessing the reference does not query the database. Storm
+    queries the database every time a ``ReferenceSet`` is used, so objects
+    loaded for a ``ReferenceSet`` are available through :func:`prefetched`
+    instead.
+
+    :param objects: Result set or iterable of objects of the same class.
+    :param references: ``Reference`` and ``ReferenceSet`` properties of the
+                       class of the objects.
+    :param chunk_size: Maximum number of keys in one query. Defaults to
+                       :data:`PREFETCH_CHUNK_SIZE`.
+    :return: List of the given objects.
+    :raises TypeError: if a reference is not a ``Reference`` or
+                       ``ReferenceSet``, or if an unknown keyword argument is
+                       given.
+    """
+
+    chunk_size = kwargs.pop("chunk_size", PREFETCH_CHUNK_SIZE)
+    if kwargs:
+        raise TypeError(
+            "Unexpected keyword arguments {}".format(", ".join(sorted(kwargs)))
+        )
+
+    objects = list(objects)
+    if not objects:
+        return objects
+
+    store = Store.of(objects[0])
+    for reference in references:
+        if isinstance(reference, Reference):
+            _prefetch_reference(store, objects, reference, chunk_size)
+        elif isinstance(reference, ReferenceSet):
+            _prefetch_reference_set(store, objects, reference, chunk_size)
+        else:
+            raise TypeError(
+                "Expected a Reference or ReferenceSet, got {!r}".format(reference)
+            )
+    return objects
+
+
+def prefetched(obj, reference_set):
+    """
+    Return the objects of the given ``ReferenceSet`` that were loaded by
+    :func:`prefetch`. If the reference set was not prefetched for the object
+    its objects are loaded from the database.
+
+    The prefetched objects are a snapshot. Objects added to or removed from the
+    reference set afterwards are not reflected.
+
+    :param obj: Object that owns the reference set.
+    :param reference_set: ``ReferenceSet`` property of the class of ``obj``.
+    :return: List of objects.
+    """
+
+    try:
+        return list(get_obj_info(obj)[(_prefetched_key, reference_set)])
+    except KeyError:
+        return list(reference_set.__get__(obj))
+
+
+# Maximum number of parameters in one statement. SQLite versions before 3.32
+# are limited to 999
+_max_parameters = {"postgres": 65535}
+_default_max_parameters = 999
+
+
+_connection_wrappers = (CachingConnection, _WriteTrackingConnection)
+
+
+def _get_wrappers(store):
+    connection = store._connection
+    while isinstance(connection, _connection_wrappers):
+        yield connection
+        connection = connection._connection
+
+
+def _get_connection(store):
+    connection = store._connection
+    while isinstance(connection, _connection_wrappers):
+        connection = connection._connection
+    return connection
+
+
+def _copy_value(value):
+    # Encode a value using the text format of COPY
+    if value is None:
+        return u"\\N"
+    elif isinstance(value, bool):
+        return u"t" if value else u"f"
+    elif isinstance(value, bstr):
+        # bytea in hex format, with the backslash escaped for COPY
+        return u"\\\\x" + hexlify(value).decode("ascii")
+    elif isinstance(value, (datetime, date, time)):
+        value = value.isoformat()
+    elif isinstance(value, timedelta):
+        value = u"{} days {} seconds {} microseconds".format(
+            value.days, value.seconds, value.microseconds
+        )
+    elif isinstance(value, (list, tuple, dict)):
+        raise TypeError("Can't COPY {!r}".format(value))
+    elif not isinstance(value, ustr):
+        value = ustr(value)
+
+    return (
+        value.replace(u"\\", u"\\\\")
+        .replace(u"\t", u"\\t")
+        .replace(u"\n", u"\\n")
+        .replace(u"\r", u"\\r")
+    )
+
+
+def _copy_rows(store, cls_info, columns, batch):
+    try:
+        lines = [
+            u"\t".join(_copy_value(variable.get(to_db=True)) for variable in row)
+            for row in batch
+        ]
+    except TypeError:
+        return False
+    data = u"".join(line + u"\n" for line in lines)
+
+    if store._implicit_flush_block_count == 0:
+        store.flush()
+
+    connection = _get_connection(store)
+    state = State()
+    state.push("context", COLUMN_NAME)
+    names = connection.compile(tuple(columns), state, token=True)
+    state.context = TABLE
+    table = connection.compile(cls_info.table, state, token=True)
+    state.pop()
+    statement = "COPY {} ({}) FROM STDIN".format(table, names)
+
+    # COPY bypasses the connection wrappers of the result and object caches,
+    # which must not serve stale rows
+    for wrapper in _get_wrappers(store):
+        wrapper.track_write(statement)
+
+    if connection._event:
+        connection._event.emit("register-transaction")
+    connection._ensure_connected()
+    raw_cursor = connection._check_disconnect(connection.build_raw_cursor)
+    try:
+        connection._check_disconnect(
+            trace, "connection_raw_execute", connection, raw_cursor, statement, ()
+        )
+        try:
+            connection._check_disconnect(
+                raw_cursor.copy_expert, statement, BytesIO(data.encode("utf-8"))
+            )
+        except Exception as error:
+            connection._check_disconnect(
+                trace,
+                "connection_raw_execute_error",
+                connection,
+                raw_cursor,
+                statement,
+                (),
+                error,
+            )
+            raise
+        else:
+            connection._check_disconnect(
+                trace,
+                "connection_raw_execute_success",
+                connection,
+                raw_cursor,
+                statement,
+                (),
+            )
+    finally:
+        connection._check_disconnect(raw_cursor.close)
+    return True
+
+
+def _get_key(values):
+    return values[0] if len(values) == 1 else tuple(values)
+
+
+def bulk_insert(store, cls, rows, return_keys=False, batch_size=None):
+    """
+    Insert many rows into the table of the given class using as few
+    statements as possible. This is considerably faster than adding one object
+    at a time using ``store.add()``, which issues one ``INSERT`` per object.
+
+    ::
+
+        bulk_insert(store, Post, [
+            {"name": u"Alice", "text": u"Post #1"},
+            {"name": u"Bob", "text": u"Post #2"},
+        ])
+
+    Rows are inserted using multi-row ``INSERT ... VALUES`` statements. When
+    the store is connected to PostgreSQL and keys are not requested
+    ``COPY ... FROM STDIN`` is used instead. Rows containing values that can
+    not be represented in the text format of ``COPY``, such as arrays, fall
+    back to ``INSERT``.
+
+    Values are converted by the columns of the class, just like when setting
+    attributes. No objects are created, which means the rows are not in the
+    store's cache and hooks like ``__storm_pre_flush__`` are not called.
+
+    :param store: Store to insert using.
+    :param cls: Storm class of the table to insert into.
+    :param rows: Iterable of dicts that map attribute names to values. All rows
+                 must have the same attributes. Omitted columns get their
+                 database defaults.
+    :param return_keys: When ``True`` the primary keys of the inserted rows
+                        are returned. Keys that are generated by the database
+                        require ``RETURNING`` on PostgreSQL, and one statement
+                        per row on other databases.
+    :param batch_size: Maximum number of rows per statement. Defaults to
+                       :data:`BULK_INSERT_BATCH_SIZE`. It is lowered to fit
+                       the number of parameters the database allows.
+    :return: List of primary keys, in the same order as the rows, if
+             ``return_keys`` is ``True``. Otherwise the number of inserted
+             rows. Composite keys are returned as tuples.
+    :raises ValueError: if the rows have different attributes.
+    :raises KeyError: if an attribute is not a column of the class.
+    """
+
+    cls_info = get_cls_info(cls)
+    rows = list(rows)
+    if not rows:
+        return [] if return_keys else 0
+
+    names = sorted(rows[0])
+    columns = tuple(cls_info.attributes[name] for name in names)
+    values = []
+    for row in rows:
+        if sorted(row) != names:
+            raise ValueError(
+                "Expected attributes {}, got {}".format(
+                    ", ".join(names), ", ".join(sorted(row))
+                )
+            )
+        values.append(
+            tuple(
+                column.variable_factory(value=row[name])
+                for name, column in zip(names, columns)
+            )
+        )
+
+    db_type = Adapter(_get_connection(store)).type
+    max_rows = _max_parameters.get(db_type, _default_max_parameters) // max(
+        len(columns), 1
+    )
+    batch_size = min(batch_size or BULK_INSERT_BATCH_SIZE, max(max_rows, 1))
+
+    primary_key = cls_info.primary_key
+    keys = []
+    generated = return_keys
+    # Columns compare as expressions, so they are looked up by identity
+    positions = dict((id(column), i) for i, column in enumerate(columns))
+    if return_keys and all(id(column) in positions for column in primary_key):
+        # The keys are known up front, so there is nothing to return from the
+        # database
+        keys = [
+            _get_key([row[positions[id(column)]].get() for column in primary_key])
+            for row in values
+        ]
+        generated = False
+
+    for batch in _chunks(values, batch_size):
+        insert = Insert(columns, values=batch, default_table=cls_info.table)
+        if not generated:
+            if db_type != "postgres" or not _copy_rows(store, cls_info, columns, batch):
+                store.execute(insert, noresult=True)
+        elif db_type == "postgres":
+            result = store.execute(Returning(insert, columns=primary_key))
+            keys.extend(_get_key(row) for row in result.get_all())
+        else:
+            # Without RETURNING the generated key is only available for the last
+            # inserted row of every statement
+            for row in batch:
+                insert = Insert(columns, values=[row], default_table=cls_info.table)
+                keys.append(store.execute(insert)._raw_cursor.lastrowid)
+
+    return keys if return_keys else len(values)
+
+
+_cursor_names = count()
+
+# Private Storm connection methods used to execute statements on a named
+# cursor, just like Connection.raw_execute does on a regular one
+_named_cursor_requirements = (
+    "_check_disconnect",
+    "_ensure_connected",
+    "_execution_args",
+    "_prepare_execution",
+    "_run_execution",
+)
+
+
+def _supports_named_cursors(connection):
+    if Adapter(connection).type != "postgres" or connection._closed:
+        return False
+
+    if not all(hasattr(connection, name) for name in _named_cursor_requirements):
+        return False
+
+    # Wrapped connections can only exist if Storm provides the cursor wrapper
+    return CursorWrapper is not None or not isinstance(
+        connection._raw_connection, ConnectionWrapper
+    )
+
+
+def _build_named_cursor(connection):
+    # Rows of named cursors are kept on the server until they are fetched
+    name = "flask_storm_stream_{}".format(next(_cursor_names))
+    raw_connection = connection._raw_connection
+    if isinstance(raw_connection, ConnectionWrapper):
+        return CursorWrapper(
+            raw_connection._connection.cursor(name=name), raw_connection._database
+        )
+    return raw_connection.cursor(name=name)
+
+
+def _execute_streaming(store, statement):
+    if store._implicit_flush_block_count == 0:
+        store.flush()
+
+    # The result cache would fetch all rows at once
+    connection = _get_connection(store)
+    if not _supports_named_cursors(connection):
+        # Closed connections raise the appropriate error
+        return connection.execute(statement)
+
+    if getattr(connection, "_event", None):
+        connection._event.emit("register-transaction")
+    connection._ensure_connected()
+
+    state = State()
+    statement = connection.compile(statement, state)
+    params = state.parameters
+    statement = convert_param_marks(statement, "?", connection.param_mark)
+
+    raw_cursor = connection._check_disconnect(_build_named_cursor, connection)
+    connection._prepare_execution(raw_cursor, params, statement)
+    args = connection._execution_args(params, statement)
+    connection._run_execution(raw_cursor, args, params, statement)
+    return connection.result_factory(connection, raw_cursor)
+
+
+def _stream(store, statement, find_spec, batch_size):
+    result = _execute_streaming(store, statement)
+    try:
+        raw_cursor = result._raw_cursor
+
+        # Translate lost connections into DisconnectionError, like Storm does
+        # when fetching results. Older versions of Storm can not do this
+        check_disconnect = getattr(result._connection, "_check_disconnect", None)
+        while True:
+            if check_disconnect is None:
+                rows = raw_cursor.fetchmany(batch_size)
+            else:
+                rows = check_disconnect(raw_cursor.fetchmany, batch_size)
+            if not rows:
+                break
+
+            for row in rows:
+                values = result.from_database(row)
+                if find_spec is None:
+                    yield tuple(values)
+                else:
+                    yield find_spec.load_objects(store, result, values)
+    finally:
+        result.close()
+
+
+def stream(store, query, batch_size=STREAM_BATCH_SIZE, objects=True):
+    """
+    Iterate over the rows of a query while only keeping ``batch_size`` rows in
+    memory at a time. Iterating a regular result set fetches all rows from the
+    database before the first one is returned.
+
+    ::
+
+        for post in stream(store, store.find(Post), batch_size=500):
+            export(post)
+
+    On PostgreSQL the rows are read using a server side cursor, which requires
+    an open transaction for as long as the iteration goes on. On other
+    databases rows are read from the cursor using ``fetchmany()``. The result
+    cache is bypassed.
+
+    Server side cursors require Storm 0.21 or later. With older versions rows
+    are read using ``fetchmany()`` on PostgreSQL as well, which bounds the
+    number of objects created at a time, but not the memory used by psycopg2
+    which receives all rows at once.
+
+    Objects are kept alive by the store's cache of recently used objects, which
+    is bounded. Use ``objects=False`` to not create any objects at all.
+
+    :param store: Store to execute the query using.
+    :param query: Result set returned by ``store.find()``, or a Storm
+                  ``Select`` expression.
+    :param batch_size: Number of rows to fetch from the database at a time.
+    :param objects: When ``False`` rows of a result set are returned as tuples
+                    of column values instead of objects. ``Select`` expressions
+                    always return tuples.
+    :return: Iterator of objects or tuples. The query is executed when the
+             first item is requested.
+    :raises TypeError: if the query is not a result set or an expression.
+    :raises ValueError: if the batch size is not positive.
+    """
+
+    find_spec = getattr(query, "_find_spec", None)
+    if find_spec is not None:
+        statement = query._get_select()
+    elif isinstance(query, Expr):
+        statement = query
+    else:
+        raise TypeError("Expected a result set or expression, got {!r}".format(query))
+
+    if batch_size < 1:
+        raise ValueError("Batch size must be positive, got {!r}".format(batch_size))
+
+    return _stream(store, statement, find_spec if objects else None, batch_size)
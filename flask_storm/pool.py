@@ -0,0 +1,210 @@
+from collections import deque
+from logging import getLogger
+from storm.exceptions import DisconnectionError
+from storm.locals import Store
+from threading import Condition
+from time import time
+
+__all__ = [
+    "StorePool",
+]
+
+
+logger = getLogger(__name__)
+
+
+class StorePool(object):
+    """
+    A pool of Store instances for one database. Stores are checked out for the
+    duration of an application context and are rolled back and returned to the
+    pool afterwards, which saves a new connection handshake for every request.
+
+    The pool is safe to use from multiple threads, as long as the connections
+    of the database can be used by other threads than the one that created
+    them. This is not the case for SQLite. Greenlets are supported as long as
+    the threading module is monkey patched, which gevent and eventlet both do
+    by default.
+
+    :param database: Storm Database to create stores for.
+    :param size: Number of idle stores to keep open.
+    :param max_overflow: Number of stores that may be checked out on top of
+                         ``size``. These are closed when returned.
+    :param recycle: Close stores older than this number of seconds instead of
+                    reusing them. ``None`` disables recycling.
+    :param timeout: Seconds to wait for a store when ``size + max_overflow``
+                    stores are already checked out.
+    :param pre_ping: When ``True`` stores are tested with ``SELECT 1`` before
+                     being checked out, and reconnected if the connection has
+                     been lost while idle.
+    :param store_factory: Callable that creates a store for ``database``.
+    """
+
+    def __init__(
+        self,
+        database,
+        size=5,
+        max_overflow=10,
+        recycle=None,
+        timeout=30,
+        pre_ping=False,
+        store_factory=Store,
+    ):
+        self.database = database
+        self.size = size
+        self.max_overflow = max_overflow
+        self.recycle = recycle
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+        self.store_factory = store_factory
+
+        self._idle = deque()
+        self._created = {}
+        self._checked_out = 0
+        self._closed = False
+        self._condition = Condition()
+
+    @property
+    def checked_out(self):
+        """
+        Number of stores currently checked out from this pool.
+        """
+
+        return self._checked_out
+
+    @property
+    def idle(self):
+        """
+        Number of idle stores currently held by this pool.
+        """
+
+        return len(self._idle)
+
+    def _is_expired(self, store):
+        if self.recycle is None:
+            return False
+        return time() - self._created.get(store, 0) > self.recycle
+
+    def _discard(self, store):
+        # Closing may block, so this must not be called while holding the lock
+        self._created.pop(store, None)
+        try:
+            store.close()
+        except Exception:
+            logger.warning("Failed to close pooled store", exc_info=True)
+
+    def _ping(self, store):
+        try:
+            store.execute("SELECT 1")
+        except DisconnectionError:
+            # Rolling back marks the connection for reconnection, which
+            # happens on the next statement
+            store.rollback()
+            store.execute("SELECT 1")
+
+    def checkout(self):
+        """
+        Return a store from the pool. A new store is created if there are no
+        idle stores and the overflow limit is not yet reached.
+
+        :return: Store instance
+        :raises RuntimeError: if no store became available within ``timeout``
+                              seconds or if the pool is closed.
+        """
+
+        store = None
+        expired = None
+        deadline = None
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Store pool is closed")
+
+                if self._idle:
+                    store = self._idle.pop()
+                    if self._is_expired(store):
+                        expired, store = store, None
+                    self._checked_out += 1
+                    break
+
+                if self._checked_out < self.size + self.max_overflow:
+                    self._checked_out += 1
+                    break
+
+                if self.timeout is None:
+                    self._condition.wait()
+                    continue
+
+                if deadline is None:
+                    deadline = time() + self.timeout
+
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise RuntimeError(
+                        "Store pool limit of {} reached, timed out after {} "
+                        "seconds".format(self.size + self.max_overflow, self.timeout)
+                    )
+                self._condition.wait(remaining)
+
+        if expired is not None:
+            self._discard(expired)
+
+        try:
+            if store is None:
+                store = self.store_factory(self.database)
+                self._created[store] = time()
+            elif self.pre_ping:
+                self._ping(store)
+        except Exception:
+            if store is not None:
+                self._discard(store)
+            with self._condition:
+                self._checked_out -= 1
+                self._condition.notify()
+            raise
+
+        return store
+
+    def checkin(self, store):
+        """
+        Roll back the given store and return it to the pool. Stores that fail
+        to roll back, have expired or do not fit in the pool are closed.
+
+        :param store: Store previously returned by :meth:`checkout`.
+        """
+
+        reusable = not self._closed and not self._is_expired(store)
+        if reusable:
+            try:
+                store.rollback()
+
+                # Forget all objects loaded during this checkout, since the
+                # next user of the store should not see them
+                store.reset()
+            except Exception:
+                logger.warning("Discarding broken pooled store", exc_info=True)
+                reusable = False
+
+        with self._condition:
+            self._checked_out -= 1
+            if reusable and len(self._idle) < self.size:
+                self._idle.append(store)
+                store = None
+            self._condition.notify()
+
+        if store is not None:
+            self._discard(store)
+
+    def close(self):
+        """
+        Close all idle stores. Stores that are checked out are closed when they
+        are returned.
+        """
+
+        with self._condition:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._condition.notify_all()
+
+        for store in idle:
+            self._discard(store)
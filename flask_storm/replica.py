@@ -0,0 +1,204 @@
+from itertools import count
+from threading import Lock
+from time import time
+from weakref import WeakKeyDictionary
+
+from .debug import _GlobalTracer
+
+
+__all__ = [
+    "LatencyTracer",
+    "Replica",
+    "ReplicaSet",
+]
+
+
+class Replica(object):
+    """
+    Health information about a single replica of a bind.
+
+    :param uri: URI of the replica.
+    :param database: Storm Database for the replica.
+    """
+
+    def __init__(self, uri, database):
+        self.uri = uri
+        self.database = database
+
+        #: Moving average of the seconds statements take to execute on this
+        #: replica. ``None`` if no statement has been measured yet.
+        self.latency = None
+
+        #: Number of consecutive failures
+        self.failures = 0
+
+        #: Timestamp until which the replica is ejected
+        self.ejected_until = 0
+
+    def is_available(self, now=None):
+        if now is None:
+            now = time()
+        return self.ejected_until <= now
+
+
+class ReplicaSet(object):
+    """
+    Selects between the replicas of a bind. Replicas that fail are ejected for
+    a backoff period that doubles for every consecutive failure, up to ten times
+    ``backoff``.
+
+    :param replicas: List of :class:`Replica` instances.
+    :param strategy: ``round-robin`` to cycle through the replicas, or
+                     ``latency`` to prefer the replicas that execute statements
+                     the fastest. Latencies are recorded by
+                     :class:`LatencyTracer`.
+    :param backoff: Number of seconds a failing replica is ejected for.
+    :param tolerance: Replicas whose latency is within this factor of the
+                      fastest replica share the traffic in round-robin order
+                      when using the ``latency`` strategy.
+    :raises ValueError: if the strategy is unknown.
+    """
+
+    strategies = ("round-robin", "latency")
+
+    #: Weight of a new latency sample in the moving average
+    smoothing = 0.2
+
+    def __init__(self, replicas, strategy="round-robin", backoff=30, tolerance=1.5):
+        if strategy not in self.strategies:
+            raise ValueError(
+                "Unknown replica strategy {!r}, expected one of {}".format(
+                    strategy, ", ".join(self.strategies)
+                )
+            )
+
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self.backoff = backoff
+        self.tolerance = tolerance
+
+        self._counter = count()
+        self._lock = Lock()
+
+    @property
+    def uris(self):
+        return [replica.uri for replica in self.replicas]
+
+    def candidates(self):
+        """
+        Return available replicas in the order they should be tried.
+
+        :return: List of :class:`Replica` instances.
+        """
+
+        now = time()
+        available = [r for r in self.replicas if r.is_available(now)]
+        if not available:
+            return available
+
+        if self.strategy != "latency":
+            return self._rotate(available)
+
+        # Replicas without measurements are tried first so every replica gets a
+        # latency sample. Replicas that are almost as fast as the fastest one
+        # share the traffic, since sending everything to a single replica would
+        # overload it. The slow ones are only used as fallbacks
+        unmeasured = [r for r in available if r.latency is None]
+        measured = sorted(
+            (r for r in available if r.latency is not None),
+            key=lambda r: r.latency,
+        )
+        if not measured:
+            return unmeasured
+
+        limit = measured[0].latency * self.tolerance
+        fast = [r for r in measured if r.latency <= limit]
+        return unmeasured + self._rotate(fast) + measured[len(fast) :]
+
+    def _rotate(self, replicas):
+        # next() on itertools.count is atomic in CPython, which makes the round
+        # robin distribution safe without locking
+        offset = next(self._counter) % len(replicas)
+        return replicas[offset:] + replicas[:offset]
+
+    def mark_success(self, replica):
+        """
+        Record that a store was acquired from the given replica.
+
+        :param replica: Replica that was used.
+        """
+
+        with self._lock:
+            replica.failures = 0
+            replica.ejected_until = 0
+
+    def record_latency(self, replica, latency):
+        """
+        Add a statement execution time to the latency average of the given
+        replica.
+
+        :param replica: Replica that executed the statement.
+        :param latency: Seconds the statement took to execute.
+        """
+
+        with self._lock:
+            if replica.latency is None:
+                replica.latency = latency
+            else:
+                replica.latency += self.smoothing * (latency - replica.latency)
+
+    def mark_failure(self, replica):
+        """
+        Eject the given replica after a failure.
+
+        :param replica: Replica that failed.
+        """
+
+        with self._lock:
+            replica.failures += 1
+            backoff = min(self.backoff * 2 ** (replica.failures - 1), self.backoff * 10)
+            replica.ejected_until = time() + backoff
+
+
+class LatencyTracer(_GlobalTracer):
+    """
+    Storm tracer that measures how long statements take to execute on replicas
+    and records it in their :class:`ReplicaSet`. Statements on other databases
+    are ignored.
+    """
+
+    def __init__(self):
+        super(LatencyTracer, self).__init__()
+        self._replicas = WeakKeyDictionary()
+
+    def track(self, replica_set):
+        """
+        Start measuring the replicas of the given replica set. This replaces
+        earlier replica sets that use the same databases.
+
+        :param replica_set: ReplicaSet to record latencies in.
+        """
+
+        for replica in replica_set.replicas:
+            self._replicas[replica.database] = (replica_set, replica)
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        self.threadinfo.start = time()
+
+    def connection_raw_execute_success(
+        self, connection, raw_cursor, statement, params
+    ):
+        start = getattr(self.threadinfo, "start", None)
+        self.threadinfo.start = None
+
+        entry = self._replicas.get(connection._database)
+        if start is None or entry is None:
+            return
+
+        replica_set, replica = entry
+        replica_set.record_latency(replica, time() - start)
+
+    def connection_raw_execute_error(
+        self, connection, raw_cursor, statement, params, error
+    ):
+        self.threadinfo.start = None
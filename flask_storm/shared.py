@@ -0,0 +1,284 @@
+import mmap
+import os
+import struct
+
+from binascii import hexlify, unhexlify
+from collections import namedtuple
+from contextlib import contextmanager
+from threading import Lock
+
+from ._compat import perf_counter_ns
+from .debug import _GlobalTracer
+from .sql import fingerprint
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+__all__ = [
+    "SharedStatement",
+    "SharedStats",
+    "SharedStatsTracer",
+]
+
+
+MAGIC = b"FSST"
+VERSION = 1
+
+# Magic, version, number of slots, size of statement text and number of
+# statements that did not fit
+_header = struct.Struct("<4sIIIQ")
+
+# Fingerprint hash, count, errors, total time, max time and text length. The
+# statement text follows
+_slot = struct.Struct("<8sQQQQH")
+
+_empty_hash = b"\x00" * 8
+
+
+#: Statistics of one statement fingerprint in a :class:`SharedStats` file
+SharedStatement = namedtuple(
+    "SharedStatement", "hash text count errors total_ns max_ns"
+)
+
+
+class SharedStats(object):
+    """
+    Per fingerprint statement statistics stored in a memory mapped file. All
+    processes that use the same file share the statistics, which gives a host
+    wide view of pre-fork servers like gunicorn.
+
+    The file consists of a fixed number of slots, which are updated under an
+    exclusive ``flock``. Statements that do not fit once every slot is taken
+    are counted in :attr:`overflow`.
+
+    The file is opened lazily in every process, since file locks are shared
+    between processes that inherit the same open file.
+
+    :param path: Path of the statistics file. It is created if missing.
+    :param slots: Number of statements the file can hold. Ignored if the file
+                  already exists.
+    :param text_size: Number of bytes to store of every normalized statement.
+                      Ignored if the file already exists.
+    :raises ValueError: if the file exists but is not a statistics file.
+    """
+
+    def __init__(self, path, slots=4096, text_size=512):
+        self.path = path
+        self.slots = slots
+        self.text_size = text_size
+
+        self._pid = None
+        self._fd = None
+        self._mmap = None
+        self._lock = Lock()
+
+    @property
+    def _slot_size(self):
+        return _slot.size + self.text_size
+
+    def _lock_file(self, fd):
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+    def _unlock_file(self, fd):
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+
+        # Forget (but do not close) the file of the parent process
+        self._fd = self._mmap = None
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self._lock_file(fd)
+            try:
+                if os.fstat(fd).st_size == 0:
+                    os.ftruncate(fd, _header.size + self.slots * self._slot_size)
+                    os.write(
+                        fd, _header.pack(MAGIC, VERSION, self.slots, self.text_size, 0)
+                    )
+                else:
+                    header = os.read(fd, _header.size)
+                    if len(header) < _header.size or header[:4] != MAGIC:
+                        raise ValueError(
+                            "{} is not a statement statistics file".format(self.path)
+                        )
+                    _, _, self.slots, self.text_size, _ = _header.unpack(header)
+            finally:
+                self._unlock_file(fd)
+
+            self._mmap = mmap.mmap(fd, _header.size + self.slots * self._slot_size)
+        except Exception:
+            os.close(fd)
+            raise
+
+        self._fd = fd
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self):
+        # The thread lock is required since threads share the open file, and
+        # flock only excludes other open files
+        with self._lock:
+            self._open()
+            self._lock_file(self._fd)
+            try:
+                yield self._mmap
+            finally:
+                self._unlock_file(self._fd)
+
+    def _find_slot(self, mm, key, create):
+        start = struct.unpack("<Q", key)[0] % self.slots
+        for i in range(self.slots):
+            offset = _header.size + ((start + i) % self.slots) * self._slot_size
+            stored = mm[offset : offset + 8]
+            if stored == key:
+                return offset
+            if stored == _empty_hash:
+                return offset if create else None
+        return None
+
+    def record(self, hash, text, duration_ns, success=True):
+        """
+        Record one execution of a statement.
+
+        :param hash: Hex encoded fingerprint hash of the statement.
+        :param text: Normalized statement.
+        :param duration_ns: Execution time in nanoseconds.
+        :param success: ``False`` if the statement raised an error.
+        """
+
+        key = unhexlify(hash)
+        with self._locked() as mm:
+            offset = self._find_slot(mm, key, create=True)
+            if offset is None:
+                offset = _header.size - 8
+                (overflow,) = struct.unpack_from("<Q", mm, offset)
+                struct.pack_into("<Q", mm, offset, overflow + 1)
+                return
+
+            stored, count, errors, total_ns, max_ns, length = _slot.unpack_from(
+                mm, offset
+            )
+            if stored == _empty_hash:
+                # Cut on a character boundary when the text is too long
+                encoded = text.encode("utf-8")[: self.text_size]
+                encoded = encoded.decode("utf-8", "ignore").encode("utf-8")
+                length = len(encoded)
+                mm[offset + _slot.size : offset + _slot.size + length] = encoded
+
+            _slot.pack_into(
+                mm,
+                offset,
+                key,
+                count + 1,
+                errors + (0 if success else 1),
+                total_ns + duration_ns,
+                max(max_ns, duration_ns),
+                length,
+            )
+
+    def entries(self):
+        """
+        Return statistics of every recorded statement.
+
+        :return: List of :class:`SharedStatement` instances.
+        """
+
+        entries = []
+        with self._locked() as mm:
+            for i in range(self.slots):
+                offset = _header.size + i * self._slot_size
+                key, count, errors, total_ns, max_ns, length = _slot.unpack_from(
+                    mm, offset
+                )
+                if key == _empty_hash:
+                    continue
+
+                text = mm[offset + _slot.size : offset + _slot.size + length]
+                entries.append(
+                    SharedStatement(
+                        hexlify(key).decode("ascii"),
+                        text.decode("utf-8"),
+                        count,
+                        errors,
+                        total_ns,
+                        max_ns,
+                    )
+                )
+        return entries
+
+    @property
+    def overflow(self):
+        """
+        Number of executions that were not recorded since every slot was taken.
+        """
+
+        with self._locked() as mm:
+            return _header.unpack_from(mm)[4]
+
+    def reset(self):
+        """
+        Remove all statistics.
+        """
+
+        with self._locked() as mm:
+            mm[_header.size :] = b"\x00" * (len(mm) - _header.size)
+            struct.pack_into("<Q", mm, _header.size - 8, 0)
+
+    def close(self):
+        """
+        Close the file of this process. It is reopened on next use.
+        """
+
+        with self._lock:
+            if self._pid == os.getpid():
+                self._mmap.close()
+                os.close(self._fd)
+            self._pid = self._fd = self._mmap = None
+
+
+class SharedStatsTracer(_GlobalTracer):
+    """
+    Storm tracer that records statement statistics in a :class:`SharedStats`
+    file, which can be shared by all worker processes of one host. Use
+    ``flask storm stats`` to show the statements with the highest total time.
+
+    ::
+
+        tracer = SharedStatsTracer(app.config["STORM_SHARED_STATS_PATH"])
+        tracer.start()
+
+    :param path: Path of the statistics file.
+    :param kwargs: Passed to :class:`SharedStats`.
+    """
+
+    def __init__(self, path, **kwargs):
+        super(SharedStatsTracer, self).__init__()
+        self.stats = SharedStats(path, **kwargs)
+
+    def _record(self, statement, success):
+        start_ns = getattr(self.threadinfo, "start_ns", None)
+        if start_ns is None:
+            return
+        self.threadinfo.start_ns = None
+
+        fp = fingerprint(statement)
+        self.stats.record(fp.hash, fp.text, perf_counter_ns() - start_ns, success)
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        self.threadinfo.start_ns = perf_counter_ns()
+
+    def connection_raw_execute_success(self, connection, raw_cursor, statement, params):
+        self._record(statement, True)
+
+    def connection_raw_execute_error(
+        self, connection, raw_cursor, statement, params, error
+    ):
+        self._record(statement, False)
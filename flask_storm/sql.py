@@ -1,3 +1,7 @@
+import re
+
+from collections import namedtuple
+from hashlib import sha1
 from storm.databases.postgres import PostgresConnection
 from storm.variables import Variable
 
@@ -19,16 +23,24 @@ try:
 except ImportError:
     psycopg2_adapt = None
 
-from ._compat import base_string, long_int
+from ._compat import base_string, long_int, lru_cache
 from .utils import colored
 
 
 __all__ = [
     "Adapter",
+    "adapt_params",
     "default_adapter",
+    "LiteralAdapter",
+    "literal_adapter",
     "replace_placeholders",
+    "normalize",
+    "fingerprint",
+    "Fingerprint",
+    "tables",
     "format",
     "color",
+    "render",
 ]
 
 
@@ -76,22 +88,290 @@ class Adapter(object):
 default_adapter = Adapter()
 
 
-def replace_placeholders(statement, params, adapter=None):
+class LiteralAdapter(Adapter):
+    """
+    Adapter for parameters that are already converted to SQL literals using
+    :func:`adapt_params`. This makes it possible to render statements after the
+    connection of the parameters is closed, or from another thread.
+    """
+
+    def adapt(self, value):
+        return value
+
+
+literal_adapter = LiteralAdapter()
+
+
+def adapt_params(params, adapter=None):
+    """
+    Return the given parameters converted to SQL literals using the given
+    :class:`Adapter`. Parameters the adapter fails to convert are converted
+    without the connection. Use :data:`literal_adapter` when rendering a
+    statement using the converted parameters.
+    """
+
     if adapter is None:
         adapter = default_adapter
 
-    param_iter = (adapter.adapt(param) for param in params)
-    tokens = []
+    literals = []
+    for param in params:
+        try:
+            literals.append(adapter.adapt(param))
+        except Exception:
+            literals.append(default_adapter.adapt(param))
+    return tuple(literals)
+
+
+#: Number of distinct statements to keep parsed placeholder templates for
+TEMPLATE_CACHE_SIZE = 2048
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _split_placeholders(statement):
+    # Split the statement into the literal segments around its placeholders.
+    # A statement with n placeholders results in n + 1 segments
+    Placeholder = sqlparse.tokens.Name.Placeholder
+
+    segments = []
+    current = []
+    for token in sqlparse.parse(statement)[0].flatten():
+        if token.ttype in Placeholder:
+            segments.append("".join(current))
+            current = []
+        else:
+            current.append(token.value)
+    segments.append("".join(current))
+    return tuple(segments)
+
+
+# Matches everything that may contain placeholder characters without them
+# being placeholders, as well as the placeholders themselves. Since the regular
+# expression is only applied once the statement is scanned in a single pass
+_placeholder_re = re.compile(
+    r"""
+    (?:
+        '(?:[^']|'')*'
+        | (?<!\w)[eE]'(?:[^'\\]|\\.|'')*'
+        | "(?:[^"]|"")*"
+        | \$(?P<tag>(?:[A-Za-z_][A-Za-z0-9_]*)?)\$.*?\$(?P=tag)\$
+        | --[^\n]*
+        | /\*.*?\*/
+        | %%
+    )
+    | (?P<placeholder>\?|%s)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _split_placeholders_fast(statement):
+    # Same as _split_placeholders, but without sqlparse. Only ? and %s
+    # placeholders are recognized, which are the ones Storm generates
+    segments = []
+    start = 0
+    for match in _placeholder_re.finditer(statement):
+        if match.group("placeholder") is not None:
+            segments.append(statement[start : match.start()])
+            start = match.end()
+    segments.append(statement[start:])
+    return tuple(segments)
+
+
+def replace_placeholders(statement, params, adapter=None, fast=False):
+    """
+    Return the statement with its placeholders replaced by the given
+    parameters, adapted using the given :class:`Adapter`. The statement is
+    only parsed the first time it is seen, after which the parsed template is
+    cached.
+
+    By default sqlparse is used to find placeholders. When ``fast`` is ``True``,
+    or if sqlparse is not installed, a purpose built scanner is used instead.
+    It only recognizes ``?`` and ``%s`` placeholders, which are the ones Storm
+    generates, and correctly skips string literals, quoted identifiers,
+    dollar quoted strings and comments.
+
+    :raises ValueError: if there are fewer parameters than placeholders.
+    """
+
+    if adapter is None:
+        adapter = default_adapter
+
+    if fast or sqlparse is None:
+        segments = _split_placeholders_fast(statement)
+    else:
+        segments = _split_placeholders(statement)
+
+    return _interpolate(segments, params, adapter)
+
+
+def _interpolate(segments, params, adapter, wrap=None):
+    param_iter = iter(params)
+
+    parts = [segments[0]]
     try:
-        for token in sqlparse.parse(statement)[0].flatten():
-            if str(token.ttype) == "Token.Name.Placeholder":
-                tokens.append(next(param_iter))
-            else:
-                tokens.append(token.value)
+        for segment in segments[1:]:
+            value = adapter.adapt(next(param_iter))
+            parts.append(value if wrap is None else wrap(value))
+            parts.append(segment)
     except StopIteration:
         raise ValueError("Not enough parameters provided")
 
-    return "".join(tokens)
+    return "".join(parts)
+
+
+_in_list_re = re.compile(r"\b(IN\s*)\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_literal_re = re.compile(
+    r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<literal>
+        '(?:[^']|'')*'
+        | (?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b
+        | %s
+        | \$\d+
+    )
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+_whitespace_re = re.compile(r"\s+")
+
+
+def _normalize_token(token):
+    Token = sqlparse.tokens
+    if token.ttype in Token.Comment:
+        return " "
+    elif token.ttype in Token.Literal.String.Symbol:
+        # Double quoted identifiers are lexed as string symbols, but are names
+        return token.value
+    elif token.ttype in Token.Literal.String or token.ttype in Token.Literal.Number:
+        return "?"
+    elif token.ttype in Token.Name.Placeholder:
+        return "?"
+    elif token.is_whitespace:
+        return " "
+    elif token.is_keyword:
+        return token.value.upper()
+    return token.value
+
+
+def _normalize_literal(match):
+    if match.group("comment") is not None:
+        return " "
+    return "?"
+
+
+def normalize(statement):
+    """
+    Return a normalized version of the given statement, where literals and
+    placeholders are replaced by ``?``, lists of values in ``IN`` clauses are
+    collapsed into ``IN (...)``, and comments and redundant whitespace are
+    removed. Statements that only differ in their values normalize to the same
+    string.
+
+    If sqlparse is installed keywords are also upper cased.
+    """
+
+    if sqlparse is None:
+        normalized = _literal_re.sub(_normalize_literal, statement)
+    else:
+        normalized = "".join(
+            _normalize_token(t) for t in sqlparse.parse(statement)[0].flatten()
+        )
+
+    normalized = _whitespace_re.sub(" ", normalized).strip()
+    return _in_list_re.sub(r"\1(...)", normalized)
+
+
+#: Number of distinct statements to keep fingerprints for
+FINGERPRINT_CACHE_SIZE = 2048
+
+
+class Fingerprint(namedtuple("Fingerprint", ["hash", "text"])):
+    """
+    Fingerprint of a statement as returned by :func:`fingerprint`.
+
+    :param hash: Hex digest of the normalized statement. This is stable across
+                 processes and Python versions.
+    :param text: Normalized statement.
+    """
+
+    __slots__ = ()
+
+
+@lru_cache(maxsize=FINGERPRINT_CACHE_SIZE)
+def fingerprint(statement):
+    """
+    Return a :class:`Fingerprint` for the given statement. Statements that only
+    differ in their values, see :func:`normalize`, have the same fingerprint.
+    Results are cached for the most recently used statements, since the same
+    statements are typically executed over and over again.
+    """
+
+    text = normalize(statement)
+    return Fingerprint(sha1(text.encode("utf-8")).hexdigest()[:16], text)
+
+
+_table_keyword_re = re.compile(
+    r"\b(?:FROM|JOIN|INTO|UPDATE|COPY|TRUNCATE(?:\s+TABLE)?)\s+(?:ONLY\s+)?",
+    re.IGNORECASE,
+)
+_copy_re = re.compile(r"^\s*COPY\b", re.IGNORECASE)
+_copy_streams = frozenset(["stdin", "stdout"])
+_identifier = r'(?:"(?:[^"]|"")+"|[A-Za-z_][\w$]*)'
+_table_name_re = re.compile(
+    r"((?:{0}\s*\.\s*)*{0})(?:\s+(?:AS\s+)?{0})?".format(_identifier),
+    re.IGNORECASE,
+)
+_table_separator_re = re.compile(r"\s*,\s*")
+
+
+def _unquote_table(name):
+    # Schemas are dropped, which may cause tables with the same name in
+    # different schemas to be considered the same
+    name = name.rsplit(".", 1)[-1].strip()
+    if name.startswith('"'):
+        return name[1:-1].replace('""', '"').lower()
+    return name.lower()
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def tables(statement):
+    """
+    Return the names of the tables referenced after ``FROM``, ``JOIN``,
+    ``INTO``, ``UPDATE``, ``COPY`` and ``TRUNCATE`` in the given statement.
+    Names are lower cased and schemas are removed.
+
+    The statement is scanned using regular expressions, which may report
+    tables that are not there, for example text within string literals, but
+    does not miss tables that are referenced after these keywords.
+
+    Only tables named in the statement itself are found. Tables read through
+    views, and tables written by triggers or foreign key cascades, are not.
+
+    :param statement: SQL statement.
+    :return: Frozenset of table names.
+    """
+
+    is_copy = _copy_re.match(statement) is not None
+
+    found = set()
+    for keyword in _table_keyword_re.finditer(statement):
+        pos = keyword.end()
+        while True:
+            match = _table_name_re.match(statement, pos)
+            if match is None:
+                break
+
+            name = match.group(1)
+            if not (is_copy and name.lower() in _copy_streams):
+                # COPY ... FROM STDIN does not refer to a table
+                found.add(_unquote_table(name))
+
+            separator = _table_separator_re.match(statement, match.end())
+            if separator is None:
+                break
+            pos = separator.end()
+    return frozenset(found)
 
 
 def format(statement):
@@ -118,6 +398,8 @@ def _color_token(token):
         return colored(token.value, 246)
     elif isinstance(token, sqlparse.sql.Identifier):
         return colored(token.value, 69)
+    elif token.ttype in Token.Literal.String.Symbol:
+        return colored(token.value, 69)
     elif token.ttype in Token.Literal.String:
         return colored(token.value, 220)
     elif token.ttype in Token.Literal.Number:
@@ -133,3 +415,51 @@ def color(statement):
     if sqlparse is None:
         return statement
     return "".join(_color_token(t) for t in sqlparse.parse(statement)[0].tokens)
+
+
+def _color_value(value):
+    if value.startswith("'") or value.startswith("E'"):
+        return colored(value, 220)
+    elif value[:1].isdigit() or value[:1] == "-":
+        return colored(value, 39)
+    return colored(value, 160, bold=True)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _render_template(statement, colorize):
+    rendered = format(statement)
+    if colorize:
+        rendered = color(rendered)
+
+    segments = _split_placeholders_fast(rendered)
+    if len(segments) != len(_split_placeholders_fast(statement)):
+        # Formatting changed the placeholders, which means the parameters can
+        # not be interpolated into the rendered template
+        return None
+    return segments
+
+
+def render(statement, params=(), adapter=None, colorize=False):
+    """
+    Return the given statement pretty printed using :func:`format`, with
+    parameters interpolated. The rendered template of every statement is cached
+    before parameters are interpolated, so repeated statements are only
+    formatted once.
+
+    :param statement: Statement with ``?`` or ``%s`` placeholders.
+    :param params: Parameters for the placeholders.
+    :param adapter: :class:`Adapter` used to convert parameters to SQL.
+    :param colorize: When ``True`` the output is also colored using
+                     :func:`color`.
+    :raises ValueError: if there are fewer parameters than placeholders.
+    """
+
+    if adapter is None:
+        adapter = default_adapter
+
+    segments = _render_template(statement, colorize)
+    if segments is None:
+        rendered = format(replace_placeholders(statement, params, adapter, fast=True))
+        return color(rendered) if colorize else rendered
+
+    return _interpolate(segments, params, adapter, _color_value if colorize else None)
@@ -1,7 +1,7 @@
 import os
 import sys
 
-from flask import current_app
+from flask import current_app, _app_ctx_stack
 from functools import partial
 from werkzeug.local import LocalProxy
 
@@ -17,7 +17,40 @@ def find_flask_storm(app):
     return getattr(app, "extensions", {}).get("storm")
 
 
-def _lookup_storm_store(bind=None):
+def get_connection_bind_name(connection):
+    """
+    Return the name of the bind the given Storm connection belongs to in the
+    current application.
+
+    The bind name is resolved once and cached on the connection, since the
+    database of a connection never changes.
+
+    :param connection: Storm connection.
+    :return: Bind name, ``None`` for the default bind or if the bind can not be
+             determined.
+    """
+
+    try:
+        return connection._flask_storm_bind_name
+    except AttributeError:
+        pass
+
+    ctx = _app_ctx_stack.top
+    flask_storm = find_flask_storm(ctx.app) if ctx is not None else None
+    if flask_storm is None:
+        # The bind may be known once there is an application context
+        return None
+
+    try:
+        bind = flask_storm.get_bind_name(connection._database)
+    except LookupError:
+        bind = None
+
+    connection._flask_storm_bind_name = bind
+    return bind
+
+
+def _resolve_storm_store(bind=None, readonly=False):
     app = current_app
     if not app:
         raise RuntimeError("Working outside an application context")
@@ -26,12 +59,34 @@ def _lookup_storm_store(bind=None):
     if flask_storm is None:
         raise RuntimeError("FlaskStorm is not bound to the current application")
 
-    return flask_storm.get_store(bind)
+    return flask_storm.get_store(bind, readonly=readonly)
+
+
+def _lookup_storm_store(bind=None, readonly=False):
+    # Fast path for stores that have already been resolved in this application
+    # context. Context locals are accessed for every attribute lookup, so this
+    # avoids resolving the application and extension every time
+    ctx = _app_ctx_stack.top
+    if ctx is None:
+        return _resolve_storm_store(bind, readonly)
+
+    key = (bind, readonly)
+    try:
+        return ctx.storm_context_locals[key]
+    except AttributeError:
+        ctx.storm_context_locals = {}
+    except KeyError:
+        pass
+
+    store = ctx.storm_context_locals[key] = _resolve_storm_store(bind, readonly)
+    return store
 
 
-def create_context_local(bind):
+def create_context_local(bind, readonly=False):
     """
     Create a context local for the given bind. None means the default store.
+    When ``readonly`` is ``True`` the context local uses one of the replicas of
+    the bind.
 
     ::
 
@@ -45,12 +100,14 @@ def create_context_local(bind):
         store = create_context_local(None)
 
     :param bind: Bind name of database URI to use when creating store.
+    :param readonly: When ``True`` the store is connected to a replica. See
+                     :meth:`FlaskStorm.get_store`.
     :raises RuntimeError: if working outside application context or if
                           FlaskStorm is not bound to the current application.
 
     """
 
-    return LocalProxy(partial(_lookup_storm_store, bind))
+    return LocalProxy(partial(_lookup_storm_store, bind, readonly))
 
 
 def has_color_support(file=None):
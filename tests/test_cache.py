@@ -0,0 +1,323 @@
+import pytest
+
+from flask_storm import store
+from flask_storm.cache import (
+    CachedCursor,
+    CachingConnection,
+    CachingStore,
+    enable_result_cache,
+    ObjectCache,
+)
+from mock import patch
+from sqlite3 import connect
+from storm.locals import Int, Unicode
+
+require = pytest.mark.usefixtures
+
+
+class User(object):
+    __storm_table__ = "users"
+
+    id = Int(primary=True)
+    name = Unicode()
+
+    def __init__(self, name):
+        self.name = name
+
+
+@pytest.fixture
+def cached_app(app):
+    app.config["STORM_RESULT_CACHE"] = True
+    return app
+
+
+@pytest.fixture
+def users(cached_app, flask_storm, app_context):
+    store.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT)")
+    store.execute("CREATE TABLE groups (id INTEGER PRIMARY KEY)")
+    store.add(User(u"foo"))
+    store.add(User(u"bar"))
+    store.flush()
+
+    connection = store._connection
+    connection.hits = connection.misses = 0
+    return connection
+
+
+def test_cached_cursor():
+    cursor = CachedCursor([(1,), (2,), (3,)], 3)
+    assert cursor.fetchone() == (1,)
+    assert cursor.fetchmany(1) == [(2,)]
+    assert cursor.fetchall() == [(3,)]
+    assert cursor.fetchone() is None
+    assert cursor.fetchmany() == []
+    assert cursor.rowcount == 3
+
+
+@require("flask_storm", "app_context")
+def test_result_cache_disabled():
+    assert not isinstance(store._connection, CachingConnection)
+
+
+def test_result_cache_hit(users):
+    assert isinstance(users, CachingConnection)
+
+    names = sorted(u.name for u in store.find(User))
+    assert sorted(u.name for u in store.find(User)) == names == [u"bar", u"foo"]
+    assert users.hits == 1
+    assert users.misses == 1
+
+    # Different parameters are cached separately
+    assert store.find(User, name=u"foo").one().name == u"foo"
+    assert store.find(User, name=u"bar").one().name == u"bar"
+    assert store.find(User, name=u"foo").one().name == u"foo"
+    assert users.hits == 2
+    assert users.misses == 3
+
+    # Statements without tables are not cached
+    assert store.execute("SELECT 1").get_one() == (1,)
+    assert store.execute("SELECT 1").get_one() == (1,)
+    assert users.hits == 2
+    assert users.misses == 3
+
+
+def test_result_cache_write_invalidation(users):
+    store.find(User).count()
+    store.execute("SELECT * FROM groups").get_all()
+    store.execute("UPDATE users SET name = 'baz' WHERE id = 1")
+    assert store.find(User, name=u"baz").count() == 1
+    assert store.find(User).count() == 2
+    assert users.misses == 4
+
+    # Writes to other tables leave unrelated entries intact
+    store.execute("SELECT * FROM groups").get_all()
+    assert users.hits == 1
+
+    # Statements that do not reveal the table clear everything
+    store.execute("CREATE TABLE other (id INTEGER PRIMARY KEY)")
+    store.execute("SELECT * FROM groups").get_all()
+    assert users.misses == 5
+
+
+def test_result_cache_commit_rollback(users):
+    store.find(User).count()
+    store.commit()
+    store.find(User).count()
+    assert users.misses == 2
+
+    store.rollback()
+    store.find(User).count()
+    assert users.misses == 3
+
+
+def test_enable_result_cache(users):
+    assert enable_result_cache(store) is users
+
+
+def test_result_cache_max_rows(users):
+    users.max_rows = 3
+    store.execute("INSERT INTO groups (id) VALUES (1), (2)")
+
+    store.find(User).count()
+    store.find(User).count()
+    assert users.hits == 1
+
+    # Both users are kept, but the groups do not fit without evicting them
+    store.execute("SELECT * FROM users").get_all()
+    store.execute("SELECT * FROM groups").get_all()
+    store.find(User).count()
+    assert users.misses == 4
+
+    # Results with more rows than the limit are never cached
+    users.max_rows = 1
+    store.execute("SELECT id FROM groups").get_all()
+    store.execute("SELECT id FROM groups").get_all()
+    assert users.misses == 6
+
+
+def test_object_cache():
+    cache = ObjectCache(size=2, ttl=10)
+    with patch("flask_storm.cache.time") as time:
+        time.return_value = 100
+        cache.set((None, User, (1,)), (1, u"foo"))
+        cache.set((None, User, (2,)), (2, u"bar"))
+        assert cache.get((None, User, (1,))) == (1, u"foo")
+
+        # The least recently used entry is evicted
+        cache.set((None, User, (3,)), (3, u"baz"))
+        assert cache.get((None, User, (2,))) is None
+        assert len(cache) == 2
+
+        time.return_value = 110
+        assert cache.get((None, User, (1,))) is None
+
+    assert cache.hits == 1
+    assert cache.misses == 2
+
+
+def test_object_cache_generation():
+    cache = ObjectCache()
+    generation = cache.generation
+    cache.invalidate((None, User, (1,)))
+
+    # Values loaded before an invalidation may be stale
+    cache.set((None, User, (1,)), (1, u"foo"), generation)
+    assert cache.get((None, User, (1,))) is None
+
+    cache.set((None, User, (1,)), (1, u"foo"), cache.generation)
+    cache.invalidate_tables(["users"])
+    assert cache.get((None, User, (1,))) is None
+
+
+@pytest.fixture
+def db_path(app, flask_storm, tmpdir):
+    path = str(tmpdir.join("db.sqlite"))
+    app.config["STORM_DATABASE_URI"] = "sqlite:" + path
+    app.config["STORM_OBJECT_CACHE_SIZE"] = 10
+
+    with app.app_context():
+        store.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT)")
+        store.execute("INSERT INTO users (id, name) VALUES (1, 'foo')")
+        store.commit()
+
+    return path
+
+
+def update_users(path, name):
+    # Change the rows without going through Flask-Storm
+    connection = connect(path)
+    with connection:
+        connection.execute("UPDATE users SET name = ?", [name])
+    connection.close()
+
+
+def test_object_cache_across_contexts(app, flask_storm, db_path):
+    with app.app_context():
+        assert isinstance(store._get_current_object(), CachingStore)
+        assert store.get(User, 1).name == u"foo"
+
+    update_users(db_path, u"bar")
+
+    with app.app_context():
+        assert store.get(User, 1).name == u"foo"
+        assert store.get(User, 2) is None
+        assert flask_storm.get_object_cache().hits == 1
+
+
+def test_object_cache_commit_invalidation(app, flask_storm, db_path):
+    with app.app_context():
+        store.get(User, 1).name = u"bar"
+        store.commit()
+
+    with app.app_context():
+        assert store.get(User, 1).name == u"bar"
+
+        store.remove(store.get(User, 1))
+        store.commit()
+
+    with app.app_context():
+        assert store.get(User, 1) is None
+
+
+def test_object_cache_execute_invalidation(app, flask_storm, db_path):
+    with app.app_context():
+        store.get(User, 1)
+        store.execute("UPDATE users SET name = 'bar'")
+
+        # Uncommitted writes do not affect other stores
+        store.rollback()
+        update_users(db_path, u"baz")
+        assert store.get(User, 1).name == u"foo"
+
+        store.execute("UPDATE users SET name = 'bar'")
+        store.commit()
+
+    with app.app_context():
+        assert store.get(User, 1).name == u"bar"
+
+
+def test_object_cache_result_set_invalidation(app, flask_storm, db_path):
+    # Results sets execute statements without using Store.execute()
+    with app.app_context():
+        store.get(User, 1)
+        store.find(User, User.id == 1).set(name=u"bar")
+        store.commit()
+
+    with app.app_context():
+        assert store.get(User, 1).name == u"bar"
+
+        store.find(User, User.id == 1).remove()
+        store.commit()
+
+    with app.app_context():
+        assert store.get(User, 1) is None
+
+
+def test_object_cache_flush_not_tracked(app, flask_storm, db_path):
+    app.config["STORM_RESULT_CACHE"] = True
+
+    with app.app_context():
+        store.get(User, 1).name = u"bar"
+        store.flush()
+
+        # Flushed objects are invalidated one at a time, not by table
+        tracker = store._write_tracker
+        assert tracker.tables == set()
+        assert not tracker.unknown
+
+        store.execute("DELETE FROM users WHERE id = 2")
+        assert tracker.tables == set([u"users"])
+
+
+def create_users(path, name):
+    connection = connect(path)
+    with connection:
+        connection.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT)")
+        connection.execute("INSERT INTO users (id, name) VALUES (1, ?)", [name])
+    connection.close()
+    return "sqlite:" + path
+
+
+def test_object_cache_binds(app, flask_storm, db_path, tmpdir):
+    other_uri = create_users(str(tmpdir.join("other.sqlite")), u"other")
+    app.config["STORM_BINDS"] = {"other": other_uri}
+
+    with app.app_context():
+        assert store.get(User, 1).name == u"foo"
+        assert flask_storm.get_store("other").get(User, 1).name == u"other"
+
+    # Binds do not share cached objects
+    with app.app_context():
+        assert store.get(User, 1).name == u"foo"
+        assert flask_storm.get_store("other").get(User, 1).name == u"other"
+
+
+def test_object_cache_replicas(app, flask_storm, tmpdir):
+    primary_path = str(tmpdir.join("primary.sqlite"))
+    app.config["STORM_OBJECT_CACHE_SIZE"] = 10
+    app.config["STORM_BINDS"] = {
+        "main": {
+            "primary": create_users(primary_path, u"foo"),
+            "replicas": [create_users(str(tmpdir.join("replica.sqlite")), u"foo")],
+        },
+    }
+
+    with app.app_context():
+        replica = flask_storm.get_store("main", readonly=True)
+        assert replica.get(User, 1).name == u"foo"
+
+    # The replica lags behind the primary, and must not have added its values
+    update_users(primary_path, u"bar")
+    with app.app_context():
+        assert flask_storm.get_store("main").get(User, 1).name == u"bar"
+
+    # Replicas use the objects loaded from the primary
+    with app.app_context():
+        replica = flask_storm.get_store("main", readonly=True)
+        assert replica.get(User, 1).name == u"bar"
+
+
+@require("flask_storm", "app_context")
+def test_object_cache_disabled(flask_storm):
+    assert flask_storm.get_object_cache() is None
+    assert not isinstance(store._get_current_object(), CachingStore)
@@ -1,6 +1,7 @@
 import pytest
 
 from flask_storm import store, create_context_local
+from mock import patch
 from storm.locals import Store
 
 
@@ -31,3 +32,16 @@ def test_bind_context_local(app, flask_storm):
 
     with app.app_context():
         assert extra_store._get_current_object() is flask_storm.get_store("extra")
+
+
+def test_context_local_resolved_once(app, flask_storm):
+    with patch.object(flask_storm, "get_store", wraps=flask_storm.get_store) as mock:
+        with app.app_context():
+            store.get
+            store.find
+            assert mock.call_count == 1
+
+        # A new application context must resolve the store again
+        with app.app_context():
+            store.get
+            assert mock.call_count == 2
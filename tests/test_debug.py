@@ -1,11 +1,34 @@
+import json
 import pytest
 import sys
 
 from datetime import datetime, timedelta
+from flask import _app_ctx_stack
 from flask_storm import store, FlaskStorm
-from flask_storm.debug import DebugTracer, get_debug_queries, DebugQuery, ShellTracer
+from flask_storm.sql import fingerprint
+from flask_storm.debug import (
+    DebugQuery,
+    DebugQueryLog,
+    DebugTracer,
+    get_debug_queries,
+    get_query_stats,
+    MonotonicDebugQuery,
+    NPlusOneError,
+    NPlusOneTracer,
+    NPlusOneWarning,
+    query_budget,
+    QueryBudgetExceeded,
+    QueryBudgetTracer,
+    QueryStats,
+    QueuedWriter,
+    RequestTracer,
+    ShellTracer,
+    SlowQueryTracer,
+    StatsTracer,
+)
 from mock import MagicMock, patch
-from threading import Thread
+from storm.variables import UnicodeVariable as Unicode
+from threading import current_thread, Event, Thread
 
 try:
     from io import StringIO
@@ -22,6 +45,8 @@ require_sqlparse = pytest.mark.skipif(not sqlparse, reason="requires sqlparse")
 
 require = pytest.mark.usefixtures
 
+remove_whitespace = pytest.helpers.remove_whitespace
+
 
 @require("app", "flask_storm", "app_context")
 def test_get_debug_queries():
@@ -188,3 +213,597 @@ def test_shell_tracer_failure():
 
     assert "FAILURE" in output.getvalue()
     output.close()
+
+
+@require("app_context", "flask_storm")
+def test_debug_tracer_not_sampled():
+    with patch("flask_storm.debug.random", return_value=0.5):
+        with DebugTracer(sample_rate=0.1):
+            store.execute("SELECT 1")
+
+    assert get_debug_queries() == []
+
+
+@require("app_context", "flask_storm")
+def test_debug_tracer_sampled():
+    with patch("flask_storm.debug.random", return_value=0.05):
+        with DebugTracer(sample_rate=0.1):
+            store.execute("SELECT 1")
+            store.execute("SELECT 2")
+
+    assert len(get_debug_queries()) == 2
+
+
+@require("app_context", "flask_storm")
+def test_debug_tracer_sampled_once_per_context():
+    with patch("flask_storm.debug.random", return_value=0.05) as mock:
+        with DebugTracer(sample_rate=0.1):
+            store.execute("SELECT 1")
+            store.execute("SELECT 2")
+
+    assert mock.call_count == 1
+
+
+@require("app_context", "flask_storm")
+def test_debug_tracer_slow_threshold():
+    with patch("flask_storm.debug.random", return_value=0.5):
+        with DebugTracer(sample_rate=0, slow_threshold=timedelta(0)):
+            store.execute("SELECT 1")
+
+        with DebugTracer(sample_rate=0, slow_threshold=timedelta(hours=1)):
+            store.execute("SELECT 2")
+
+    queries = get_debug_queries()
+    assert len(queries) == 1
+    assert queries[0].statement == "SELECT 1"
+
+
+@require("app_context", "flask_storm")
+def test_debug_tracer_max_per_statement():
+    with DebugTracer(max_per_statement=2):
+        # Statements with the same fingerprint are counted together
+        for i in range(5):
+            store.execute("SELECT {}".format(i))
+        store.execute("SELECT ?, ?", [1, 2])
+
+    queries = get_debug_queries()
+    assert [q.statement for q in queries] == ["SELECT 0", "SELECT 1", "SELECT ?, ?"]
+
+
+def test_debug_query_log():
+    log = DebugQueryLog(2)
+    for i in range(5):
+        log.append(i)
+
+    assert list(log) == [3, 4]
+    assert log.dropped == 3
+    assert log.total == 5
+
+
+@require("app_context", "flask_storm")
+def test_debug_tracer_max_queries():
+    with DebugTracer(max_queries=2):
+        for i in range(5):
+            store.execute("SELECT ?", [i])
+
+    queries = get_debug_queries()
+    assert isinstance(queries, DebugQueryLog)
+    assert [q.params for q in queries] == [[3], [4]]
+    assert queries.dropped == 3
+    assert queries.total == 5
+
+
+@require("app_context", "flask_storm")
+def test_debug_tracer_max_param_size():
+    blob = b"x" * 1000
+
+    with DebugTracer(max_param_size=10):
+        store.execute("SELECT ?, ?, ?", [u"y" * 100, blob, 42])
+        store.execute("SELECT ?", [Unicode(u"z" * 100)])
+
+    first, second = get_debug_queries()
+    assert first.params == (u"y" * 10 + u"...", b"x" * 10 + b"...", 42)
+    assert second.params == (u"z" * 10 + u"...",)
+
+
+def test_monotonic_debug_query():
+    anchor = (datetime(2000, 1, 1), 1000)
+    dq = MonotonicDebugQuery("SELECT 1", (), 2000, 1502000, anchor)
+
+    assert dq.statement == "SELECT 1"
+    assert dq.duration_ns == 1500000
+    assert dq.duration == timedelta(microseconds=1500)
+    assert dq.start_time == datetime(2000, 1, 1, microsecond=1)
+    assert dq.end_time == datetime(2000, 1, 1, microsecond=1501)
+
+
+@require("app_context", "flask_storm")
+def test_debug_tracer_monotonic():
+    with DebugTracer(clock="monotonic"):
+        store.execute("SELECT 1")
+
+    (query,) = get_debug_queries()
+    assert isinstance(query, MonotonicDebugQuery)
+    assert query.statement == "SELECT 1"
+    assert query.duration_ns >= 0
+    assert isinstance(query.duration, timedelta)
+    assert isinstance(query.start_time, datetime)
+    assert query.start_time <= query.end_time
+
+
+@require("app_context", "flask_storm")
+def test_debug_tracer_monotonic_slow_threshold():
+    with DebugTracer(
+        clock="monotonic", sample_rate=0, slow_threshold=timedelta(hours=1)
+    ):
+        store.execute("SELECT 1")
+
+    assert get_debug_queries() == []
+
+
+def test_debug_tracer_unknown_clock():
+    with pytest.raises(ValueError):
+        DebugTracer(clock="sundial")
+
+
+def test_query_stats():
+    stats = QueryStats()
+    stats.record("SELECT 1", 1000)
+    stats.record("SELECT 2", 3000, success=False)
+    stats.record("SELECT 1", 2000)
+
+    assert stats.count == 3
+    assert stats.errors == 1
+    assert stats.total_ns == 6000
+    assert stats.total_time == timedelta(microseconds=6)
+    assert stats.max_time == timedelta(microseconds=3)
+    assert stats.slowest_statement == "SELECT 2"
+
+    select_1 = stats.statements["SELECT 1"]
+    assert select_1.count == 2
+    assert select_1.errors == 0
+    assert select_1.total_ns == 3000
+    assert select_1.max_ns == 2000
+
+
+@require("app_context", "flask_storm")
+def test_stats_tracer():
+    with StatsTracer():
+        store.execute("SELECT 1")
+        store.execute("SELECT ?", [1])
+        store.execute("SELECT ?", [2])
+        with pytest.raises(Exception):
+            store.execute("SELECT !")
+
+    stats = get_query_stats()
+    assert stats.count == 4
+    assert stats.errors == 1
+    assert stats.statements["SELECT ?"].count == 3
+    assert stats.statements["SELECT !"].errors == 1
+    assert stats.total_ns >= stats.max_ns > 0
+
+    # Queries are no longer counted once the tracer is stopped
+    store.execute("SELECT 1")
+    assert get_query_stats().count == 4
+
+
+def test_get_query_stats_no_context():
+    stats = get_query_stats()
+    assert stats.count == 0
+    assert stats.statements == {}
+
+
+@require("app_context", "flask_storm")
+def test_nplusone_tracer_raise():
+    with NPlusOneTracer(threshold=2, action="raise"):
+        store.execute("SELECT 1")
+        store.execute("SELECT 2")
+
+        with pytest.raises(NPlusOneError) as excinfo:
+            store.execute("SELECT 3")
+
+    assert excinfo.value.count == 3
+    assert excinfo.value.statement == "SELECT ?"
+
+
+@require("app_context", "flask_storm")
+def test_nplusone_tracer_warn():
+    with NPlusOneTracer(threshold=1, action="warn"):
+        store.execute("SELECT ?", [1])
+        with pytest.warns(NPlusOneWarning):
+            store.execute("SELECT ?", [2])
+
+
+@require("app_context", "flask_storm")
+def test_nplusone_tracer_log():
+    with patch("flask_storm.debug.logger") as logger:
+        with NPlusOneTracer(threshold=1):
+            for i in range(5):
+                store.execute("SELECT ?", [i])
+            store.execute("SELECT 'other'")
+
+    # Statements are only reported once
+    assert logger.warning.call_count == 1
+    assert logger.warning.call_args[0][1:] == (2, "SELECT ?")
+
+
+@require("flask_storm")
+def test_nplusone_tracer_per_context(app):
+    with NPlusOneTracer(threshold=1, action="raise"):
+        for _ in range(2):
+            with app.app_context():
+                store.execute("SELECT 1")
+
+
+def test_nplusone_tracer_unknown_action():
+    with pytest.raises(ValueError):
+        NPlusOneTracer(action="explode")
+
+
+@require("app_context", "flask_storm")
+def test_shell_tracer_no_sqlparse():
+    output = StringIO()
+
+    with patch("flask_storm.sql.sqlparse", None):
+        with ShellTracer(file=output, fancy=False):
+            store.execute("SELECT ? + ?", [1, 2])
+
+    assert output.getvalue().startswith("SELECT 1 + 2;\n")
+    output.close()
+
+
+def test_queued_writer():
+    output = StringIO()
+    writer = QueuedWriter(output)
+
+    writer.write(u"foo\n")
+    writer.submit(u"{}\n".format, u"bar")
+    writer.flush()
+
+    assert output.getvalue() == u"foo\nbar\n"
+    writer.close()
+
+
+def test_queued_writer_drop():
+    blocker = Event()
+    output = StringIO()
+    writer = QueuedWriter(output, maxsize=1, policy="drop")
+
+    started = Event()
+
+    def block():
+        started.set()
+        blocker.wait()
+        return u""
+
+    # Block the writer thread so the queue fills up
+    writer.submit(block)
+    started.wait()
+
+    writer.write(u"kept")
+    writer.write(u"dropped")
+    assert writer.dropped == 1
+
+    blocker.set()
+    writer.flush()
+    assert output.getvalue() == u"kept"
+    writer.close()
+
+
+def test_queued_writer_unknown_policy():
+    with pytest.raises(ValueError):
+        QueuedWriter(StringIO(), policy="maybe")
+
+
+@require("app_context", "flask_storm")
+def test_shell_tracer_queued():
+    output = StringIO()
+
+    tracer = ShellTracer(file=output, fancy=False, queued=True)
+    with tracer:
+        store.execute("SELECT ? + ?", [1, 2])
+
+    # Output is flushed when the tracer stops
+    assert remove_whitespace(output.getvalue()).startswith("SELECT1+2;--SUCCESS")
+
+
+@require("app_context", "flask_storm")
+def test_shell_tracer_queued_stop():
+    output = StringIO()
+
+    tracer = ShellTracer(file=output, fancy=False, queued=True)
+    with tracer:
+        store.execute("SELECT 1")
+        thread = tracer.writer._thread
+        assert thread.is_alive()
+
+    # Stopping the tracer must not leave the writer thread behind
+    assert not thread.is_alive()
+    assert tracer.writer._thread is None
+
+    # The writer thread is started again when the tracer is reused
+    with tracer:
+        store.execute("SELECT 2")
+    assert remove_whitespace(output.getvalue()).count("--SUCCESS") == 2
+
+
+@require("app_context", "flask_storm")
+def test_shell_tracer_queued_adapts_on_caller():
+    output = StringIO()
+    threads = []
+
+    def adapt(self, value):
+        threads.append(current_thread())
+        return str(value)
+
+    tracer = ShellTracer(file=output, fancy=False, queued=True)
+    with patch("flask_storm.sql.Adapter.adapt", adapt):
+        with tracer:
+            store.execute("SELECT ? + ?", [1, 2])
+
+    # Only plain text is left for the writer thread
+    assert threads == [current_thread()] * 2
+    assert remove_whitespace(output.getvalue()).startswith("SELECT1+2;")
+
+
+@require("flask_storm")
+def test_request_tracer_buffered(app):
+    output = StringIO()
+
+    with app.test_request_context("/foo?bar=1"):
+        with RequestTracer(file=output, fancy=False, buffered=True):
+            store.execute("SELECT 1")
+            store.execute("SELECT ?", [2])
+
+            # Nothing is written until the tracer stops
+            assert output.getvalue() == ""
+
+    lines = output.getvalue().splitlines()
+    assert lines[0].endswith('"GET /foo?bar=1 HTTP/1.1" SQL -')
+    assert lines[1] == "SELECT 1;"
+    assert lines[2].startswith("-- SUCCESS")
+    assert lines[3] == "SELECT 2;"
+    assert lines[4].startswith("-- SUCCESS")
+    assert lines[5].startswith("-- 2 queries in")
+    assert len(lines) == 6
+
+
+@require("flask_storm")
+def test_request_tracer_buffered_teardown(app):
+    output = StringIO()
+    tracer = RequestTracer(file=output, fancy=False, buffered=True)
+    tracer.start()
+    try:
+        for i in range(2):
+            with app.test_request_context("/{}".format(i)):
+                store.execute("SELECT 1")
+
+            # Every application context is written on teardown
+            assert output.getvalue().count("SQL -") == i + 1
+    finally:
+        tracer.stop()
+
+    assert output.getvalue().count("-- 1 queries in") == 2
+
+
+@require("flask_storm")
+def test_request_tracer_unbuffered(app):
+    output = StringIO()
+
+    with app.test_request_context("/"):
+        with RequestTracer(file=output, fancy=False):
+            store.execute("SELECT 1")
+            store.execute("SELECT 2")
+
+    assert output.getvalue().count("SQL -") == 2
+
+
+def test_slow_query_tracer_json(app, flask_storm):
+    app.config["STORM_BINDS"] = {"extra": "sqlite:"}
+    app.add_url_rule("/slow", "slow", lambda: "")
+    output = StringIO()
+
+    with app.test_request_context("/slow"):
+        with SlowQueryTracer(threshold=0, file=output):
+            extra_store = flask_storm.get_store("extra")
+            extra_store.execute("SELECT ?", [u"foo"])
+
+    record = json.loads(output.getvalue())
+    assert record["statement"] == "SELECT 'foo'"
+    assert record["bind"] == "extra"
+    assert record["endpoint"] == "slow"
+    assert record["success"] is True
+    assert record["duration_ms"] >= 0
+    assert record["fingerprint"] == fingerprint("SELECT ?").hash
+
+
+@require("app_context", "flask_storm")
+def test_slow_query_tracer_threshold(app):
+    logger = MagicMock()
+
+    with SlowQueryTracer(logger=logger):
+        app.config["STORM_SLOW_QUERY_MS"] = 60 * 60 * 1000
+        store.execute("SELECT 1")
+        assert not logger.warning.called
+
+        app.config["STORM_SLOW_QUERY_MS"] = 0
+        with pytest.raises(Exception):
+            store.execute("SELECT !")
+        assert logger.warning.called
+
+    record = logger.warning.call_args[1]["extra"]["storm_slow_query"]
+    assert record["statement"] == "SELECT !"
+    assert record["success"] is False
+    assert record["bind"] is None
+    assert record["endpoint"] is None
+
+
+@require("app_context", "flask_storm")
+def test_slow_query_tracer_explain(app, tmpdir):
+    app.config["STORM_DATABASE_URI"] = "sqlite:" + str(tmpdir.join("db.sqlite"))
+    store.execute("CREATE TABLE foo (id INTEGER PRIMARY KEY)")
+    store.commit()
+
+    output = StringIO()
+    with DebugTracer():
+        with SlowQueryTracer(threshold=0, file=output, explain=True):
+            store.execute("SELECT * FROM foo WHERE id = ?", [1])
+            store.execute("SELECT * FROM foo WHERE id = ?", [2])
+
+        # The EXPLAIN statements are not seen by other tracers
+        assert len(get_debug_queries()) == 2
+
+    # Records with plans are written by the background thread once the plan is
+    # captured, which is done when the tracer stops
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    records.sort(key=lambda record: record["statement"])
+    assert len(records) == 2
+
+    assert "foo" in records[0]["plan"]
+
+    # Plans are captured once per interval for every fingerprint
+    assert "plan" not in records[1]
+
+
+def test_slow_query_tracer_explain_cache_size():
+    tracer = SlowQueryTracer(explain_cache_size=2)
+    assert tracer._should_explain("a")
+    assert tracer._should_explain("b")
+    assert not tracer._should_explain("a")
+
+    # The least recently used fingerprint is forgotten
+    assert tracer._should_explain("c")
+    assert not tracer._should_explain("a")
+    assert tracer._should_explain("b")
+
+
+@require("app_context", "flask_storm")
+def test_slow_query_tracer_explain_error():
+    output = StringIO()
+    with SlowQueryTracer(threshold=0, file=output, explain=True):
+        # The side connection uses a different in-memory database which lacks
+        # the table
+        store.execute("CREATE TABLE foo (id INTEGER PRIMARY KEY)")
+        store.execute("SELECT * FROM foo")
+
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert records[-1]["statement"] == "SELECT * FROM foo"
+    assert "plan" not in records[-1]
+
+
+@require("flask_storm")
+def test_query_budget_tracer_raise(app):
+    app.config["STORM_MAX_QUERIES_PER_REQUEST"] = 2
+    app.config["STORM_QUERY_BUDGET_MODE"] = "raise"
+
+    with app.test_request_context(), QueryBudgetTracer():
+        store.execute("SELECT 1")
+        store.execute("SELECT 1")
+        with pytest.raises(QueryBudgetExceeded) as e:
+            store.execute("SELECT 1")
+
+        # Limits are only reported once
+        store.execute("SELECT 1")
+
+    assert e.value.queries == 3
+    assert str(e.value) == "3 statements executed, the limit is 2 in endpoint None"
+
+
+@require("flask_storm")
+def test_query_budget_tracer_db_time(app):
+    app.config["STORM_MAX_DB_TIME_PER_REQUEST"] = 50
+    app.config["STORM_QUERY_BUDGET_MODE"] = "raise"
+
+    with app.test_request_context(), QueryBudgetTracer():
+        with patch("flask_storm.debug.perf_counter_ns") as perf_counter_ns:
+            perf_counter_ns.side_effect = [0, 40000000, 40000000, 80000000]
+            store.execute("SELECT 1")
+            with pytest.raises(QueryBudgetExceeded) as e:
+                store.execute("SELECT 1")
+
+    assert e.value.queries == 2
+    assert e.value.db_time == 80.0
+
+
+@require("flask_storm")
+def test_query_budget_tracer_log(app):
+    app.config["STORM_MAX_QUERIES_PER_REQUEST"] = 1
+
+    with app.test_request_context(), QueryBudgetTracer():
+        with patch("flask_storm.debug.logger") as logger:
+            for _ in range(3):
+                store.execute("SELECT 1")
+
+    logger.warning.assert_called_once_with(
+        "Query budget exceeded: %s",
+        "2 statements executed, the limit is 1 in endpoint None",
+    )
+
+
+@require("app_context", "flask_storm")
+def test_query_budget_tracer_outside_request(app):
+    app.config["STORM_MAX_QUERIES_PER_REQUEST"] = 1
+    app.config["STORM_QUERY_BUDGET_MODE"] = "raise"
+
+    # CLI commands and the shell only have an application context
+    with QueryBudgetTracer():
+        for _ in range(3):
+            store.execute("SELECT 1")
+
+
+@require("flask_storm")
+def test_query_budget_tracer_unknown_mode(app):
+    app.config["STORM_QUERY_BUDGET_MODE"] = "explode"
+
+    with app.app_context():
+        with pytest.raises(ValueError):
+            QueryBudgetTracer().start()
+
+    # Without an application context the mode is checked by the first statement
+    # of a request, even if no limit is exceeded
+    with QueryBudgetTracer(), app.test_request_context():
+        with pytest.raises(ValueError):
+            store.execute("SELECT 1")
+
+
+@require("flask_storm")
+def test_query_budget_restores_limits(app):
+    @query_budget(max_queries=5)
+    def view():
+        return app_context_budget()
+
+    def app_context_budget():
+        return getattr(_app_ctx_stack.top, "storm_query_budget", {})
+
+    with app.app_context():
+        assert view() == {"max_queries": 5}
+        assert app_context_budget() == {}
+
+
+@require("flask_storm")
+def test_query_budget_tracer_abort(app):
+    app.config["STORM_MAX_QUERIES_PER_REQUEST"] = 1
+    app.config["STORM_QUERY_BUDGET_MODE"] = "abort"
+
+    @app.route("/chatty")
+    def chatty():
+        store.execute("SELECT 1")
+        store.execute("SELECT 1")
+        return "ok"
+
+    @app.route("/report")
+    @query_budget(max_queries=2)
+    def report():
+        store.execute("SELECT 1")
+        store.execute("SELECT 1")
+        return "ok"
+
+    client = app.test_client()
+    with QueryBudgetTracer():
+        assert client.get("/chatty").status_code == 503
+        assert client.get("/report").status_code == 200
+
+
+def test_query_budget_unknown_mode():
+    with pytest.raises(ValueError):
+        query_budget(mode="explode")
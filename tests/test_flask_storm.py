@@ -3,7 +3,7 @@ import pytest
 from flask import Flask
 from flask_storm import FlaskStorm, find_flask_storm
 from mock import patch
-from storm.locals import Store
+from storm.locals import create_database, Store
 
 require = pytest.mark.usefixtures
 
@@ -60,6 +60,9 @@ def test_none_in_binds(app, flask_storm):
     with pytest.raises(RuntimeError):
         flask_storm.get_binds()
 
+    with pytest.raises(RuntimeError):
+        flask_storm.connect()
+
 
 @require("app_context")
 def test_connect(app, flask_storm):
@@ -144,3 +147,53 @@ def test_shell_context(app):
         assert "_store_tracer" in ctx
     finally:
         ctx["_store_tracer"].stop()
+
+
+@require("app_context")
+def test_get_database_cached(app, flask_storm):
+    database = flask_storm.get_database()
+    assert flask_storm.get_database() is database
+
+    # Changing the URI must invalidate the cached database
+    app.config["STORM_DATABASE_URI"] = "sqlite:"
+    assert flask_storm.get_database() is not database
+
+
+@require("app_context")
+def test_get_database_binds(app, flask_storm):
+    app.config["STORM_BINDS"] = {"extra": app.config["STORM_DATABASE_URI"]}
+
+    assert flask_storm.get_database("extra") is flask_storm.get_database("extra")
+    assert flask_storm.get_database("extra") is not flask_storm.get_database()
+
+    with pytest.raises(RuntimeError):
+        flask_storm.get_database("missing")
+
+
+def test_get_database_per_app(app, flask_storm):
+    other_app = Flask("bar")
+    other_app.config["STORM_DATABASE_URI"] = app.config["STORM_DATABASE_URI"]
+    flask_storm.init_app(other_app)
+
+    with app.app_context():
+        database = flask_storm.get_database()
+
+    with other_app.app_context():
+        assert flask_storm.get_database() is not database
+
+
+@require("app_context")
+def test_get_bind_name(app, flask_storm):
+    app.config["STORM_BINDS"] = {
+        "extra": "sqlite:",
+        "replicated": {"primary": "sqlite:", "replicas": ["sqlite:?r=1"]},
+    }
+
+    assert flask_storm.get_bind_name(flask_storm.get_database()) is None
+    assert flask_storm.get_bind_name(flask_storm.get_database("extra")) == "extra"
+
+    (replica,) = flask_storm.get_replica_set("replicated").replicas
+    assert flask_storm.get_bind_name(replica.database) == "replicated"
+
+    with pytest.raises(LookupError):
+        flask_storm.get_bind_name(create_database("sqlite:"))
@@ -0,0 +1,121 @@
+import pytest
+
+from flask_storm import MetricsTracer, store
+from flask_storm.sql import fingerprint
+from mock import patch
+from threading import Thread
+
+require = pytest.mark.usefixtures
+
+
+@require("app_context", "flask_storm")
+def test_metrics_tracer_collect():
+    tracer = MetricsTracer()
+    with tracer:
+        store.execute("SELECT 1")
+        store.execute("SELECT 2")
+        with pytest.raises(Exception):
+            store.execute("SELECT !")
+
+    collected = tracer.collect()
+    series = collected[(None, fingerprint("SELECT 1").hash, None)]
+    assert series.count == 2
+    assert series.errors == 0
+    assert sum(series.buckets) == 2
+    assert series.total_ns > 0
+
+    series = collected[(None, fingerprint("SELECT !").hash, None)]
+    assert series.count == 1
+    assert series.errors == 1
+
+
+def test_metrics_tracer_threads(app, flask_storm):
+    tracer = MetricsTracer()
+
+    def run():
+        with app.app_context():
+            store.execute("SELECT 1")
+
+    with tracer:
+        threads = [Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Collecting twice must not count statements twice
+        tracer.collect()
+        collected = tracer.collect()
+
+    assert collected[(None, fingerprint("SELECT 1").hash, None)].count == 4
+
+
+def test_metrics_tracer_endpoint(app, flask_storm):
+    app.config["STORM_BINDS"] = {"extra": "sqlite:"}
+    tracer = MetricsTracer(buckets=[60.0])
+
+    @app.route("/users")
+    def users():
+        flask_storm.get_store("extra").execute("SELECT 1")
+        return ""
+
+    with tracer:
+        app.test_client().get("/users")
+
+    text = tracer.render()
+    labels = 'bind="extra",fingerprint="{}",endpoint="users"'.format(
+        fingerprint("SELECT 1").hash
+    )
+    assert "# TYPE storm_queries_total counter" in text
+    assert "storm_queries_total{%s} 1" % labels in text
+    assert "storm_query_errors_total{%s} 0" % labels in text
+    assert "# TYPE storm_query_duration_seconds histogram" in text
+    assert 'storm_query_duration_seconds_bucket{%s,le="60.0"} 1' % labels in text
+    assert 'storm_query_duration_seconds_bucket{%s,le="+Inf"} 1' % labels in text
+    assert "storm_query_duration_seconds_count{%s} 1" % labels in text
+
+
+def test_metrics_tracer_wsgi_app():
+    tracer = MetricsTracer(namespace="db")
+    responses = []
+
+    def start_response(status, headers):
+        responses.append((status, dict(headers)))
+
+    body = b"".join(tracer.wsgi_app({}, start_response))
+    status, headers = responses[0]
+    assert status == "200 OK"
+    assert headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert b"# TYPE db_queries_total counter" in body
+
+
+@require("app_context")
+def test_register_metrics(app, flask_storm):
+    tracer = MetricsTracer()
+    with tracer:
+        store.execute("SELECT 1")
+
+    flask_storm.register_metrics(tracer, "/db-metrics")
+    response = app.test_client().get("/db-metrics")
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert b"storm_queries_total{" in response.data
+
+
+@require("app_context")
+def test_bind_name_cached(app, flask_storm):
+    app.config["STORM_BINDS"] = {"extra": "sqlite:"}
+    extra = flask_storm.get_store("extra")
+
+    tracer = MetricsTracer()
+    with tracer:
+        extra.execute("SELECT 1")
+
+        # The bind is resolved once per connection
+        with patch("flask_storm.utils.find_flask_storm") as find_flask_storm:
+            extra.execute("SELECT 1")
+        assert not find_flask_storm.called
+
+    series = tracer.collect()[("extra", fingerprint("SELECT 1").hash, None)]
+    assert series.count == 2
@@ -0,0 +1,299 @@
+import pytest
+
+from datetime import date, timedelta
+from flask_storm import (
+    bulk_insert,
+    DebugTracer,
+    get_debug_queries,
+    prefetch,
+    prefetched,
+    store,
+    stream,
+)
+from flask_storm.orm import _copy_value, _execute_streaming, _supports_named_cursors
+from mock import ANY, call, Mock, patch
+from storm.expr import Select
+from storm.locals import Int, Reference, ReferenceSet, Unicode
+
+require = pytest.mark.usefixtures
+
+
+class Person(object):
+    __storm_table__ = "people"
+
+    id = Int(primary=True)
+    name = Unicode()
+
+
+class Tag(object):
+    __storm_table__ = "tags"
+
+    id = Int(primary=True)
+    name = Unicode()
+
+
+class PostTag(object):
+    __storm_table__ = "post_tags"
+    __storm_primary__ = ("post_id", "tag_id")
+
+    post_id = Int()
+    tag_id = Int()
+
+
+class Comment(object):
+    __storm_table__ = "comments"
+
+    id = Int(primary=True)
+    post_id = Int()
+    text = Unicode()
+
+
+class Post(object):
+    __storm_table__ = "posts"
+
+    id = Int(primary=True)
+    author_id = Int()
+    author = Reference(author_id, Person.id)
+    comments = ReferenceSet(id, Comment.post_id, order_by=Comment.id)
+    tags = ReferenceSet(id, PostTag.post_id, PostTag.tag_id, Tag.id, order_by=Tag.name)
+
+
+@pytest.fixture
+def posts(flask_storm, app_context):
+    store.execute("CREATE TABLE people (id INTEGER PRIMARY KEY, name TEXT)")
+    store.execute("CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT)")
+    store.execute("CREATE TABLE post_tags (post_id INTEGER, tag_id INTEGER)")
+    store.execute(
+        "CREATE TABLE comments (id INTEGER PRIMARY KEY, post_id INTEGER, text TEXT)"
+    )
+    store.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, author_id INTEGER)")
+
+    store.execute("INSERT INTO people VALUES (1, 'alice'), (2, 'bob')")
+    store.execute("INSERT INTO tags VALUES (1, 'b'), (2, 'a')")
+    store.execute("INSERT INTO posts VALUES (1, 1), (2, 2), (3, 1), (4, NULL)")
+    store.execute("INSERT INTO post_tags VALUES (1, 1), (1, 2), (2, 1)")
+    store.execute("INSERT INTO comments VALUES (1, 1, 'x'), (2, 1, 'y'), (3, 3, 'z')")
+    return list(store.find(Post).order_by(Post.id))
+
+
+def count_queries(func):
+    with DebugTracer():
+        before = len(get_debug_queries())
+        func()
+        return len(get_debug_queries()) - before
+
+
+def test_prefetch_reference(posts):
+    assert count_queries(lambda: prefetch(posts, Post.author, chunk_size=1)) == 2
+
+    names = []
+    assert (
+        count_queries(lambda: names.extend(p.author and p.author.name for p in posts))
+        == 0
+    )
+    assert names == [u"alice", u"bob", u"alice", None]
+
+
+def test_prefetch_reference_set(posts):
+    # One query for the posts and one for the comments
+    assert count_queries(lambda: prefetch(store.find(Post), Post.comments)) == 2
+
+    def get_comments():
+        return [[c.text for c in prefetched(p, Post.comments)] for p in posts]
+
+    assert count_queries(get_comments) == 0
+    assert get_comments() == [[u"x", u"y"], [], [u"z"], []]
+
+
+def test_prefetch_indirect_reference_set(posts):
+    assert count_queries(lambda: prefetch(posts, Post.tags)) == 1
+
+    def get_tags():
+        return [[t.name for t in prefetched(p, Post.tags)] for p in posts]
+
+    assert count_queries(get_tags) == 0
+    assert get_tags() == [[u"a", u"b"], [u"b"], [], []]
+
+
+def test_prefetched_fallback(posts):
+    assert [c.text for c in prefetched(posts[0], Post.comments)] == [u"x", u"y"]
+
+
+@require("flask_storm", "app_context")
+def test_prefetch_invalid():
+    assert prefetch([]) == []
+
+    with pytest.raises(TypeError):
+        prefetch([Post()], Post.id)
+
+    with pytest.raises(TypeError):
+        prefetch([], Post.author, size=1)
+
+
+@pytest.fixture
+def people(flask_storm, app_context):
+    store.execute("CREATE TABLE people (id INTEGER PRIMARY KEY, name TEXT)")
+
+
+@require("people")
+def test_bulk_insert():
+    rows = [{"name": u"person {}".format(i)} for i in range(10)]
+    assert count_queries(lambda: bulk_insert(store, Person, rows, batch_size=4)) == 3
+
+    names = [p.name for p in store.find(Person).order_by(Person.id)]
+    assert names == [row["name"] for row in rows]
+
+
+@require("people")
+def test_bulk_insert_return_keys():
+    rows = [{"name": u"alice"}, {"name": u"bob"}]
+    assert bulk_insert(store, Person, rows, return_keys=True) == [1, 2]
+    assert store.get(Person, 2).name == u"bob"
+
+    # Keys that are given are returned without asking the database
+    rows = [{"id": 10, "name": u"carol"}, {"id": 5, "name": u"dave"}]
+    assert bulk_insert(store, Person, rows, return_keys=True) == [10, 5]
+    assert store.get(Person, 5).name == u"dave"
+
+    store.execute("CREATE TABLE post_tags (post_id INTEGER, tag_id INTEGER)")
+    keys = bulk_insert(store, PostTag, [{"post_id": 1, "tag_id": 2}], return_keys=True)
+    assert keys == [(1, 2)]
+
+
+@require("people")
+def test_bulk_insert_invalid():
+    assert bulk_insert(store, Person, []) == 0
+
+    with pytest.raises(ValueError):
+        bulk_insert(store, Person, [{"name": u"alice"}, {"id": 1}])
+
+    with pytest.raises(KeyError):
+        bulk_insert(store, Person, [{"email": u"alice@example.com"}])
+
+
+@require("people")
+def test_bulk_insert_copy():
+    data = []
+    cursor = Mock()
+    cursor.copy_expert.side_effect = lambda statement, f: data.append(f.read())
+
+    connection = store._connection
+    rows = [{"name": u"a\tb\nc"}, {"name": None}]
+    with patch("flask_storm.orm.Adapter") as adapter, patch(
+        "flask_storm.orm.trace"
+    ) as trace, patch.object(connection, "build_raw_cursor", return_value=cursor):
+        adapter.return_value.type = "postgres"
+        assert bulk_insert(store, Person, rows) == 2
+
+    statement = "COPY people (name) FROM STDIN"
+    cursor.copy_expert.assert_called_once_with(statement, ANY)
+    assert data == [b"a\\tb\\nc\n\\N\n"]
+    assert cursor.close.called
+
+    assert trace.call_args_list == [
+        call("connection_raw_execute", connection, cursor, statement, ()),
+        call("connection_raw_execute_success", connection, cursor, statement, ()),
+    ]
+
+
+@require("people")
+def test_bulk_insert_copy_error():
+    error = RuntimeError("COPY failed")
+    cursor = Mock()
+    cursor.copy_expert.side_effect = error
+
+    connection = store._connection
+    with patch("flask_storm.orm.Adapter") as adapter, patch(
+        "flask_storm.orm.trace"
+    ) as trace, patch.object(connection, "build_raw_cursor", return_value=cursor):
+        adapter.return_value.type = "postgres"
+        with pytest.raises(RuntimeError):
+            bulk_insert(store, Person, [{"name": u"alice"}])
+
+    statement = "COPY people (name) FROM STDIN"
+    assert trace.call_args_list[-1] == call(
+        "connection_raw_execute_error", connection, cursor, statement, (), error
+    )
+    assert cursor.close.called
+
+
+def test_copy_value():
+    assert _copy_value(None) == u"\\N"
+    assert _copy_value(True) == u"t"
+    assert _copy_value(b"\x00\xff") == u"\\\\x00ff"
+    assert _copy_value(u"a\\b\tc\nd\re") == u"a\\\\b\\tc\\nd\\re"
+    assert _copy_value(date(2020, 1, 2)) == u"2020-01-02"
+    assert _copy_value(timedelta(1, 2, 3)) == u"1 days 2 seconds 3 microseconds"
+    assert _copy_value(42) == u"42"
+
+    with pytest.raises(TypeError):
+        _copy_value([1, 2])
+
+
+@require("people")
+def test_stream():
+    bulk_insert(store, Person, [{"name": u"person {}".format(i)} for i in range(5)])
+    result = store.find(Person).order_by(Person.id)
+
+    cursors = []
+
+    def execute_streaming(store, statement):
+        result = _execute_streaming(store, statement)
+        result._raw_cursor = Mock(wraps=result._raw_cursor)
+        cursors.append(result._raw_cursor)
+        return result
+
+    with patch("flask_storm.orm._execute_streaming", execute_streaming):
+        people = stream(store, result, batch_size=2)
+        assert next(people).name == u"person 0"
+        assert cursors[0].fetchmany.call_count == 1
+
+        names = [p.name for p in people]
+        assert names == [u"person {}".format(i) for i in range(1, 5)]
+        assert cursors[0].fetchmany.call_count == 4
+
+    rows = list(stream(store, result, objects=False))
+    assert rows[0] == (1, u"person 0")
+
+    rows = list(stream(store, Select(Person.name, Person.id > 3)))
+    assert rows == [(u"person 3",), (u"person 4",)]
+
+    # Invalid arguments are reported before iterating
+    with pytest.raises(TypeError):
+        stream(store, "SELECT 1")
+
+    with pytest.raises(ValueError):
+        stream(store, result, batch_size=0)
+
+
+@require("people")
+def test_stream_check_disconnect():
+    bulk_insert(store, Person, [{"name": u"alice"}])
+
+    # Lost connections must be reported like Storm does for regular results
+    connection = store._connection
+    with patch.object(
+        connection, "_check_disconnect", wraps=connection._check_disconnect
+    ) as check_disconnect:
+        assert list(stream(store, store.find(Person), batch_size=5)) == [
+            store.get(Person, 1)
+        ]
+
+    fetches = [
+        c for c in check_disconnect.call_args_list if c[0][0].__name__ == "fetchmany"
+    ]
+    assert [c[0][1:] for c in fetches] == [(5,), (5,)]
+
+
+@require("people")
+def test_stream_postgres_legacy_storm():
+    bulk_insert(store, Person, [{"name": u"alice"}])
+
+    # Without the Storm internals server side cursors are not used, even on
+    # PostgreSQL
+    with patch("flask_storm.orm.Adapter") as adapter:
+        adapter.return_value.type = "postgres"
+        assert _supports_named_cursors(store._connection)
+
+        with patch("flask_storm.orm._named_cursor_requirements", ("_missing",)):
+            assert list(stream(store, store.find(Person))) == [store.get(Person, 1)]
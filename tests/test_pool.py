@@ -0,0 +1,211 @@
+import pytest
+
+from flask_storm import store
+from flask_storm.pool import StorePool
+from mock import patch
+from storm.locals import create_database, Store
+from threading import Thread
+
+require = pytest.mark.usefixtures
+
+
+@pytest.fixture
+def database():
+    return create_database("sqlite:")
+
+
+@pytest.fixture
+def pooled_app(app):
+    app.config["STORM_POOL_SIZE"] = 2
+    app.config["STORM_POOL_MAX_OVERFLOW"] = 0
+
+    # SQLite is not pooled, but is used here since it is the only database
+    # available to the tests
+    with patch("flask_storm.ext._thread_bound_databases", ()):
+        yield app
+
+
+def test_checkout_checkin(database):
+    pool = StorePool(database, size=1, max_overflow=0)
+
+    store = pool.checkout()
+    assert isinstance(store, Store)
+    assert pool.checked_out == 1
+    assert pool.idle == 0
+
+    pool.checkin(store)
+    assert pool.checked_out == 0
+    assert pool.idle == 1
+
+    # The idle store must be reused
+    assert pool.checkout() is store
+
+
+def test_checkin_rolls_back(database):
+    pool = StorePool(database, size=1, max_overflow=0)
+
+    store = pool.checkout()
+    with patch.object(store, "rollback", wraps=store.rollback) as mock:
+        pool.checkin(store)
+        assert mock.called
+
+
+def test_overflow_closed(database):
+    pool = StorePool(database, size=1, max_overflow=1)
+
+    first = pool.checkout()
+    second = pool.checkout()
+
+    with patch.object(second, "close", wraps=second.close) as mock:
+        pool.checkin(first)
+        pool.checkin(second)
+        assert mock.called
+
+    assert pool.idle == 1
+
+
+def test_timeout(database):
+    pool = StorePool(database, size=1, max_overflow=0, timeout=0.01)
+    pool.checkout()
+
+    with pytest.raises(RuntimeError):
+        pool.checkout()
+
+
+def test_wait_for_checkin(database):
+    pool = StorePool(database, size=1, max_overflow=0, timeout=5)
+    store = pool.checkout()
+
+    result = []
+    t = Thread(target=lambda: result.append(pool.checkout()))
+    t.start()
+
+    pool.checkin(store)
+    t.join()
+
+    assert result == [store]
+
+
+def test_recycle(database):
+    pool = StorePool(database, size=1, max_overflow=0, recycle=0)
+
+    store = pool.checkout()
+    pool.checkin(store)
+
+    assert pool.idle == 0
+    assert pool.checkout() is not store
+
+
+def test_broken_store_discarded(database):
+    pool = StorePool(database, size=1, max_overflow=0)
+
+    store = pool.checkout()
+    with patch.object(store, "rollback", side_effect=Exception("broken")):
+        pool.checkin(store)
+
+    assert pool.idle == 0
+    assert pool.checked_out == 0
+    assert pool.checkout() is not store
+
+
+def test_pre_ping(database):
+    pool = StorePool(database, size=1, max_overflow=0, pre_ping=True)
+    store = pool.checkout()
+    pool.checkin(store)
+
+    with patch.object(store, "execute", wraps=store.execute) as mock:
+        assert pool.checkout() is store
+        mock.assert_called_with("SELECT 1")
+
+
+def test_close(database):
+    pool = StorePool(database, size=1, max_overflow=0)
+    pool.checkin(pool.checkout())
+    pool.close()
+
+    assert pool.idle == 0
+    with pytest.raises(RuntimeError):
+        pool.checkout()
+
+
+def test_get_pool_disabled(app, flask_storm):
+    with app.app_context():
+        assert flask_storm.get_pool() is None
+
+
+def test_get_pool(pooled_app, flask_storm):
+    with pooled_app.app_context():
+        pool = flask_storm.get_pool()
+        assert isinstance(pool, StorePool)
+        assert pool.size == 2
+        assert flask_storm.get_pool() is pool
+
+        pooled_app.config["STORM_DATABASE_URI"] = "sqlite:"
+        assert flask_storm.get_pool() is not pool
+
+
+def test_pooled_store_reused(pooled_app, flask_storm):
+    with pooled_app.app_context():
+        first = store._get_current_object()
+        pool = flask_storm.get_pool()
+        assert pool.checked_out == 1
+
+    assert pool.checked_out == 0
+    assert pool.idle == 1
+
+    with pooled_app.app_context():
+        assert store._get_current_object() is first
+
+
+def test_get_pool_options(pooled_app, flask_storm):
+    with pooled_app.app_context():
+        pool = flask_storm.get_pool()
+
+        pooled_app.config["STORM_POOL_MAX_OVERFLOW"] = 1
+        assert flask_storm.get_pool() is not pool
+        assert flask_storm.get_pool().max_overflow == 1
+
+
+def test_sqlite_not_pooled(app, flask_storm):
+    app.config["STORM_POOL_SIZE"] = 2
+    errors = []
+
+    def run():
+        try:
+            with app.app_context():
+                store.execute("SELECT 1")
+        except Exception as e:
+            errors.append(e)
+
+    # Every thread gets its own connection, since SQLite connections can not
+    # be shared between threads
+    for _ in range(2):
+        thread = Thread(target=run)
+        thread.start()
+        thread.join()
+
+    assert errors == []
+    with app.app_context():
+        assert flask_storm.get_pool() is None
+
+
+def test_close_outside_lock(database):
+    pool = StorePool(database, size=0, max_overflow=1)
+    store = pool.checkout()
+    acquired = []
+
+    def try_acquire():
+        if pool._condition.acquire(False):
+            acquired.append(True)
+            pool._condition.release()
+
+    def close():
+        # Other threads must be able to use the pool while a store is closed
+        thread = Thread(target=try_acquire)
+        thread.start()
+        thread.join()
+
+    with patch.object(store, "close", side_effect=close):
+        pool.checkin(store)
+
+    assert acquired == [True]
@@ -0,0 +1,198 @@
+import pytest
+
+from flask_storm import create_context_local, store
+from flask_storm.replica import LatencyTracer, Replica, ReplicaSet
+from mock import patch
+from storm.locals import create_database, Store
+
+require = pytest.mark.usefixtures
+
+broken_uri = "sqlite:/nonexistent/directory/replica.db"
+
+
+@pytest.fixture
+def replica_app(app):
+    app.config["STORM_BINDS"] = {
+        "main": {
+            "primary": "sqlite:",
+            "replicas": ["sqlite:", "sqlite:?replica=2"],
+        },
+    }
+    return app
+
+
+def make_replica_set(count, **kwargs):
+    replicas = [
+        Replica("sqlite:?r={}".format(i), create_database("sqlite:"))
+        for i in range(count)
+    ]
+    return ReplicaSet(replicas, **kwargs)
+
+
+def test_round_robin():
+    replica_set = make_replica_set(3)
+    first = [replica_set.candidates()[0] for _ in range(3)]
+
+    assert first == replica_set.replicas
+
+
+def test_latency():
+    replica_set = make_replica_set(3, strategy="latency")
+    a, b, c = replica_set.replicas
+
+    replica_set.record_latency(a, 0.3)
+    replica_set.record_latency(b, 0.1)
+
+    # Replicas without measurements come first, then the fastest one
+    assert replica_set.candidates() == [c, b, a]
+
+
+def test_latency_tolerance():
+    replica_set = make_replica_set(3, strategy="latency")
+    a, b, c = replica_set.replicas
+
+    replica_set.record_latency(a, 0.1)
+    replica_set.record_latency(b, 0.12)
+    replica_set.record_latency(c, 0.5)
+
+    # Replicas that are almost as fast share the traffic, slow ones come last
+    first = [replica_set.candidates() for _ in range(2)]
+    assert first == [[a, b, c], [b, a, c]]
+
+
+def test_latency_moving_average():
+    replica_set = make_replica_set(1, strategy="latency")
+    (replica,) = replica_set.replicas
+
+    replica_set.record_latency(replica, 1.0)
+    replica_set.record_latency(replica, 2.0)
+    assert replica.latency == pytest.approx(1.2)
+
+
+def test_latency_tracer():
+    replica_set = make_replica_set(2, strategy="latency")
+    a, b = replica_set.replicas
+
+    tracer = LatencyTracer()
+    tracer.track(replica_set)
+
+    store = Store(a.database)
+    try:
+        with patch("flask_storm.replica.time", side_effect=[10.0, 10.25]):
+            tracer.connection_raw_execute(store._connection, None, "SELECT 1", ())
+            tracer.connection_raw_execute_success(
+                store._connection, None, "SELECT 1", ()
+            )
+    finally:
+        store.close()
+
+    assert a.latency == 0.25
+    assert b.latency is None
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        make_replica_set(1, strategy="random")
+
+
+def test_ejection_backoff():
+    replica_set = make_replica_set(2, backoff=30)
+    a, b = replica_set.replicas
+
+    with patch("flask_storm.replica.time", return_value=1000):
+        replica_set.mark_failure(a)
+        assert a.ejected_until == 1030
+        assert replica_set.candidates() == [b]
+
+        replica_set.mark_failure(a)
+        assert a.ejected_until == 1060
+
+        for _ in range(10):
+            replica_set.mark_failure(a)
+        assert a.ejected_until == 1300
+
+    with patch("flask_storm.replica.time", return_value=2000):
+        assert a in replica_set.candidates()
+
+    replica_set.mark_success(a)
+    assert a.failures == 0
+
+
+@require("app_context")
+def test_get_replica_set(replica_app, flask_storm):
+    assert flask_storm.get_replica_set() is None
+
+    replica_set = flask_storm.get_replica_set("main")
+    assert replica_set.uris == ["sqlite:", "sqlite:?replica=2"]
+    assert flask_storm.get_replica_set("main") is replica_set
+
+    replica_app.config["STORM_REPLICA_STRATEGY"] = "latency"
+    latency_set = flask_storm.get_replica_set("main")
+    assert latency_set is not replica_set
+
+    # Executing statements on the replica records its latency
+    try:
+        replica = flask_storm.get_store("main", readonly=True)
+        replica.execute("SELECT 1")
+
+        assert [r.latency is not None for r in latency_set.replicas].count(True) == 1
+    finally:
+        flask_storm._latency_tracer.stop()
+
+
+@require("app_context")
+def test_readonly_store(replica_app, flask_storm):
+    primary = flask_storm.get_store("main")
+    replica = flask_storm.get_store("main", readonly=True)
+
+    assert replica is not primary
+    assert flask_storm.get_store("main", readonly=True) is replica
+    assert replica.get_database() in [
+        r.database for r in flask_storm.get_replica_set("main").replicas
+    ]
+
+
+@require("app_context")
+def test_readonly_without_replicas(flask_storm):
+    assert flask_storm.get_store(readonly=True) is flask_storm.get_store()
+
+
+@require("app_context")
+def test_readonly_context_local(replica_app, flask_storm):
+    replica_store = create_context_local("main", readonly=True)
+
+    assert replica_store._get_current_object() is flask_storm.get_store(
+        "main", readonly=True
+    )
+    assert store._get_current_object() is not replica_store._get_current_object()
+
+
+@require("app_context")
+def test_failing_replica_ejected(replica_app, flask_storm):
+    replica_app.config["STORM_BINDS"]["main"]["replicas"] = [broken_uri, "sqlite:"]
+    replica_set = flask_storm.get_replica_set("main")
+    broken, working = replica_set.replicas
+
+    replica = flask_storm.get_store("main", readonly=True)
+
+    assert replica.get_database() is working.database
+    assert broken.failures == 1
+    assert replica_set.candidates() == [working]
+
+
+@require("app_context")
+def test_all_replicas_failing(replica_app, flask_storm):
+    replica_app.config["STORM_BINDS"]["main"]["replicas"] = [broken_uri]
+
+    replica = flask_storm.get_store("main", readonly=True)
+    assert replica.get_database() is flask_storm.get_database("main")
+
+
+def test_readonly_teardown(replica_app, flask_storm):
+    with replica_app.app_context():
+        replica = flask_storm.get_store("main", readonly=True)
+        patch_close = patch.object(replica, "close", wraps=replica.close)
+        mock = patch_close.start()
+
+    patch_close.stop()
+    assert mock.called
@@ -0,0 +1,148 @@
+import os
+import pytest
+
+from flask_storm import SharedStatsTracer, store
+from flask_storm.shared import SharedStats
+from flask_storm.sql import fingerprint
+
+require = pytest.mark.usefixtures
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join("stats"))
+
+
+def test_shared_stats(path):
+    stats = SharedStats(path, slots=8)
+    stats.record("0000000000000001", u"SELECT ?", 10)
+    stats.record("0000000000000001", u"SELECT ?", 30, success=False)
+    stats.record("0000000000000009", u"SELECT * FROM t", 5)
+
+    entries = {entry.hash: entry for entry in stats.entries()}
+    assert len(entries) == 2
+
+    # Both hashes map to the same slot, which must be resolved by probing
+    entry = entries["0000000000000001"]
+    assert entry.text == u"SELECT ?"
+    assert entry.count == 2
+    assert entry.errors == 1
+    assert entry.total_ns == 40
+    assert entry.max_ns == 30
+
+    assert entries["0000000000000009"].text == u"SELECT * FROM t"
+
+    # Other instances see the same statistics, using the size from the file
+    other = SharedStats(path, slots=1)
+    assert sorted(other.entries()) == sorted(entries.values())
+    assert other.slots == 8
+
+
+def test_shared_stats_overflow(path):
+    stats = SharedStats(path, slots=1)
+    stats.record("0000000000000001", u"SELECT 1", 10)
+    stats.record("0000000000000002", u"SELECT 2", 10)
+
+    assert [entry.text for entry in stats.entries()] == [u"SELECT 1"]
+    assert stats.overflow == 1
+
+    stats.reset()
+    assert stats.entries() == []
+    assert stats.overflow == 0
+
+
+def test_shared_stats_text_size(path):
+    stats = SharedStats(path, text_size=4)
+    stats.record("0000000000000001", u"SELECT \xe5\xe4\xf6", 10)
+    stats.record("0000000000000002", u"SEL\xe5", 10)
+
+    assert sorted(entry.text for entry in stats.entries()) == [u"SEL", u"SELE"]
+
+
+def test_shared_stats_invalid_file(path):
+    with open(path, "wb") as f:
+        f.write(b"not a statistics file")
+
+    with pytest.raises(ValueError):
+        SharedStats(path).entries()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_shared_stats_processes(path):
+    stats = SharedStats(path)
+    stats.record("0000000000000001", u"SELECT ?", 10)
+
+    pids = []
+    for _ in range(4):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for _ in range(25):
+                    stats.record("0000000000000001", u"SELECT ?", 10)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    (entry,) = stats.entries()
+    assert entry.count == 101
+    assert entry.total_ns == 1010
+
+
+@require("app_context", "flask_storm")
+def test_shared_stats_tracer(path):
+    tracer = SharedStatsTracer(path)
+    with tracer:
+        store.execute("SELECT 1")
+        store.execute("SELECT 2")
+
+    (entry,) = tracer.stats.entries()
+    assert entry.hash == fingerprint("SELECT 1").hash
+    assert entry.text == fingerprint("SELECT 1").text
+    assert entry.count == 2
+
+
+def test_stats_command(app, flask_storm, path):
+    stats = SharedStats(path)
+    stats.record("0000000000000001", "SELECT * FROM a", 1000000)
+    stats.record("0000000000000002", "SELECT * FROM b", 3000000)
+    stats.record("0000000000000002", "SELECT * FROM b", 3000000)
+
+    app.config["STORM_SHARED_STATS_PATH"] = path
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(args=["storm", "stats"])
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert "total ms" in lines[0]
+    assert lines[1].split() == [
+        "6.0",
+        "2",
+        "3.00",
+        "3.00",
+        "0",
+        "SELECT",
+        "*",
+        "FROM",
+        "b",
+    ]
+    assert lines[2].endswith("SELECT * FROM a")
+
+    result = runner.invoke(args=["storm", "stats", "--limit", "1", "--reset"])
+    assert result.exit_code == 0
+    assert len(result.output.splitlines()) == 2
+    assert stats.entries() == []
+
+
+def test_stats_command_missing_file(app, flask_storm, path):
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(args=["storm", "stats"])
+    assert result.exit_code != 0
+    assert "STORM_SHARED_STATS_PATH" in result.output
+
+    result = runner.invoke(args=["storm", "stats", "--path", path])
+    assert result.exit_code != 0
+    assert "does not exist" in result.output
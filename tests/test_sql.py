@@ -2,7 +2,20 @@ import pytest
 
 from datetime import date
 from flask_storm._compat import bstr, max_int
-from flask_storm.sql import default_adapter, replace_placeholders, format, color
+from flask_storm.sql import (
+    adapt_params,
+    Adapter,
+    default_adapter,
+    literal_adapter,
+    replace_placeholders,
+    normalize,
+    fingerprint,
+    Fingerprint,
+    format,
+    color,
+    render,
+    tables,
+)
 from mock import patch
 
 # Enable skipping of tests that do not run without sqlparse being installed
@@ -13,6 +26,8 @@ except ImportError:
 
 require_sqlparse = pytest.mark.skipif(not sqlparse, reason="requires sqlparse")
 
+remove_whitespace = pytest.helpers.remove_whitespace
+
 
 def to_ustr(s):
     """Helper function to ensure string is unicode."""
@@ -110,3 +125,158 @@ def test_color_no_sqlparse():
 
     with patch("flask_storm.sql.sqlparse", None):
         assert sql == color(sql)
+
+
+@pytest.mark.parametrize("use_sqlparse", [True, False])
+def test_normalize(use_sqlparse):
+    if use_sqlparse and sqlparse is None:
+        pytest.skip("requires sqlparse")
+
+    with patch("flask_storm.sql.sqlparse", sqlparse if use_sqlparse else None):
+        assert normalize("SELECT 1") == "SELECT ?"
+        assert normalize("SELECT 'foo''bar', -1.5e3") == "SELECT ?, ?"
+        assert normalize("SELECT * FROM t2 WHERE id = %s") == (
+            "SELECT * FROM t2 WHERE id = ?"
+        )
+        assert normalize("SELECT x FROM t -- comment\n WHERE x = ?") == (
+            "SELECT x FROM t WHERE x = ?"
+        )
+        assert normalize("SELECT x  FROM\n\tt /* comment */") == "SELECT x FROM t"
+        assert normalize("SELECT x FROM t WHERE x IN (1, 2, 3)") == normalize(
+            "SELECT x FROM t WHERE x IN (?,?)"
+        )
+        assert normalize("SELECT x FROM t WHERE x IN (?,?)").endswith("IN (...)")
+
+
+def test_fingerprint():
+    fp = fingerprint("SELECT * FROM t WHERE id = 1")
+
+    assert isinstance(fp, Fingerprint)
+    assert fp.text == "SELECT * FROM t WHERE id = ?"
+    assert fp == fingerprint("SELECT * FROM t WHERE id = 2")
+    assert fp.hash != fingerprint("SELECT * FROM t WHERE name = 1").hash
+
+    # Double quoted identifiers are names, not string literals
+    assert fingerprint('SELECT * FROM "user" WHERE id = 1').text == (
+        'SELECT * FROM "user" WHERE id = ?'
+    )
+    assert (
+        fingerprint('SELECT * FROM "user" WHERE id = 1').hash
+        != fingerprint('SELECT * FROM "order" WHERE id = 1').hash
+    )
+
+    # The hash must be stable across processes
+    assert fp.hash == "cbd083708a34d661"
+
+
+def test_fingerprint_cached():
+    fingerprint.cache_clear()
+    with patch("flask_storm.sql.normalize", wraps=normalize) as mock:
+        fingerprint("SELECT 1")
+        fingerprint("SELECT 1")
+
+    assert mock.call_count == 1
+
+
+@require_sqlparse
+def test_replace_placeholders_quoted():
+    sql = "SELECT '?', ? FROM t -- ?"
+    assert replace_placeholders(sql, [1]) == "SELECT '?', 1 FROM t -- ?"
+
+
+@require_sqlparse
+def test_replace_placeholders_cached():
+    sql = "SELECT ? + ? FROM cached"
+    with patch("flask_storm.sql.sqlparse.parse", wraps=sqlparse.parse) as mock:
+        assert replace_placeholders(sql, [1, 2]) == "SELECT 1 + 2 FROM cached"
+        assert replace_placeholders(sql, [3, 4]) == "SELECT 3 + 4 FROM cached"
+
+    assert mock.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "sql, expected",
+    [
+        ("SELECT ? + ?", "SELECT 1 + 2"),
+        ("SELECT %s + %s", "SELECT 1 + 2"),
+        ("SELECT '?', ?, ?", "SELECT '?', 1, 2"),
+        ("SELECT 'it''s ?', ?, ?", "SELECT 'it''s ?', 1, 2"),
+        ("SELECT E'\\' ?', ?, ?", "SELECT E'\\' ?', 1, 2"),
+        ('SELECT "?" + ?, ?', 'SELECT "?" + 1, 2'),
+        ("SELECT $$ ? $$, $x$ $$ ? $x$, ?, ?", "SELECT $$ ? $$, $x$ $$ ? $x$, 1, 2"),
+        ("SELECT ? -- ?\n, ?", "SELECT 1 -- ?\n, 2"),
+        ("SELECT /* ? */ ?, ?", "SELECT /* ? */ 1, 2"),
+        ("SELECT '%' || %s, %%s, %s", "SELECT '%' || 1, %%s, 2"),
+    ],
+)
+def test_replace_placeholders_fast(sql, expected):
+    assert replace_placeholders(sql, [1, 2], fast=True) == expected
+
+
+def test_replace_placeholders_no_sqlparse():
+    with patch("flask_storm.sql.sqlparse", None):
+        assert replace_placeholders("SELECT ? + ?", [1, 2]) == "SELECT 1 + 2"
+
+        with pytest.raises(ValueError):
+            replace_placeholders("SELECT ?", [])
+
+
+def test_render():
+    assert remove_whitespace(render("SELECT ? + ?", [1, 2])) == "SELECT1+2"
+
+
+@require_sqlparse
+def test_render_color():
+    rendered = render("SELECT * FROM t WHERE name = ?", [u"foo"], colorize=True)
+
+    assert rendered != pytest.helpers.remove_ansi(rendered)
+    assert remove_whitespace(pytest.helpers.remove_ansi(rendered)) == (
+        "SELECT*FROMtWHEREname='foo'"
+    )
+
+
+@require_sqlparse
+def test_render_cached():
+    sql = "SELECT * FROM render_cached WHERE id = ?"
+    with patch("flask_storm.sql.sqlparse.format", wraps=sqlparse.format) as mock:
+        first = render(sql, [1])
+        second = render(sql, [2])
+
+    assert mock.call_count == 1
+    assert first.replace("1", "2") == second
+
+
+def test_render_exhausted_params():
+    with pytest.raises(ValueError):
+        render("SELECT ?", [])
+
+
+def test_tables():
+    assert tables("SELECT * FROM a, b AS _1 JOIN c ON x") == {"a", "b", "c"}
+    assert tables('SELECT * FROM "Users" WHERE id IN (SELECT id FROM x)') == {
+        "users",
+        "x",
+    }
+    assert tables("INSERT INTO public.a (id) VALUES (1)") == {"a"}
+    assert tables("UPDATE a SET x = 1, y = 2") == {"a"}
+    assert tables("DELETE FROM a WHERE id IN (1, 2)") == {"a"}
+    assert tables("SELECT 1") == frozenset()
+
+    assert tables("UPDATE ONLY a SET x = 1") == {"a"}
+    assert tables("SELECT * FROM ONLY a") == {"a"}
+    assert tables("COPY a (id) FROM STDIN") == {"a"}
+    assert tables("COPY (SELECT * FROM a) TO STDOUT") == {"a"}
+    assert tables("TRUNCATE TABLE ONLY a, b") == {"a", "b"}
+
+
+def test_adapt_params():
+    class FailingAdapter(Adapter):
+        def adapt(self, value):
+            raise ValueError(value)
+
+    assert adapt_params([1, u"a'b", None]) == ("1", u"'a''b'", "NULL")
+    assert adapt_params([1], FailingAdapter()) == ("1",)
+
+    params = adapt_params([1, u"foo"])
+    sql = replace_placeholders("SELECT ?, ?", params, literal_adapter)
+    assert sql == u"SELECT 1, 'foo'"